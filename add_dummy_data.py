@@ -1,6 +1,7 @@
 import database
 import crw
 import crw_jsonrpc
+import passwords
 import datetime as dt
 import random as r
 
@@ -49,6 +50,7 @@ def create_fake_data(user, user_id, rpc):
                            dt.timedelta(seconds=r.randint(30, 300)))])
 
 if __name__ == '__main__':
+    passwords.configure(crw.PASSWORD_ROUNDS)
     db = database.Database(crw.DATABASE_HOST, crw.DATABASE_PORT,
                            crw.DATABASE_NAME,
                            crw.DATABASE_USER, crw.DATABASE_PASS)
@@ -0,0 +1,62 @@
+"""
+Compares the latency of adding a training with a growing number of
+intervals, between adding every interval separately like add_training
+used to and TrainingDatabase.add_training_with_intervals.
+
+Run with: python bench_add_training.py
+"""
+import datetime
+import benchmark
+import database as d
+
+INTERVAL_COUNTS = [1, 5, 20, 50, 100]
+TRAININGS = 20
+
+
+def add_separately(trdb, idb, user_id, intervals):
+    """The way a training was added before, with a commit for the
+    training and every interval."""
+    training_id = trdb.add_training(
+        user_id, datetime.datetime.now(), True, '')
+    for (duration, power, pace, rest) in intervals:
+        idb.add_interval(training_id, duration, power, pace, rest)
+
+
+def measure(db, function):
+    """Returns (queries, commits, median milliseconds) of adding one
+    training with function."""
+    db.queries = 0
+    db.commits = 0
+    function()
+    (queries, commits) = (db.queries, db.commits)
+    durations = benchmark.timed(function, repeat=TRAININGS)
+    return (queries, commits, benchmark.median(durations) * 1000)
+
+
+if __name__ == '__main__':
+    db = benchmark.connect(database_class=benchmark.CountingDatabase)
+    benchmark.reset_database(db)
+    trdb = d.TrainingDatabase(db)
+    idb = d.IntervalDatabase(db)
+    user_id = d.UserDatabase(db).add_user('rower@crw.nl', 'benchmark')
+
+    rows = []
+    for interval_count in INTERVAL_COUNTS:
+        intervals = [(60, 300, 20, datetime.timedelta(seconds=60))
+                     for _ in range(interval_count)]
+
+        before = measure(db, lambda: add_separately(
+            trdb, idb, user_id, intervals))
+        after = measure(db, lambda: trdb.add_training_with_intervals(
+            user_id, datetime.datetime.now(), True, '', intervals))
+        rows.append([interval_count, before[0], after[0], before[1],
+                     after[1], '{:.2f}'.format(before[2]),
+                     '{:.2f}'.format(after[2])])
+
+    benchmark.print_table(
+        ['intervals', 'queries before', 'queries after',
+         'commits before', 'commits after', 'ms before', 'ms after'],
+        rows)
+
+    db.drop_all_tables()
+    db.close_database_connection()
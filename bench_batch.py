@@ -0,0 +1,74 @@
+"""
+Measures the latency of JSON-RPC batches of growing size, invoked one
+request after the other and concurrently on a thread pool.
+
+Run with: python bench_batch.py
+"""
+import json
+from multiprocessing.pool import ThreadPool
+import benchmark
+import database as d
+from crw_jsonrpc import CrwJsonRpc
+
+BATCH_SIZES = [1, 2, 4, 8, 16]
+CONCURRENCY = 8
+ROWERS = 25
+DAYS = 90
+
+# The requests of a rower (with id 2) and a coach (with id 1) opening
+# the app, repeated to fill a batch
+ROWER_METHODS = [
+    ('user_status', []),
+    ('my_team_info', []),
+    ('get_my_health_data', [7]),
+    ('get_my_training_data', [7]),
+]
+COACH_METHODS = [
+    ('user_status', []),
+    ('my_team_info', []),
+    ('get_team_health_data', [DAYS]),
+    ('get_team_training_data', [DAYS]),
+]
+
+
+def create_batch(methods, size, user_id, session_key):
+    return json.dumps([
+        {'jsonrpc': '2.0', 'id': i, 'method': methods[i % len(methods)][0],
+         'params': methods[i % len(methods)][1], 'session': session_key,
+         'user_id': user_id}
+        for i in range(size)])
+
+
+if __name__ == '__main__':
+    db = benchmark.connect(pool_size=CONCURRENCY + 1)
+    # The requests claim connections from the pool themselves, so this
+    # one has to be returned afterwards
+    with db.connection():
+        benchmark.populate_team(db, ROWERS, DAYS)
+        sdb = d.SessionDatabase(db)
+        sessions = [('rower', ROWER_METHODS, 2, sdb.generate_session_key(2)),
+                    ('coach', COACH_METHODS, 1, sdb.generate_session_key(1))]
+
+    sequential = CrwJsonRpc(db)
+    concurrent = CrwJsonRpc(db)
+    concurrent.batch_pool = ThreadPool(CONCURRENCY)
+    concurrent.batch_concurrency = CONCURRENCY
+
+    rows = []
+    for (user, methods, user_id, session_key) in sessions:
+        for size in BATCH_SIZES:
+            batch = create_batch(methods, size, user_id, session_key)
+            before = benchmark.timed(lambda: sequential.rpc_invoke(batch))
+            after = benchmark.timed(lambda: concurrent.rpc_invoke(batch))
+            rows.append([user, size,
+                         '{:.1f}'.format(benchmark.median(before) * 1000),
+                         '{:.1f}'.format(benchmark.median(after) * 1000)])
+
+    benchmark.print_table(
+        ['user', 'batch size', 'ms one by one',
+         'ms concurrent ({})'.format(CONCURRENCY)], rows)
+
+    concurrent.batch_pool.close()
+    with db.connection():
+        db.drop_all_tables()
+    db.close_database_connection()
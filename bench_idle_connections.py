@@ -0,0 +1,113 @@
+"""
+Measures the latency of requests while many idle keep-alive connections
+are open, with the threaded server (mode = threads) and the event loop
+(mode = events).
+
+The server runs in a child process with the benchmark database.
+
+Run with: python bench_idle_connections.py
+"""
+import httplib
+import multiprocessing
+import resource
+import socket
+import time
+import benchmark
+import event_server
+import http_server
+from crw_jsonrpc import CrwJsonRpc
+from static_files import AssetCache, RouteTable
+
+WORKERS = 8
+# The numbers of idle connections to measure with, per mode. Once there
+# are more idle connections than workers, the threaded server can't
+# handle any other request, so larger numbers only take longer
+IDLE_CONNECTIONS = [
+    ('threads', [0, 100]),
+    ('events', [0, 100, 1000, 5000]),
+]
+REQUESTS = 20
+# Seconds a request may take before it counts as failed
+REQUEST_TIMEOUT = 1
+
+
+def run_server(mode, ports):
+    """Serves requests until the process is terminated, after putting
+    the port it listens on in the ports queue."""
+    http_server.rpc = CrwJsonRpc(benchmark.connect(pool_size=WORKERS))
+    http_server.assets = AssetCache()
+    http_server.routes = RouteTable('static')
+    # Idle connections are kept open for the whole benchmark
+    http_server.FileServer.timeout = 60
+    http_server.FileServer.log_message = lambda self, *args: None
+    event_server.EventServer.timeout = 60
+    event_server.HttpChannel.log_request = lambda *args: None
+    if mode == 'threads':
+        server = http_server.create_server(('localhost', 0), WORKERS)
+        ports.put(server.server_address[1])
+        server.serve_forever()
+    else:
+        server = event_server.EventServer(WORKERS)
+        listener = server.listen(('localhost', 0), event_server.HttpChannel)
+        ports.put(listener.socket.getsockname()[1])
+        server.serve_forever()
+
+
+def open_idle_connections(port, count):
+    """Opens count connections which stay idle."""
+    return [socket.create_connection(('localhost', port))
+            for _ in range(count)]
+
+
+def measure(mode, idle):
+    """Returns (failed requests, median ms, 99th percentile ms) of
+    requests on new connections while `idle` connections are open."""
+    ports = multiprocessing.Queue()
+    server = multiprocessing.Process(target=run_server, args=(mode, ports))
+    server.start()
+    try:
+        port = ports.get(timeout=10)
+        idle_connections = open_idle_connections(port, idle)
+
+        latencies = []
+        failed = 0
+        for _ in range(REQUESTS):
+            start = time.time()
+            connection = httplib.HTTPConnection('localhost', port,
+                                                timeout=REQUEST_TIMEOUT)
+            try:
+                connection.request('GET', '/promo/LICENSE')
+                connection.getresponse().read()
+                latencies.append(time.time() - start)
+            except (socket.error, httplib.HTTPException):
+                failed += 1
+            connection.close()
+
+        for connection in idle_connections:
+            connection.close()
+    finally:
+        server.terminate()
+        server.join()
+
+    if not latencies:
+        return (failed, '-', '-')
+    return (failed,
+            '{:.2f}'.format(benchmark.median(latencies) * 1000),
+            '{:.2f}'.format(benchmark.percentile(latencies, 99) * 1000))
+
+
+if __name__ == '__main__':
+    # Both ends of every connection are in this benchmark
+    files = 2 * max(max(counts) for (_, counts) in IDLE_CONNECTIONS) + 1000
+    (soft, hard) = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if soft < files:
+        resource.setrlimit(resource.RLIMIT_NOFILE, (min(files, hard), hard))
+
+    rows = []
+    for (mode, counts) in IDLE_CONNECTIONS:
+        for idle in counts:
+            rows.append([mode, idle] + list(measure(mode, idle)))
+
+    benchmark.print_table(
+        ['mode', 'idle connections', 'failed requests', 'median ms',
+         'p99 ms'], rows)
@@ -0,0 +1,177 @@
+"""
+Loads a large synthetic history into the benchmark database and shows
+the query plans and execution times of the hot lookup queries before
+and after the migrations (and their indexes) are applied.
+
+Run with: python bench_indexes.py
+"""
+import datetime
+import benchmark
+
+TEAMS = 20
+ROWERS_PER_TEAM = 25
+DAYS = 365
+INTERVALS_PER_TRAINING = 4
+SESSIONS_PER_USER = 20
+
+USER_ID = ROWERS_PER_TEAM * TEAMS / 2
+TEAM_ID = TEAMS / 2
+
+# The queries of the hot paths in database.py, with parameters for a
+# user and team in the middle of the data
+QUERIES = [
+    ('verify_session_key',
+     """SELECT user_id FROM sessions
+     WHERE key = %s AND exp_date > %s AND user_id = %s;""",
+     ('key-{}-0'.format(USER_ID), datetime.datetime.now(), USER_ID)),
+    ('remove_expired_keys',
+     """SELECT key FROM sessions
+     WHERE user_id = %s AND exp_date < %s;""",
+     (USER_ID, datetime.datetime.now())),
+    ('remove_expired_sessions',
+     """SELECT key FROM sessions
+     WHERE exp_date < %s
+     LIMIT 1000;""",
+     (datetime.datetime.now(),)),
+    ('get_health_data',
+     """SELECT resting_heart_rate, weight, comment FROM health_data
+     WHERE user_id = %s AND date = %s;""",
+     (USER_ID, datetime.date.today())),
+    ('get_past_health_data',
+     """SELECT date, resting_heart_rate, weight, comment
+     FROM health_data
+     WHERE user_id = %s AND date >= %s
+     ORDER BY date ASC;""",
+     (USER_ID, datetime.date.today() - datetime.timedelta(days=7))),
+    ('get_past_training_data',
+     """SELECT id, time, type_is_ed, comment
+     FROM training_data
+     WHERE user_id = %s AND time >= %s
+     ORDER BY time ASC;""",
+     (USER_ID, datetime.datetime.now() - datetime.timedelta(days=7))),
+    ('get_training_interval_data',
+     """SELECT duration, power, pace, rest
+     FROM interval_data
+     WHERE training_id = %s;""",
+     (USER_ID * DAYS,)),
+    ('get_team_members',
+     """SELECT id, email, coach FROM users
+     WHERE team_id = %s;""",
+     (TEAM_ID,)),
+    ('get_team_training_data',
+     """SELECT users.id, training_data.id, interval_data.duration
+     FROM users
+     LEFT JOIN training_data
+     ON training_data.user_id = users.id AND training_data.time >= %s
+     LEFT JOIN interval_data
+     ON interval_data.training_id = training_data.id
+     WHERE users.team_id = %s AND users.coach IS NOT TRUE;""",
+     (datetime.datetime.now() - datetime.timedelta(days=7), TEAM_ID)),
+]
+
+
+def populate(db):
+    """Creates the tables without migrations and fills them with a
+    year of daily health data and trainings for every rower."""
+    benchmark.reset_database(db, migrate=False)
+
+    users = TEAMS * ROWERS_PER_TEAM
+    db.cursor.execute(
+        """INSERT INTO teams (id, name)
+        SELECT i, 'Team ' || i FROM generate_series(1, %s) AS i;""",
+        (TEAMS,))
+    db.cursor.execute(
+        """INSERT INTO users (id, email, password, team_id, coach)
+        SELECT i, 'rower' || i || '@crw.nl', '', (i - 1) / %s + 1,
+        (i - 1) %% %s = 0
+        FROM generate_series(1, %s) AS i;""",
+        (ROWERS_PER_TEAM, ROWERS_PER_TEAM, users))
+    db.cursor.execute(
+        """INSERT INTO sessions (key, user_id, exp_date)
+        SELECT 'key-' || user_id || '-' || i, user_id,
+        now() - i * INTERVAL '1 week'
+        FROM generate_series(1, %s) AS user_id,
+        generate_series(0, %s) AS i;""",
+        (users, SESSIONS_PER_USER - 1))
+    db.cursor.execute(
+        """INSERT INTO health_data
+        (user_id, date, resting_heart_rate, weight, comment)
+        SELECT user_id, current_date - day, 50 + day %% 10, 75, ''
+        FROM generate_series(1, %s) AS user_id,
+        generate_series(0, %s) AS day;""",
+        (users, DAYS - 1))
+    db.cursor.execute(
+        """INSERT INTO training_data (id, user_id, time, type_is_ed, comment)
+        SELECT (user_id - 1) * %s + day + 1, user_id,
+        date_trunc('day', now()) - day * INTERVAL '1 day', TRUE, ''
+        FROM generate_series(1, %s) AS user_id,
+        generate_series(0, %s) AS day;""",
+        (DAYS, users, DAYS - 1))
+    db.cursor.execute(
+        """INSERT INTO interval_data
+        (training_id, duration, power, pace, rest)
+        SELECT id, 300, 200 + i, 20, INTERVAL '1 minute'
+        FROM training_data, generate_series(1, %s) AS i;""",
+        (INTERVALS_PER_TRAINING,))
+    db.database_connection.commit()
+    analyze(db)
+
+
+def analyze(db):
+    """Updates the planner statistics of all tables."""
+    db.database_connection.autocommit = True
+    db.cursor.execute("""ANALYZE;""")
+    db.database_connection.autocommit = False
+
+
+def scan_types(plan):
+    """Returns the scan nodes of a JSON query plan, with the index or
+    table they scan."""
+    scans = []
+    if 'Scan' in plan['Node Type']:
+        scans.append('{} on {}'.format(
+            plan['Node Type'],
+            plan.get('Index Name', plan.get('Relation Name'))))
+    for subplan in plan.get('Plans', []):
+        scans += scan_types(subplan)
+    return scans
+
+
+def measure(db, query, parameters, repeat=5):
+    """Returns the scan nodes and the median execution time in
+    milliseconds of the query."""
+    execution_times = []
+    for _ in range(repeat):
+        db.cursor.execute('EXPLAIN (ANALYZE, FORMAT JSON) ' + query,
+                          parameters)
+        (explain,) = db.cursor.fetchone()
+        execution_times.append(explain[0]['Execution Time'])
+    db.database_connection.rollback()
+    return (scan_types(explain[0]['Plan']),
+            benchmark.median(execution_times))
+
+
+if __name__ == '__main__':
+    db = benchmark.connect()
+    print 'Loading synthetic history...'
+    populate(db)
+
+    before = [measure(db, query, parameters)
+              for (name, query, parameters) in QUERIES]
+    db.migrate()
+    analyze(db)
+    after = [measure(db, query, parameters)
+             for (name, query, parameters) in QUERIES]
+
+    rows = []
+    for ((name, query, parameters), (plan_before, ms_before),
+         (plan_after, ms_after)) in zip(QUERIES, before, after):
+        print '{}\n  before: {}\n  after:  {}'.format(
+            name, ', '.join(plan_before), ', '.join(plan_after))
+        rows.append([name, '{:.3f}'.format(ms_before),
+                     '{:.3f}'.format(ms_after)])
+    print
+    benchmark.print_table(['query', 'ms before', 'ms after'], rows)
+
+    db.drop_all_tables()
+    db.close_database_connection()
@@ -0,0 +1,104 @@
+"""
+Measures the size and the encode and decode durations of the team
+training data of a year, with dates and times encoded as objects and in
+the compact ISO 8601 format, and the duration of decoding requests with
+and without dates and times, before and after DateTimeDecoder.loads.
+
+Run with: python bench_json.py
+"""
+import datetime
+import json
+import benchmark
+from jsonrpc import DateTimeDecoder, DateTimeEncoder
+
+TEAM_SIZE = 25
+DAYS = 365
+INTERVALS_PER_TRAINING = 8
+# Number of times a request is decoded
+REQUESTS = 10000
+
+
+def old_dict_to_object(dict):
+    """How the objects of the DateTimeEncoder were decoded before."""
+    if '__type__' not in dict:
+        return dict
+
+    type = dict.pop('__type__')
+    if type == 'datetime':
+        return datetime.datetime(**dict)
+    elif type == 'timedelta':
+        return datetime.timedelta(seconds=dict['seconds'])
+    elif type == 'date':
+        return datetime.date(**dict)
+    else:
+        dict['__type__'] = type
+        return dict
+
+
+def old_loads(payload):
+    return json.loads(payload, object_hook=old_dict_to_object)
+
+
+def team_training_data():
+    """Returns the result of get_team_training_data for a team with a
+    training every day."""
+    today = datetime.datetime.now().replace(hour=8, minute=0, second=0,
+                                            microsecond=0)
+    return [('rower{}@crw.nl'.format(rower),
+             [(today - datetime.timedelta(days=day), day % 2 == 0, '',
+               [(300, 200 + i, 20, datetime.timedelta(minutes=1))
+                for i in range(INTERVALS_PER_TRAINING)])
+              for day in range(DAYS)])
+            for rower in range(TEAM_SIZE)]
+
+
+def milliseconds(function):
+    return '{:.0f}'.format(
+        benchmark.median(benchmark.timed(function, repeat=5)) * 1000)
+
+
+def microseconds(function):
+    def decode_requests():
+        for _ in range(REQUESTS):
+            function()
+    return '{:.1f}'.format(
+        benchmark.median(benchmark.timed(decode_requests, repeat=3)) *
+        1000000 / REQUESTS)
+
+
+if __name__ == '__main__':
+    response = {'jsonrpc': '2.0', 'id': 1, 'result': team_training_data()}
+    objects = json.dumps(response, cls=DateTimeEncoder)
+    iso = json.dumps(response, cls=DateTimeEncoder, compact=True)
+
+    benchmark.print_table(
+        ['response', 'MB', 'encode ms', 'decode ms'],
+        [['objects, old decoder',
+          '{:.1f}'.format(len(objects) / 1024.0 / 1024), '-',
+          milliseconds(lambda: old_loads(objects))],
+         ['objects', '{:.1f}'.format(len(objects) / 1024.0 / 1024),
+          milliseconds(lambda: json.dumps(response, cls=DateTimeEncoder)),
+          milliseconds(lambda: DateTimeDecoder.loads(objects))],
+         ['iso', '{:.1f}'.format(len(iso) / 1024.0 / 1024),
+          milliseconds(lambda: json.dumps(response, cls=DateTimeEncoder,
+                                          compact=True)),
+          # The client knows which strings are dates
+          milliseconds(lambda: json.loads(iso))]])
+    print
+
+    add_training = json.dumps(
+        {'jsonrpc': '2.0', 'id': 1, 'session': 'x' * 32, 'user_id': 2,
+         'method': 'add_training',
+         'params': [datetime.datetime.now(), True, '',
+                    [(300, 200, 20, datetime.timedelta(minutes=1))] *
+                    INTERVALS_PER_TRAINING]},
+        cls=DateTimeEncoder)
+    get_data = json.dumps(
+        {'jsonrpc': '2.0', 'id': 1, 'session': 'x' * 32, 'user_id': 2,
+         'method': 'get_team_training_data', 'params': [DAYS]})
+    benchmark.print_table(
+        ['request', 'us before', 'us after'],
+        [['get_team_training_data', microseconds(lambda: old_loads(get_data)),
+          microseconds(lambda: DateTimeDecoder.loads(get_data))],
+         ['add_training', microseconds(lambda: old_loads(add_training)),
+          microseconds(lambda: DateTimeDecoder.loads(add_training))]])
@@ -0,0 +1,132 @@
+"""
+Measures the throughput and latency of static file and JSON-RPC
+requests over HTTP and HTTPS, with persistent connections (keep-alive)
+and with a new connection for every request.
+
+The server runs in a child process with the benchmark database. For
+HTTPS a self-signed certificate is created with the openssl command.
+
+Run with: python bench_keepalive.py
+"""
+import httplib
+import json
+import multiprocessing
+import shutil
+import ssl
+import tempfile
+import time
+from multiprocessing.pool import ThreadPool
+import benchmark
+import crw
+import http_server
+from crw_jsonrpc import CrwJsonRpc
+from static_files import AssetCache, RouteTable
+
+WORKERS = 8
+CLIENTS = 8
+REQUESTS_PER_CLIENT = 250
+
+# The requests every client repeats, a page with its stylesheets and a
+# call to the JSON-RPC API
+REQUESTS = [
+    ('GET', '/promo/index.html', None),
+    ('GET', '/promo/css/landing-page.css', None),
+    ('GET', '/promo/css/bootstrap.min.css', None),
+    ('POST', '/rpc', json.dumps(
+        {'jsonrpc': '2.0', 'id': 1, 'method': 'echo', 'params': ['crw']})),
+]
+
+
+def run_server(ports, max_requests, certfile, keyfile):
+    """Serves requests until the process is terminated, after putting
+    the port it listens on in the ports queue."""
+    http_server.rpc = CrwJsonRpc(benchmark.connect(pool_size=WORKERS))
+    http_server.assets = AssetCache()
+    http_server.routes = RouteTable('static')
+    http_server.FileServer.max_requests = max_requests
+    http_server.FileServer.log_message = lambda self, *args: None
+    ssl_context = None
+    if certfile is not None:
+        ssl_context = http_server.create_ssl_context(
+            certfile, keyfile, crw.HTTPS_CIPHERS)
+    server = http_server.create_server(('localhost', 0), WORKERS,
+                                       ssl_context)
+    ports.put(server.server_address[1])
+    server.serve_forever()
+
+
+def connect(port, https):
+    if https:
+        return httplib.HTTPSConnection(
+            'localhost', port, context=ssl._create_unverified_context())
+    return httplib.HTTPConnection('localhost', port)
+
+
+def client(port, https, keepalive):
+    """Sends REQUESTS_PER_CLIENT requests and returns the latency of every
+    request in seconds, including opening a connection when needed."""
+    latencies = []
+    connection = None
+    for i in range(REQUESTS_PER_CLIENT):
+        (method, path, body) = REQUESTS[i % len(REQUESTS)]
+        start = time.time()
+        if connection is None:
+            connection = connect(port, https)
+        connection.request(method, path, body)
+        connection.getresponse().read()
+        if not keepalive:
+            connection.close()
+            connection = None
+        latencies.append(time.time() - start)
+    if connection is not None:
+        connection.close()
+    return latencies
+
+
+def measure(https, keepalive, certfile, keyfile):
+    """Returns (requests per second, median ms, 99th percentile ms) of
+    all clients sending their requests at the same time."""
+    ports = multiprocessing.Queue()
+    server = multiprocessing.Process(
+        target=run_server,
+        args=(ports, REQUESTS_PER_CLIENT if keepalive else 1,
+              certfile if https else None, keyfile if https else None))
+    server.start()
+    try:
+        port = ports.get(timeout=10)
+        # Warm up the asset cache
+        client(port, https, keepalive)
+
+        pool = ThreadPool(CLIENTS)
+        start = time.time()
+        results = pool.map(lambda _: client(port, https, keepalive),
+                           range(CLIENTS))
+        duration = time.time() - start
+        pool.close()
+    finally:
+        server.terminate()
+        server.join()
+
+    latencies = [latency for result in results for latency in result]
+    return (int(len(latencies) / duration),
+            '{:.2f}'.format(benchmark.median(latencies) * 1000),
+            '{:.2f}'.format(benchmark.percentile(latencies, 99) * 1000))
+
+
+if __name__ == '__main__':
+    directory = tempfile.mkdtemp()
+    try:
+        (certfile, keyfile) = benchmark.create_certificate(directory)
+        rows = []
+        for https in [False, True]:
+            for keepalive in [True, False]:
+                rows.append(['HTTPS' if https else 'HTTP',
+                             'on' if keepalive else 'off'] +
+                            list(measure(https, keepalive,
+                                         certfile, keyfile)))
+    finally:
+        shutil.rmtree(directory)
+
+    benchmark.print_table(
+        ['protocol', 'keep-alive', 'requests/s', 'median ms', 'p99 ms'],
+        rows)
@@ -0,0 +1,179 @@
+"""
+Measures the latency of legitimate logins and other JSON-RPC requests
+(echo) while attackers guess the password of a user, with and without
+the login throttles.
+
+The server runs in a child process with the benchmark database and the
+throttle settings of crw.cfg, verifying passwords in the threads
+handling the requests. The attackers connect from 127.0.0.2, the
+legitimate clients from 127.0.0.1, so this only runs on Linux.
+
+Run with: python bench_login_attack.py
+"""
+import httplib
+import json
+import multiprocessing
+import threading
+import time
+import benchmark
+import crw
+import database
+import http_server
+import passwords
+from crw_jsonrpc import CrwJsonRpc
+from login_throttle import LoginThrottle
+
+WORKERS = 16
+ATTACKERS = 8
+# Login attempts per second of all attackers together. Their clients run
+# on the same cores as the server here, so they don't simply guess as
+# fast as refusals come back
+ATTACK_RATE = 100
+RPC_CLIENTS = 2
+# Seconds between the logins of the legitimate client
+LOGIN_INTERVAL = 0.5
+DURATION = 10
+USERS = ['rower{}@crw.nl'.format(i) for i in range(10)]
+PASSWORD = 'password'
+VICTIM = USERS[0]
+# (name, attack, throttled) of the measurements
+RUNS = [
+    ('no attack', False, True),
+    ('attack, not throttled', True, False),
+    ('attack, throttled', True, True),
+]
+
+ECHO = json.dumps({'jsonrpc': '2.0', 'id': 1, 'method': 'echo',
+                   'params': ['crw']})
+
+
+def login_request(email, password):
+    return json.dumps({'jsonrpc': '2.0', 'id': 1, 'method': 'login',
+                       'params': [email, password]})
+
+
+def run_server(ports, throttled):
+    """Serves requests until the process is terminated, after putting
+    the port it listens on in the ports queue."""
+    rpc = CrwJsonRpc(benchmark.connect(pool_size=WORKERS))
+    if throttled:
+        rpc.email_throttle = LoginThrottle(
+            crw.LOGIN_EMAIL_BURST, crw.LOGIN_EMAIL_RATE / 60,
+            crw.LOGIN_BACKOFF, crw.LOGIN_MAX_BACKOFF)
+        rpc.address_throttle = LoginThrottle(
+            crw.LOGIN_ADDRESS_BURST, crw.LOGIN_ADDRESS_RATE / 60,
+            crw.LOGIN_BACKOFF, crw.LOGIN_MAX_BACKOFF)
+    http_server.rpc = rpc
+    http_server.FileServer.log_message = lambda self, *args: None
+    server = http_server.create_server(('localhost', 0), WORKERS)
+    ports.put(server.server_address[1])
+    server.serve_forever()
+
+
+def post(connection, request):
+    """Returns (seconds, response) of the request."""
+    start = time.time()
+    connection.request('POST', '/rpc', request)
+    response = json.loads(connection.getresponse().read())
+    return (time.time() - start, response)
+
+
+def attacker(port, stop, results):
+    """Guesses passwords at ATTACK_RATE / ATTACKERS attempts per second,
+    or as fast as the server answers if that's slower, until stop is
+    set, and appends the error code of every attempt to results."""
+    connection = httplib.HTTPConnection(
+        'localhost', port, source_address=('127.0.0.2', 0))
+    interval = float(ATTACKERS) / ATTACK_RATE
+    guess = 0
+    next_attempt = time.time()
+    while not stop.wait(max(next_attempt - time.time(), 0)):
+        next_attempt = max(next_attempt + interval, time.time())
+        (_, response) = post(connection,
+                             login_request(VICTIM, str(guess)))
+        results.append(response['error']['code'])
+        guess += 1
+    connection.close()
+
+
+def user(port, stop, latencies):
+    """Logs in as the other users in turn every LOGIN_INTERVAL seconds
+    until stop is set, and appends the latency of every login."""
+    connection = httplib.HTTPConnection('localhost', port)
+    i = 0
+    while not stop.wait(LOGIN_INTERVAL):
+        email = USERS[1 + i % (len(USERS) - 1)]
+        (latency, response) = post(connection,
+                                   login_request(email, PASSWORD))
+        assert 'result' in response, response
+        latencies.append(latency)
+        i += 1
+    connection.close()
+
+
+def echo(port, stop, latencies):
+    connection = httplib.HTTPConnection('localhost', port)
+    while not stop.is_set():
+        latencies.append(post(connection, ECHO)[0])
+    connection.close()
+
+
+def measure(attack, throttled):
+    """Returns (attempts per second, passwords checked per second of the
+    attackers, login median ms and 99th percentile ms, echo median ms
+    and 99th percentile ms)."""
+    ports = multiprocessing.Queue()
+    server = multiprocessing.Process(target=run_server,
+                                     args=(ports, throttled))
+    server.start()
+    try:
+        port = ports.get(timeout=10)
+        stop = threading.Event()
+        (attempts, logins, echoes) = ([], [], [])
+        threads = [threading.Thread(target=user,
+                                    args=(port, stop, logins))]
+        threads += [threading.Thread(target=echo, args=(port, stop, echoes))
+                    for _ in range(RPC_CLIENTS)]
+        if attack:
+            threads += [threading.Thread(target=attacker,
+                                         args=(port, stop, attempts))
+                        for _ in range(ATTACKERS)]
+        for thread in threads:
+            thread.start()
+        time.sleep(DURATION)
+        stop.set()
+        for thread in threads:
+            thread.join()
+    finally:
+        server.terminate()
+        server.join()
+
+    # Refused attempts get error 13, checked ones invalid credentials
+    checked = sum(1 for code in attempts if code == 2)
+    return (int(len(attempts) / float(DURATION)),
+            '{:.1f}'.format(checked / float(DURATION)),
+            '{:.1f}'.format(benchmark.median(logins) * 1000),
+            '{:.1f}'.format(benchmark.percentile(logins, 99) * 1000),
+            '{:.2f}'.format(benchmark.median(echoes) * 1000),
+            '{:.2f}'.format(benchmark.percentile(echoes, 99) * 1000))
+
+
+if __name__ == '__main__':
+    # Before the server processes are forked
+    passwords.configure(crw.PASSWORD_ROUNDS)
+    db = benchmark.connect()
+    benchmark.reset_database(db)
+    udb = database.UserDatabase(db)
+    for email in USERS:
+        udb.add_user(email, PASSWORD)
+
+    rows = []
+    for (name, attack, throttled) in RUNS:
+        rows.append([name] + list(measure(attack, throttled)))
+
+    benchmark.print_table(
+        ['', 'attempts/s', 'checked/s', 'login median ms', 'login p99 ms',
+         'echo median ms', 'echo p99 ms'], rows)
+
+    db.drop_all_tables()
+    db.close_database_connection()
@@ -0,0 +1,137 @@
+"""
+Measures a storm of logins: the logins per second, and the latency of
+the other JSON-RPC requests (echo) made meanwhile, with the passwords
+verified in the threads handling the requests and on a PasswordPool.
+
+The server runs in a child process with the benchmark database and
+the worker threads, database pool size and password pool limit of
+crw.cfg. While LOGIN_CLIENTS clients log in over and over for DURATION
+seconds, RPC_CLIENTS other clients call echo. Every request is made on
+a new connection, so no worker waits for the next request of a client.
+
+Run with: python bench_login_storm.py
+"""
+import httplib
+import json
+import multiprocessing
+import threading
+import time
+import benchmark
+import crw
+import database
+import http_server
+import passwords
+from crw_jsonrpc import CrwJsonRpc
+from passwords import PasswordPool
+
+LOGIN_CLIENTS = 8
+RPC_CLIENTS = 4
+DURATION = 5
+EMAIL = 'rower@crw.nl'
+PASSWORD = 'password'
+# (name, password processes, whether logins are made) of the servers
+SERVERS = [
+    ('no logins', 0, False),
+    ('in request threads', 0, True),
+    ('1 password process', 1, True),
+    ('2 password processes', 2, True),
+    ('4 password processes', 4, True),
+]
+
+LOGIN = json.dumps({'jsonrpc': '2.0', 'id': 1, 'method': 'login',
+                    'params': [EMAIL, PASSWORD]})
+ECHO = json.dumps({'jsonrpc': '2.0', 'id': 1, 'method': 'echo',
+                   'params': ['crw']})
+
+
+def run_server(ports, processes):
+    """Serves requests until the process is terminated, after putting
+    the port it listens on in the ports queue."""
+    # Forked before the database connections are opened
+    password_pool = None
+    if processes > 0:
+        password_pool = PasswordPool(processes, crw.PASSWORD_MAX_PENDING)
+    db = benchmark.connect(pool_size=crw.DATABASE_POOL_SIZE)
+    db.password_pool = password_pool
+    http_server.rpc = CrwJsonRpc(db)
+    http_server.FileServer.log_message = lambda self, *args: None
+    server = http_server.create_server(('localhost', 0),
+                                       crw.SERVER_WORKERS)
+    ports.put(server.server_address[1])
+    server.serve_forever()
+
+
+def client(port, request, stop):
+    """Sends the request until stop is set and returns the latency of
+    every request in seconds, and the number of error responses."""
+    latencies = []
+    errors = 0
+    while not stop.is_set():
+        start = time.time()
+        connection = httplib.HTTPConnection('localhost', port)
+        connection.request('POST', '/rpc', request,
+                           {'Connection': 'close'})
+        response = json.loads(connection.getresponse().read())
+        connection.close()
+        latencies.append(time.time() - start)
+        if 'error' in response:
+            errors += 1
+    return (latencies, errors)
+
+
+def measure(processes, logins):
+    """Returns (logins per second, rejected logins, echo median ms, echo
+    99th percentile ms)."""
+    ports = multiprocessing.Queue()
+    server = multiprocessing.Process(target=run_server,
+                                     args=(ports, processes))
+    server.start()
+    try:
+        port = ports.get(timeout=10)
+        stop = threading.Event()
+        clients = ([LOGIN] * LOGIN_CLIENTS if logins else []) + \
+            [ECHO] * RPC_CLIENTS
+        results = [None] * len(clients)
+
+        def run(i):
+            results[i] = client(port, clients[i], stop)
+        threads = [threading.Thread(target=run, args=(i,))
+                   for i in range(len(clients))]
+        for thread in threads:
+            thread.start()
+        time.sleep(DURATION)
+        stop.set()
+        for thread in threads:
+            thread.join()
+    finally:
+        server.terminate()
+        server.join()
+
+    login_results = results[:-RPC_CLIENTS]
+    echoes = [latency for (latencies, _) in results[-RPC_CLIENTS:]
+              for latency in latencies]
+    accepted = sum(len(latencies) - errors
+                   for (latencies, errors) in login_results)
+    rejected = sum(errors for (_, errors) in login_results)
+    return ('{:.1f}'.format(accepted / float(DURATION)), rejected,
+            '{:.2f}'.format(benchmark.median(echoes) * 1000),
+            '{:.2f}'.format(benchmark.percentile(echoes, 99) * 1000))
+
+
+if __name__ == '__main__':
+    # Before the server processes are forked
+    passwords.configure(crw.PASSWORD_ROUNDS)
+    db = benchmark.connect()
+    benchmark.reset_database(db)
+    database.UserDatabase(db).add_user(EMAIL, PASSWORD)
+
+    rows = []
+    for (name, processes, logins) in SERVERS:
+        rows.append([name] + list(measure(processes, logins)))
+
+    benchmark.print_table(
+        ['passwords verified', 'logins/s', 'rejected logins',
+         'echo median ms', 'echo p99 ms'], rows)
+
+    db.drop_all_tables()
+    db.close_database_connection()
@@ -0,0 +1,130 @@
+"""
+Measures the number of redirects per second of the HTTPS redirector
+under a flood of clients, and the file descriptors the redirector holds
+while flooded and after its timeouts passed.
+
+The redirector runs in a child process, its file descriptors are
+counted in /proc, so this only runs on Linux.
+
+Run with: python bench_redirector.py
+"""
+import httplib
+import multiprocessing
+import os
+import resource
+import socket
+import threading
+import time
+from multiprocessing.pool import ThreadPool
+import benchmark
+import event_server
+import http_redirector
+
+CLIENTS = 50
+REDIRECTS_PER_CLIENT = 100
+# Seconds a connection may stay idle, and take to send a request
+TIMEOUT = 2
+# (name, idle connections, keep-alive) of the floods to measure with
+FLOODS = [
+    ('new connection per redirect', 0, False),
+    ('keep-alive', 0, True),
+    ('1000 idle connections', 1000, False),
+    ('5000 idle connections', 5000, False),
+]
+
+
+def run_server(ports):
+    """Redirects requests until the process is terminated, after putting
+    the port it listens on in the ports queue."""
+    server = event_server.EventServer(0)
+    server.timeout = TIMEOUT
+    server.request_timeout = TIMEOUT
+    server.max_requests = REDIRECTS_PER_CLIENT
+    http_redirector.RedirectChannel.log_request = lambda *args: None
+    listener = server.listen(('localhost', 0),
+                             http_redirector.RedirectChannel)
+    ports.put(listener.socket.getsockname()[1])
+    server.serve_forever()
+
+
+def open_files(pid):
+    return len(os.listdir('/proc/{}/fd'.format(pid)))
+
+
+class PeakOpenFiles(threading.Thread):
+    """Samples the number of open files of a process until stopped, and
+    keeps the highest in `peak`."""
+    def __init__(self, pid):
+        threading.Thread.__init__(self)
+        self.pid = pid
+        self.peak = 0
+        self.stopped = threading.Event()
+
+    def run(self):
+        while not self.stopped.wait(0.05):
+            self.peak = max(self.peak, open_files(self.pid))
+
+
+def client(port, keepalive):
+    """Requests REDIRECTS_PER_CLIENT redirects."""
+    connection = None
+    for _ in range(REDIRECTS_PER_CLIENT):
+        if connection is None:
+            connection = httplib.HTTPConnection('localhost', port)
+        connection.request('GET', '/promo/index.html')
+        connection.getresponse().read()
+        if not keepalive:
+            connection.close()
+            connection = None
+    if connection is not None:
+        connection.close()
+
+
+def measure(idle, keepalive):
+    """Returns (redirects per second, most open files of the server
+    during the flood, open files after the timeouts)."""
+    ports = multiprocessing.Queue()
+    server = multiprocessing.Process(target=run_server, args=(ports,))
+    server.start()
+    try:
+        port = ports.get(timeout=10)
+        sampler = PeakOpenFiles(server.pid)
+        sampler.start()
+        # Clients that connect and never send a request
+        idle_connections = [socket.create_connection(('localhost', port))
+                            for _ in range(idle)]
+
+        pool = ThreadPool(CLIENTS)
+        start = time.time()
+        pool.map(lambda _: client(port, keepalive), range(CLIENTS))
+        duration = time.time() - start
+        pool.close()
+        sampler.stopped.set()
+        sampler.join()
+
+        time.sleep(TIMEOUT + 1.5)
+        after = open_files(server.pid)
+        for connection in idle_connections:
+            connection.close()
+    finally:
+        server.terminate()
+        server.join()
+
+    return (int(CLIENTS * REDIRECTS_PER_CLIENT / duration), sampler.peak,
+            after)
+
+
+if __name__ == '__main__':
+    # Both ends of the idle connections are in this benchmark
+    files = 2 * max(idle for (_, idle, _) in FLOODS) + 1000
+    (soft, hard) = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if soft < files:
+        resource.setrlimit(resource.RLIMIT_NOFILE, (min(files, hard), hard))
+
+    rows = []
+    for (name, idle, keepalive) in FLOODS:
+        rows.append([name] + list(measure(idle, keepalive)))
+
+    benchmark.print_table(
+        ['flood', 'redirects/s', 'peak open files',
+         'open files after timeout'], rows)
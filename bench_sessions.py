@@ -0,0 +1,56 @@
+"""
+Measures the cost of authenticating a JSON-RPC request with each
+session backend: the database queries per request and the duration of
+invoking an authenticated echo request, whose call doesn't use the
+database itself.
+
+Run with: python bench_sessions.py
+"""
+import json
+import benchmark
+import database as d
+from crw_jsonrpc import CrwJsonRpc
+from session_cache import SessionCache
+
+REQUESTS = 2000
+# (name, function returning the session backend for a database)
+BACKENDS = [
+    ('table', lambda db: d.SessionDatabase(db)),
+    ('table with cache', lambda db: d.SessionDatabase(db, SessionCache())),
+    ('signed', lambda db: d.SignedSessionDatabase(db, 'benchmark')),
+]
+
+
+def measure(db, sessions):
+    """Returns (queries per request, microseconds per request)."""
+    rpc = CrwJsonRpc(db, sessions=sessions)
+    request = json.dumps({'jsonrpc': '2.0', 'id': 1, 'method': 'echo',
+                          'params': ['crw'], 'user_id': 2,
+                          'session': sessions.generate_session_key(2)})
+    db.database_connection.commit()
+    # Fills the cache
+    rpc.rpc_invoke(request)
+
+    def invoke_requests():
+        for _ in range(REQUESTS):
+            rpc.rpc_invoke(request)
+    queries = db.queries
+    duration = benchmark.median(benchmark.timed(invoke_requests, repeat=3))
+    queries = (db.queries - queries) / 3.0 / REQUESTS
+    return ('{:.1f}'.format(queries),
+            '{:.0f}'.format(duration * 1000000 / REQUESTS))
+
+
+if __name__ == '__main__':
+    db = benchmark.connect(database_class=benchmark.CountingDatabase)
+    benchmark.populate_team(db, 1, 1)
+
+    rows = []
+    for (name, backend) in BACKENDS:
+        rows.append([name] + list(measure(db, backend(db))))
+
+    benchmark.print_table(['sessions', 'queries/request', 'us/request'],
+                          rows)
+
+    db.drop_all_tables()
+    db.close_database_connection()
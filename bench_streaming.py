@@ -0,0 +1,78 @@
+"""
+Compares the peak memory and duration of answering a coach's
+get_team_training_data request, between encoding the whole response at
+once (rpc_invoke) and streaming it (rpc_invoke_stream), which reads the
+rows from a server side cursor while the response is encoded.
+
+Every request is made in a new child process, whose peak resident set
+size is compared with the one before the request.
+
+Run with: python bench_streaming.py
+"""
+import json
+import multiprocessing
+import resource
+import time
+import benchmark
+import database as d
+from crw_jsonrpc import CrwJsonRpc
+
+TEAM_SIZE = 25
+DAYS = [30, 90, 365]
+INTERVALS_PER_TRAINING = 8
+
+
+def invoke(streamed, days, results):
+    """Makes the request and puts (response bytes, peak memory increase
+    in kilobytes, seconds) in the results queue."""
+    db = benchmark.connect()
+    rpc = CrwJsonRpc(db)
+    key = d.SessionDatabase(db).generate_session_key(1)
+    request = json.dumps({'jsonrpc': '2.0', 'id': 1, 'session': key,
+                          'user_id': 1, 'method': 'get_team_training_data',
+                          'params': [days]})
+
+    before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    start = time.time()
+    size = 0
+    if streamed:
+        # The chunks would be written to the socket one by one
+        for chunk in rpc.rpc_invoke_stream(request):
+            size += len(chunk)
+    else:
+        size = len(rpc.rpc_invoke(request))
+    duration = time.time() - start
+    after = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+    db.close_database_connection()
+    results.put((size, after - before, duration))
+
+
+def measure(streamed, days):
+    results = multiprocessing.Queue()
+    process = multiprocessing.Process(target=invoke,
+                                      args=(streamed, days, results))
+    process.start()
+    result = results.get()
+    process.join()
+    return result
+
+
+if __name__ == '__main__':
+    db = benchmark.connect()
+    rows = []
+    for days in DAYS:
+        benchmark.populate_team(db, TEAM_SIZE, days, INTERVALS_PER_TRAINING)
+        (size, buffered_kb, buffered_s) = measure(False, days)
+        (_, streamed_kb, streamed_s) = measure(True, days)
+        rows.append([days, '{:.1f}'.format(size / 1024.0 / 1024),
+                     '{:.1f}'.format(buffered_kb / 1024.0),
+                     '{:.1f}'.format(streamed_kb / 1024.0),
+                     int(buffered_s * 1000), int(streamed_s * 1000)])
+
+    benchmark.print_table(
+        ['days', 'response MB', 'peak MB buffered', 'peak MB streamed',
+         'ms buffered', 'ms streamed'], rows)
+
+    db.drop_all_tables()
+    db.close_database_connection()
@@ -0,0 +1,71 @@
+"""
+Compares the number of queries and the latency of fetching the training
+data of a whole team, between the per member and per training queries
+get_team_training_data used to do and the single query of
+TrainingDatabase.get_team_training_data.
+
+Run with: python bench_team_training.py
+"""
+import datetime
+import benchmark
+import database as d
+
+TEAM_SIZES = [5, 25, 50]
+DAYS = [7, 30, 90]
+INTERVALS_PER_TRAINING = 4
+
+
+def per_member_training_data(db, team_id, time):
+    """The way the team training data was fetched before, one query per
+    member and two per training."""
+    tdb = d.TeamDatabase(db)
+    trdb = d.TrainingDatabase(db)
+    idb = d.IntervalDatabase(db)
+
+    team_training_data = []
+    for (user_id, email, coach) in tdb.get_team_members(team_id):
+        if coach:
+            continue
+        member_training_data = []
+        for (training_id, training_time, type_is_ed, comment)\
+                in trdb.get_past_training_data(user_id, time):
+            member_training_data.append(
+                (training_time, type_is_ed, comment,
+                 idb.get_training_interval_data(training_id)))
+        team_training_data.append((email, member_training_data))
+    return team_training_data
+
+
+def measure(db, function):
+    """Returns (queries, median milliseconds) of calling function."""
+    db.queries = 0
+    function()
+    queries = db.queries
+    durations = benchmark.timed(function, repeat=3)
+    return (queries, int(benchmark.median(durations) * 1000))
+
+
+if __name__ == '__main__':
+    db = benchmark.connect(database_class=benchmark.CountingDatabase)
+    trdb = d.TrainingDatabase(db)
+    rows = []
+
+    for team_size in TEAM_SIZES:
+        for days in DAYS:
+            benchmark.populate_team(db, team_size, days,
+                                    INTERVALS_PER_TRAINING)
+            time = datetime.timedelta(days=days)
+
+            (old_queries, old_ms) = measure(
+                db, lambda: per_member_training_data(db, 1, time))
+            (new_queries, new_ms) = measure(
+                db, lambda: trdb.get_team_training_data(1, time))
+            rows.append([team_size, days, old_queries, new_queries,
+                         old_ms, new_ms])
+
+    benchmark.print_table(
+        ['rowers', 'days', 'queries before', 'queries after',
+         'ms before', 'ms after'], rows)
+
+    db.drop_all_tables()
+    db.close_database_connection()
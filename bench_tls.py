@@ -0,0 +1,79 @@
+"""
+Measures the number of connections per second (each fetching a small
+file) the HTTPS server handles with a full TLS handshake and with a
+resumed session, with openssl s_time as the client.
+
+Run with: python bench_tls.py
+"""
+import re
+import shutil
+import subprocess
+import tempfile
+import threading
+import benchmark
+import crw
+import http_server
+from static_files import AssetCache, RouteTable
+
+WORKERS = 8
+SECONDS = 5
+# The file every connection requests
+PATH = '/promo/LICENSE'
+
+# (name, s_time option, session tickets enabled on the server) of the
+# TLS versions and ways to resume a session
+PROTOCOLS = [
+    ('TLS 1.2, session ID', '-tls1_2', False),
+    ('TLS 1.2, session ticket', '-tls1_2', True),
+    ('TLS 1.3, session ticket', '-tls1_3', True),
+]
+
+
+def s_time(port, protocol, mode):
+    """Runs openssl s_time against the server for SECONDS seconds and
+    returns the number of connections per second it made."""
+    output = subprocess.check_output(
+        ['openssl', 's_time', '-connect', 'localhost:{}'.format(port),
+         '-www', PATH, mode, protocol, '-time', str(SECONDS)],
+        stderr=subprocess.STDOUT)
+    match = re.search(r'(\d+) connections in (\d+) real seconds', output)
+    return int(match.group(1)) / int(match.group(2))
+
+
+def start_server(ssl_context):
+    """Starts an HTTPS server in a thread and returns it."""
+    server = http_server.create_server(('localhost', 0), WORKERS,
+                                       ssl_context)
+    # s_time resets connections, which would print tracebacks
+    server.handle_error = lambda request, client_address: None
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    return server
+
+
+if __name__ == '__main__':
+    http_server.assets = AssetCache()
+    http_server.routes = RouteTable('static')
+    http_server.FileServer.log_message = lambda self, *args: None
+    directory = tempfile.mkdtemp()
+    try:
+        (certfile, keyfile) = benchmark.create_certificate(directory)
+        rows = []
+        for (name, protocol, session_tickets) in PROTOCOLS:
+            ssl_context = http_server.create_ssl_context(
+                certfile, keyfile, crw.HTTPS_CIPHERS, session_tickets)
+            server = start_server(ssl_context)
+            port = server.server_address[1]
+            full = s_time(port, protocol, '-new')
+            resumed = s_time(port, protocol, '-reuse')
+            server.shutdown()
+            server.server_close()
+            rows.append([name, full, resumed,
+                         ssl_context.session_stats()['hits']])
+    finally:
+        shutil.rmtree(directory)
+
+    benchmark.print_table(
+        ['protocol', 'full handshakes/s', 'resumed handshakes/s',
+         'session cache hits'], rows)
@@ -0,0 +1,166 @@
+"""
+Helpers shared by the bench_*.py benchmark scripts.
+
+The benchmarks run against their own database, named crwbenchmark
+unless the CRW_BENCHMARK_DATABASE environment variable says otherwise,
+which has to be created beforehand with the credentials in crw.cfg.
+All of its tables are dropped and recreated by the benchmarks.
+"""
+import os
+import subprocess
+import time
+import psycopg2
+from crw import \
+    DATABASE_HOST, DATABASE_PORT, DATABASE_USER, DATABASE_PASS
+import database
+
+DATABASE = os.environ.get('CRW_BENCHMARK_DATABASE', 'crwbenchmark')
+
+
+class CountingCursor(object):
+    """Wraps a cursor to count the statements executed with it."""
+    def __init__(self, cursor, counter):
+        self.wrapped_cursor = cursor
+        self.counter = counter
+
+    def execute(self, *args, **kwargs):
+        self.counter.queries += 1
+        return self.wrapped_cursor.execute(*args, **kwargs)
+
+    def __iter__(self):
+        return iter(self.wrapped_cursor)
+
+    def __getattr__(self, name):
+        return getattr(self.wrapped_cursor, name)
+
+
+class CountingConnection(object):
+    """Wraps a connection to count its commits."""
+    def __init__(self, connection, counter):
+        self.wrapped_connection = connection
+        self.counter = counter
+
+    def commit(self):
+        self.counter.commits += 1
+        return self.wrapped_connection.commit()
+
+    def __getattr__(self, name):
+        return getattr(self.wrapped_connection, name)
+
+
+class CountingDatabase(database.Database):
+    """Database that counts the statements executed through its
+    cursor in `queries` and the commits of its connection in
+    `commits`."""
+    queries = 0
+    commits = 0
+
+    @property
+    def database_connection(self):
+        return CountingConnection(
+            database.Database.database_connection.fget(self), self)
+
+    @property
+    def cursor(self):
+        return CountingCursor(database.Database.cursor.fget(self), self)
+
+
+def connect(pool_size=1, database_class=database.Database):
+    """Opens the benchmark database."""
+    return database_class(DATABASE_HOST, DATABASE_PORT, DATABASE,
+                          DATABASE_USER, DATABASE_PASS, pool_size)
+
+
+def reset_database(db, migrate=True):
+    """Drops all tables of the benchmark database, if they exist, and
+    creates them again."""
+    try:
+        db.drop_all_tables()
+    except psycopg2.ProgrammingError:
+        db.database_connection.rollback()
+    db.init_database(migrate)
+
+
+def populate_team(db, team_size, days, intervals_per_training=4):
+    """Resets the database and creates a team (with id 1) with one
+    coach (with id 1) and `team_size` rowers, who all have health data
+    and one training with intervals on every day of the last `days`
+    days."""
+    reset_database(db)
+    db.cursor.execute(
+        """INSERT INTO teams (id, name) VALUES (1, 'Benchmark');""")
+    db.cursor.execute(
+        """INSERT INTO users (id, email, password, team_id, coach)
+        SELECT i, 'rower' || i || '@crw.nl', '', 1, i = 1
+        FROM generate_series(1, %s) AS i;""", (team_size + 1,))
+    db.cursor.execute(
+        """INSERT INTO health_data
+        (user_id, date, resting_heart_rate, weight, comment)
+        SELECT user_id, current_date - day, 50 + day %% 10, 75, ''
+        FROM generate_series(2, %s) AS user_id,
+        generate_series(0, %s) AS day;""", (team_size + 1, days - 1))
+    db.cursor.execute(
+        """INSERT INTO training_data (id, user_id, time, type_is_ed, comment)
+        SELECT row_number() OVER (), user_id,
+        date_trunc('day', now()) - day * INTERVAL '1 day'
+        + INTERVAL '8 hours', day %% 2 = 0, ''
+        FROM generate_series(2, %s) AS user_id,
+        generate_series(0, %s) AS day;""", (team_size + 1, days - 1))
+    db.cursor.execute(
+        """INSERT INTO interval_data
+        (training_id, duration, power, pace, rest)
+        SELECT id, 300, 200 + i, 20, INTERVAL '1 minute'
+        FROM training_data, generate_series(1, %s) AS i;""",
+        (intervals_per_training,))
+    # Continue the sequences after the inserted ids
+    for table in ['users', 'teams', 'training_data']:
+        db.cursor.execute(
+            """SELECT setval('{0}_id_seq', MAX(id)) FROM {0};"""
+            .format(table))
+    db.database_connection.commit()
+
+
+def create_certificate(directory):
+    """Creates a self-signed certificate for localhost in the directory
+    with the openssl command and returns the paths of the certificate
+    and key files."""
+    certfile = os.path.join(directory, 'cert.pem')
+    keyfile = os.path.join(directory, 'key.pem')
+    with open(os.devnull, 'w') as devnull:
+        subprocess.check_call(
+            ['openssl', 'req', '-x509', '-newkey', 'rsa:2048', '-nodes',
+             '-days', '1', '-subj', '/CN=localhost',
+             '-keyout', keyfile, '-out', certfile],
+            stdout=devnull, stderr=devnull)
+    return (certfile, keyfile)
+
+
+def timed(function, repeat=5):
+    """Calls function `repeat` times and returns the duration of every
+    call in seconds."""
+    durations = []
+    for _ in range(repeat):
+        start = time.time()
+        function()
+        durations.append(time.time() - start)
+    return durations
+
+
+def percentile(values, p):
+    """Returns the `p`th percentile (0-100) of the values."""
+    ordered = sorted(values)
+    index = int(round((len(ordered) - 1) * p / 100.0))
+    return ordered[index]
+
+
+def median(values):
+    return percentile(values, 50)
+
+
+def print_table(header, rows):
+    """Prints rows of values as an aligned table."""
+    rows = [header] + [[str(value) for value in row] for row in rows]
+    widths = [max(len(row[i]) for row in rows) for i in range(len(header))]
+    for row in rows:
+        print '  '.join(value.rjust(width)
+                        for (value, width) in zip(row, widths))
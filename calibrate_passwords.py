@@ -0,0 +1,41 @@
+"""
+Measures how long hashing a password takes on this host and suggests
+the number of pbkdf2_sha256 rounds for crw.cfg that takes the target
+number of milliseconds, 50 unless given:
+
+python calibrate_passwords.py [milliseconds]
+"""
+import sys
+import time
+from passlib.crypto.digest import PBKDF2_BACKENDS
+from passlib.hash import pbkdf2_sha256
+from crw import PASSWORD_ROUNDS
+
+# Number of times a hash is made to measure it, the fastest one counts
+REPEAT = 5
+
+
+def hash_milliseconds(rounds):
+    """Returns the milliseconds hashing a password with rounds takes."""
+    handler = pbkdf2_sha256.using(rounds=rounds)
+    durations = []
+    for _ in range(REPEAT):
+        start = time.time()
+        handler.hash('calibration')
+        durations.append(time.time() - start)
+    return min(durations) * 1000
+
+
+if __name__ == '__main__':
+    target = float(sys.argv[1]) if len(sys.argv) > 1 else 50
+    milliseconds = hash_milliseconds(PASSWORD_ROUNDS)
+    # The duration is proportional to the number of rounds, rounded to
+    # thousands
+    rounds = max(int(round(PASSWORD_ROUNDS * target / milliseconds,
+                           -3)), 1000)
+
+    print 'pbkdf2 backend: {}'.format(', '.join(PBKDF2_BACKENDS))
+    print 'Configured: {} rounds take {:.1f} ms'.format(
+        PASSWORD_ROUNDS, milliseconds)
+    print 'Suggested for {:.0f} ms: rounds = {} ({:.1f} ms)'.format(
+        target, rounds, hash_milliseconds(rounds))
@@ -0,0 +1,7 @@
+from static_files import compress_directory
+
+if __name__ == '__main__':
+    # Write the gzip (and brotli) compressed variants of the static
+    # files, which are sent to clients that accept those encodings
+    compress_directory('static')
+    print 'Compressed the static files'
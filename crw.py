@@ -16,22 +16,76 @@ USE_HTTPS = cfg.get('https', 'enabled') == 'True'
 HTTPS_PORT = int(cfg.get('https', 'port'))
 HTTPS_CERT = cfg.get('https', 'certfile')
 HTTPS_KEY = cfg.get('https', 'keyfile')
+HTTPS_CIPHERS = cfg.get('https', 'ciphers')
+HTTPS_SESSION_TICKETS = cfg.get('https', 'session_tickets') == 'True'
+
+SERVER_MODE = cfg.get('server', 'mode')
+SERVER_WORKERS = int(cfg.get('server', 'workers'))
+BATCH_WORKERS = int(cfg.get('server', 'batch_workers'))
+BATCH_CONCURRENCY = int(cfg.get('server', 'batch_concurrency'))
+KEEPALIVE_TIMEOUT = int(cfg.get('server', 'keepalive_timeout'))
+if cfg.has_option('server', 'keepalive_requests'):
+    KEEPALIVE_REQUESTS = int(cfg.get('server', 'keepalive_requests'))
+else:
+    KEEPALIVE_REQUESTS = 100 if SERVER_MODE == 'events' else 1
+REQUEST_TIMEOUT = int(cfg.get('server', 'request_timeout'))
 
 DATABASE_HOST = cfg.get('database', 'host')
 DATABASE_PORT = cfg.get('database', 'port')
 DATABASE_NAME = cfg.get('database', 'name')
 DATABASE_USER = cfg.get('database', 'user')
 DATABASE_PASS = cfg.get('database', 'password')
+DATABASE_POOL_SIZE = int(cfg.get('database', 'pool_size'))
+
+PASSWORD_ROUNDS = int(cfg.get('passwords', 'rounds'))
+PASSWORD_PROCESSES = int(cfg.get('passwords', 'processes'))
+PASSWORD_MAX_PENDING = int(cfg.get('passwords', 'max_pending'))
+
+LOGIN_EMAIL_BURST = int(cfg.get('login', 'email_burst'))
+LOGIN_EMAIL_RATE = float(cfg.get('login', 'email_rate'))
+LOGIN_ADDRESS_BURST = int(cfg.get('login', 'address_burst'))
+LOGIN_ADDRESS_RATE = float(cfg.get('login', 'address_rate'))
+LOGIN_BACKOFF = float(cfg.get('login', 'backoff'))
+LOGIN_MAX_BACKOFF = float(cfg.get('login', 'max_backoff'))
+LOGIN_THROTTLE_SIZE = int(cfg.get('login', 'size'))
+if (LOGIN_EMAIL_BURST > 0 and LOGIN_EMAIL_RATE <= 0) or \
+        (LOGIN_ADDRESS_BURST > 0 and LOGIN_ADDRESS_RATE <= 0):
+    raise ValueError('The login rates in {} have to be more than 0'
+                     .format(CONFIG_FILE))
+
+SESSION_BACKEND = cfg.get('sessions', 'backend')
+SESSION_SECRET = cfg.get('sessions', 'secret')
+SESSION_CACHE_SIZE = int(cfg.get('sessions', 'cache_size'))
+SESSION_CACHE_TTL = int(cfg.get('sessions', 'cache_ttl'))
+SESSION_RENEW_INTERVAL = int(cfg.get('sessions', 'renew_interval'))
+SESSION_REAP_INTERVAL = int(cfg.get('sessions', 'reap_interval'))
+SESSION_REAP_BATCH_SIZE = int(cfg.get('sessions', 'reap_batch_size'))
+SESSION_REAP_MAX_BATCHES = int(cfg.get('sessions', 'reap_max_batches'))
+
+STATIC_CACHE_SIZE = int(cfg.get('static', 'cache_size'))
+STATIC_STREAM_THRESHOLD = int(cfg.get('static', 'stream_threshold'))
+STATIC_MAX_AGE = int(cfg.get('static', 'max_age'))
+STATIC_COMPRESS = cfg.get('static', 'compress') == 'True'
+STATIC_WATCH_INTERVAL = int(cfg.get('static', 'watch_interval'))
 
 USE_REDIRECTOR = cfg.get('redirector', 'enabled') == 'True'
 REDIRECT_TARGET = cfg.get('redirector', 'target')
 
 if __name__ == '__main__':
     try:
-        import http_redirector
-        thread.start_new_thread(http_redirector.serve, ())
-        import http_server
-        http_server.serve()
+        if SERVER_MODE == 'events':
+            # Also redirects to HTTPS, on the same event loop
+            import event_server
+            event_server.serve()
+        else:
+            import http_redirector
+            import http_server
+            # setup forks the password processes, which has to happen
+            # before any thread is started: a lock held by another
+            # thread at the fork stays held in the child
+            http_server.setup()
+            thread.start_new_thread(http_redirector.serve, ())
+            http_server.serve()
     except KeyboardInterrupt:
         print 'Exiting...'
         raise SystemExit
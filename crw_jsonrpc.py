@@ -1,7 +1,11 @@
 from jsonrpc import JsonRpcServer
 import jsonrpc
 import database as d
+import passwords
 import datetime
+import math
+import threading
+from contextlib import contextmanager
 
 
 # CrwJsonRpc is a server that accepts an extended version of JsonRpc
@@ -10,62 +14,141 @@ import datetime
 # to be logged in. CrwJsonRpc will return standard JsonRpc 2.0
 # responses.
 class CrwJsonRpc(JsonRpcServer):
-    def __init__(self, database):
+    # LoginThrottles limiting the login attempts per email address and
+    # per client host. Without them logins aren't limited.
+    email_throttle = None
+    address_throttle = None
+
+    def __init__(self, database, session_cache=None, sessions=None):
+        """`sessions` is the session backend, a SessionDatabase with
+        `session_cache` by default, or a SignedSessionDatabase."""
+        self.database = database
         self.udb = d.UserDatabase(database)
         self.tdb = d.TeamDatabase(database)
-        self.sdb = d.SessionDatabase(database)
+        if sessions is None:
+            sessions = d.SessionDatabase(database, session_cache)
+        self.sdb = sessions
         self.hdb = d.HealthDatabase(database)
         self.trdb = d.TrainingDatabase(database)
         self.idb = d.IntervalDatabase(database)
 
-        # The id of the user who's request is currently being processed
-        self.current_user_id = -1
-        # Stores whether the user is authenticated for the user id
-        # currently
-        self.authenticated = False
+        # The state of the request that is currently being processed.
+        # Requests can be processed by multiple threads at the same
+        # time, so every thread keeps its own.
+        self.request = threading.local()
+
+    @property
+    def current_user_id(self):
+        """The id of the user who's request is currently being
+        processed"""
+        return getattr(self.request, 'user_id', -1)
+
+    @current_user_id.setter
+    def current_user_id(self, user_id):
+        self.request.user_id = user_id
+
+    @property
+    def authenticated(self):
+        """Whether the user is authenticated for the current user id"""
+        return getattr(self.request, 'authenticated', False)
+
+    @authenticated.setter
+    def authenticated(self, authenticated):
+        self.request.authenticated = authenticated
+
+    @property
+    def current_session(self):
+        """The session key the current request was made with"""
+        return getattr(self.request, 'session', None)
+
+    @current_session.setter
+    def current_session(self, session):
+        self.request.session = session
+
+    @property
+    def streaming(self):
+        """Whether the response to the current request is streamed, so
+        large results can be returned as iterators"""
+        return getattr(self.request, 'streaming', False)
+
+    @streaming.setter
+    def streaming(self, streaming):
+        self.request.streaming = streaming
+
+    @property
+    def client_address(self):
+        """The (host, port) of the client that sent the current request,
+        if known"""
+        return getattr(self.request, 'client_address', None)
+
+    @client_address.setter
+    def client_address(self, client_address):
+        self.request.client_address = client_address
+
+    # We overwrite the invocation method to save our custom values
+    # before a request is invoked by the rpc_invoke_single method from
+    # the super class.
+    @contextmanager
+    def invocation(self, data, streaming=False, client_address=None):
+        try:
+            # Every request is handled in one transaction, committed
+            # once at the end, or rolled back if the call failed. A
+            # streamed response is encoded in the same transaction
+            with self.database.connection(), self.database.transaction():
+                self.streaming = streaming
+                self.client_address = client_address
+                if type(data) is dict:
+                    if 'session' in data:
+                        # The user can be authenticated if they
+                        # supply both an session key and user id (and
+                        # they are both correct).
+                        # Or if they supply a correct session_key. The
+                        # user_id that belongs to that session_key will
+                        # be used then.
+                        if 'user_id' in data and data['user_id'] is not None:
+                            self.current_user_id = data['user_id']
+                        else:
+                            self.current_user_id =\
+                                self.sdb.get_user_id_by_sessionkey(
+                                    data['session'])
+
+                        if self.current_user_id is None:
+                            self.current_user_id = -1
+                        else:
+                            self.authenticated = self.sdb.verify_session_key(
+                                self.current_user_id, data['session'])
+                            self.current_session = data['session']
+
+                        if self.authenticated:
+                            self.sdb.renew_session_key(
+                                self.current_user_id, data['session'])
+
+                yield
+        finally:
+            self.current_user_id = -1
+            self.authenticated = False
+            self.current_session = None
+            self.streaming = False
+            self.client_address = None
 
-    # We overwrite the rpc_invoke_single method to save our custom
-    # values before calling the rpc_invoke_single method from the
-    # super class.
-    def rpc_invoke_single(self, data):
+    def rpc_invoke_single(self, data, client_address=None):
         try:
-            if type(data) is dict:
-                if 'session' in data:
-                    # The user can be authenticated if they
-                    # supply both an session key and user id (and they
-                    # are both correct).
-                    # Or if they supply a correct session_key. The user_id
-                    # that belongs to that session_key will be used then.
-                    if 'user_id' in data and data['user_id'] is not None:
-                        self.current_user_id = data['user_id']
-                    else:
-                        self.current_user_id =\
-                            self.sdb.get_user_id_by_sessionkey(
-                                data['session'])
-
-                    if self.current_user_id is None:
-                        self.current_user_id = -1
-                    else:
-                        self.authenticated = self.sdb.verify_session_key(
-                            self.current_user_id, data['session'])
-                        self.current_session = data['session']
-
-                    if self.authenticated:
-                        self.sdb.renew_session_key(
-                            self.current_user_id, data['session'])
-
-            response = JsonRpcServer.rpc_invoke_single(self, data)
+            with self.invocation(data, client_address=client_address):
+                response = JsonRpcServer.rpc_invoke_single(self, data)
         except Exception as e:
             response = {
                 "jsonrpc": "2.0",
                 "id": None,
-                "error": RPCError.internal_error(e).serialize()
+                "error": jsonrpc.RPCError.internal_error(e).serialize()
             }
-        finally:
-            self.current_user_id = -1
-            self.authenticated = False
+        return response
 
-            return response
+    def rpc_call(self, method, params):
+        # Makes the transaction of the request roll back when the call
+        # raises an error, even though it is turned into an error
+        # response
+        with self.database.transaction():
+            return JsonRpcServer.rpc_call(self, method, params)
 
     def echo(self, s):
         return s
@@ -76,6 +159,8 @@ class CrwJsonRpc(JsonRpcServer):
         try:
             self.udb.add_user(email, password)
             return True
+        except passwords.PasswordPoolFull:
+            raise error_server_busy
         except d.PasswordFieldEmpty, e:
             raise error_no_password_submitted
         except d.UserDoesNotExistError, e:
@@ -85,16 +170,50 @@ class CrwJsonRpc(JsonRpcServer):
 
     def login(self, email, password):
         """This function will verify the user and return a new session
-        key if the user has been authenticated correctly."""
+        key if the user has been authenticated correctly.
+
+        Attempts beyond the limits of the login throttles are refused
+        before the password is checked."""
         self.check_arguments_not_none([email, password])
 
-        if (not self.udb.does_user_email_exist(email)) or\
-           (not self.udb.verify_user(email, password)):
-            raise error_invalid_account_credentials
+        throttles = self.login_throttles(email)
+        for (i, (throttle, key)) in enumerate(throttles):
+            retry_after = throttle.acquire(key)
+            if retry_after > 0:
+                # The refused attempt doesn't count for the other
+                # throttles
+                for (acquired, acquired_key) in throttles[:i]:
+                    acquired.release(acquired_key)
+                raise jsonrpc.RPCError(error_too_many_login_attempts.code,
+                                       error_too_many_login_attempts.message,
+                                       int(math.ceil(retry_after)))
 
+        try:
+            if (not self.udb.does_user_email_exist(email)) or\
+               (not self.udb.verify_user(email, password)):
+                for (throttle, key) in throttles:
+                    throttle.failed(key)
+                raise error_invalid_account_credentials
+        except passwords.PasswordPoolFull:
+            raise error_server_busy
+
+        for (throttle, key) in throttles:
+            throttle.succeeded(key)
         return self.sdb.generate_session_key(
             self.udb.get_user_id(email))
 
+    def login_throttles(self, email):
+        """Returns the (throttle, key) pairs limiting a login attempt
+        with email by the client of the current request."""
+        throttles = []
+        if self.email_throttle is not None:
+            throttles.append((self.email_throttle, email))
+        if self.address_throttle is not None and \
+                self.client_address is not None:
+            throttles.append((self.address_throttle,
+                              self.client_address[0]))
+        return throttles
+
     def user_status(self):
         """Returns if the user is still authenticated, if the user is
         in a team and if the user is a coach in the form:
@@ -255,6 +374,31 @@ class CrwJsonRpc(JsonRpcServer):
 
         return True
 
+    def add_health_data_bulk(self, health_data):
+        """Adds the health data of multiple days of the logged in user
+        at once, in the form [(date, resting_heart_rate, weight,
+        comment)], using HealthDatabase::add_health_data_bulk.
+
+        Returns true on success"""
+        self.check_arguments_not_none([health_data])
+
+        if not self.authenticated:
+            raise error_incorrect_authentication
+
+        for (date, resting_heart_rate, weight, comment) in health_data:
+            self.check_arguments_not_none([date, resting_heart_rate,
+                                           weight])
+
+        (team_id, coach) = self.udb.get_user_team_status(self.current_user_id)
+        if team_id is not None and coach:
+            # Someone who is a coach in a team, can't add any health
+            # data
+            raise error_invalid_action_coach
+
+        self.hdb.add_health_data_bulk(self.current_user_id, health_data)
+
+        return True
+
     def get_my_health_data(self, days_in_the_past):
         """Gets the health data of the user from `days_in_the_past` ago to
         now, in the form [(date, resting_heart_rate, weight,
@@ -286,22 +430,21 @@ class CrwJsonRpc(JsonRpcServer):
         if not coach or team_id is None:
             raise error_invalid_action_no_coach
 
-        # This is a list in the form [(user_id, email, coach)]
-        team_list = self.tdb.get_team_members(team_id)
-
         team_health_data = []
+        last_user_id = None
+
+        for (user_id, email, date, resting_heart_rate, weight, comment)\
+                in self.hdb.get_team_health_data(
+                    team_id, datetime.timedelta(days=days_in_the_past)):
+            if user_id != last_user_id:
+                member_health_data = []
+                team_health_data.append((email, member_health_data))
+                last_user_id = user_id
 
-        for team_member in team_list:
-            coach = team_member[2]
-            if coach:
-                # Coaches don't have any health data and can be skipped
-                continue
-            email = team_member[1]
-            user_id = team_member[0]
-            team_health_data.append(
-                (email,
-                 self.hdb.get_past_health_data(
-                     user_id, datetime.timedelta(days=days_in_the_past))))
+            # The date is None for members without any health data
+            if date is not None:
+                member_health_data.append(
+                    (date, resting_heart_rate, weight, comment))
 
         return team_health_data
 
@@ -322,19 +465,12 @@ class CrwJsonRpc(JsonRpcServer):
             # data
             raise error_invalid_action_coach
 
-        training_id = self.trdb.add_training(
-            self.current_user_id, time, type_is_ed, comment)
-
-        for interval in interval_list:
-            duration = interval[0]
-            power = interval[1]
-            pace = interval[2]
-            rest = interval[3]
-
+        for (duration, power, pace, rest) in interval_list:
             # Pace is explicitly allowed to be None
             self.check_arguments_not_none([duration, power, rest])
 
-            self.idb.add_interval(training_id, duration, power, pace, rest)
+        self.trdb.add_training_with_intervals(
+            self.current_user_id, time, type_is_ed, comment, interval_list)
 
         return True
 
@@ -387,36 +523,13 @@ class CrwJsonRpc(JsonRpcServer):
         if not coach or team_id is None:
             raise error_invalid_action_no_coach
 
-        # This is a list in the form [(user_id, email, coach)]
-        team_list = self.tdb.get_team_members(team_id)
-
-        team_training_data = []
-
-        for (user_id, email, coach) in team_list:
-            if coach:
-                # Choaches don't have any training data, they just
-                # watch it.
-                continue
-
-            past_trainings = self.trdb.get_past_training_data(
-                user_id, datetime.timedelta(days=days_in_the_past))
-
-            member_training_data = []
-
-            for training in past_trainings:
-                training_id = training[0]
-                time = training[1]
-                type_is_ed = training[2]
-                comment = training[3]
-                # This list is in the form [(duration, power, pace, rest)]
-                interval_data = self.idb.get_training_interval_data(
-                    training_id)
-                member_training_data.append(
-                    (time, type_is_ed, comment, interval_data))
-
-            team_training_data.append((email, member_training_data))
-
-        return team_training_data
+        if self.streaming:
+            # Encoded while the rows are read from the database, so the
+            # whole team's data is never in memory at once
+            return self.trdb.iter_team_training_data(
+                team_id, datetime.timedelta(days=days_in_the_past))
+        return self.trdb.get_team_training_data(
+            team_id, datetime.timedelta(days=days_in_the_past))
 
     def check_arguments_not_none(self, list_of_arguments):
         """Accepts a list of arguments that can't be None. Raises an
@@ -452,3 +565,9 @@ error_invalid_email_address = jsonrpc.RPCError(
     10, """The given email address is synthactically invalid.""")
 error_mandatory_argument_none = jsonrpc.RPCError(
     11, """One of the mandatory arguments was None.""")
+error_server_busy = jsonrpc.RPCError(
+    12, """The server is too busy to check passwords, try again """
+    """later.""")
+error_too_many_login_attempts = jsonrpc.RPCError(
+    13, """Too many login attempts, try again after the number of """
+    """seconds in data.""")
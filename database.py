@@ -1,26 +1,236 @@
 import psycopg2
-from passlib.context import CryptContext
+import psycopg2.extras
+import psycopg2.errorcodes
 import random
 import string
 import datetime
+import hashlib
+import hmac
 import re
-
-# Global password context
-pwd_context = CryptContext(
-    schemes=["pbkdf2_sha256"]
-    )
-
-
-class Database:
-    def __init__(self, db_host, db_port, db_name, db_user, db_pass):
-        self.database_connection = psycopg2.connect(
-            host=db_host, port=db_port, database=db_name,
-            user=db_user, password=db_pass)
-        self.cursor = self.database_connection.cursor()
-
-    def init_database(self):
+import threading
+import Queue
+import collections
+import itertools
+import time
+import traceback
+from contextlib import contextmanager
+import migrations
+import passwords
+
+
+class Database(object):
+    # A passwords.PasswordPool on which the passwords of users are
+    # hashed and verified. Without a pool they are hashed on the
+    # calling thread.
+    password_pool = None
+    # A thread pool (multiprocessing.pool.ThreadPool) running the work
+    # passed to `defer`. Without a pool it's done right away.
+    deferred_pool = None
+
+    def __init__(self, db_host, db_port, db_name, db_user, db_pass,
+                 pool_size=1):
+        """Opens `pool_size` connections to the database. Every thread
+        works on a connection of its own, see `connection`."""
+        self.pool = Queue.Queue()
+        self.connections = []
+        for _ in range(pool_size):
+            database_connection = psycopg2.connect(
+                host=db_host, port=db_port, database=db_name,
+                user=db_user, password=db_pass)
+            self.connections.append(database_connection)
+            self.pool.put(
+                (database_connection, database_connection.cursor()))
+
+        # The connection and cursor bound to the current thread
+        self.local = threading.local()
+        # Numbers the server side cursors, their names have to be unique
+        self.server_cursor_numbers = itertools.count(1)
+
+    @property
+    def database_connection(self):
+        """The connection of the current thread. A thread that uses the
+        database outside of a `connection` block claims a connection
+        from the pool and keeps it, so single threaded scripts and the
+        tests can keep using the database like before."""
+        if getattr(self.local, 'connection', None) is None:
+            (self.local.connection, self.local.cursor) = self.pool.get()
+        return self.local.connection
+
+    @property
+    def cursor(self):
+        """The cursor belonging to `database_connection`"""
+        self.database_connection
+        return self.local.cursor
+
+    def server_cursor(self):
+        """Returns a new server side cursor on `database_connection`.
+        Iterating over it fetches the rows of its query `itersize` at a
+        time, instead of all at once like `cursor`. It is closed at the
+        end of the transaction."""
+        return self.database_connection.cursor(
+            name='crw_cursor_{}'.format(next(self.server_cursor_numbers)))
+
+    @contextmanager
+    def connection(self):
+        """Binds a connection from the pool to the current thread for the
+        duration of the block, waiting for one if all of them are in
+        use. Nested blocks reuse the connection of the outer block."""
+        if getattr(self.local, 'connection', None) is not None:
+            yield
+            return
+
+        (self.local.connection, self.local.cursor) = self.pool.get()
+        self.local.pooled = True
+        try:
+            yield
+        finally:
+            try:
+                # Don't hand an open or failed transaction to the next
+                # thread
+                self.local.connection.rollback()
+            finally:
+                # Even when the connection broke, or the pool would run
+                # out of connections
+                self.pool.put((self.local.connection, self.local.cursor))
+                self.local.connection = None
+                self.local.cursor = None
+                self.local.pooled = False
+
+    @contextmanager
+    def released(self):
+        """Gives the connection of the current thread back to the pool
+        for the duration of the block, so other threads can use it while
+        this one does slow work without the database, like hashing a
+        password. The transaction so far is ended first: committed, or
+        rolled back when the `transaction` block it is in will be rolled
+        back. After the block the thread waits for a connection again.
+
+        Whatever was written before the block is committed early, and no
+        longer undone when the request fails afterwards. What was read
+        before it may be changed by other threads meanwhile, so writes
+        after the block can't rely on earlier checks.
+
+        Outside of a `connection` block the thread keeps its connection."""
+        if not getattr(self.local, 'pooled', False):
+            yield
+            return
+
+        if self.in_transaction() and self.local.rollback_only:
+            self.local.connection.rollback()
+        else:
+            self.local.connection.commit()
+            if self.in_transaction():
+                (callbacks, self.local.after_commit) = \
+                    (self.local.after_commit, [])
+                for (function, args) in callbacks:
+                    function(*args)
+        self.pool.put((self.local.connection, self.local.cursor))
+        self.local.connection = None
+        self.local.cursor = None
+        try:
+            yield
+        finally:
+            (self.local.connection, self.local.cursor) = self.pool.get()
+
+    def in_transaction(self):
+        """Returns whether the current thread is inside a `transaction`
+        block."""
+        return getattr(self.local, 'transaction_depth', 0) > 0
+
+    @contextmanager
+    def transaction(self):
+        """Makes all changes of the current thread inside the block one
+        transaction. Calls to `commit` and `rollback` inside the block
+        are deferred to its end, where the transaction is committed, or
+        rolled back if an exception was raised in the block or
+        `rollback` was called. Nested blocks are part of the transaction
+        of the outer block."""
+        depth = getattr(self.local, 'transaction_depth', 0)
+        if depth == 0:
+            self.local.rollback_only = False
+            self.local.after_commit = []
+        self.local.transaction_depth = depth + 1
+
+        try:
+            yield
+        except Exception:
+            self.local.rollback_only = True
+            raise
+        finally:
+            self.local.transaction_depth = depth
+            if depth == 0:
+                callbacks = self.local.after_commit
+                self.local.after_commit = []
+                if self.local.rollback_only:
+                    self.database_connection.rollback()
+                else:
+                    self.database_connection.commit()
+                    for (function, args) in callbacks:
+                        function(*args)
+
+    def commit(self):
+        """Commits the changes of the current thread, or leaves that to
+        the end of the `transaction` block it is in."""
+        if not self.in_transaction():
+            self.database_connection.commit()
+
+    def rollback(self):
+        """Rolls back the changes of the current thread, or makes the
+        `transaction` block it is in roll back at its end."""
+        if self.in_transaction():
+            self.local.rollback_only = True
+        else:
+            self.database_connection.rollback()
+
+    def after_commit(self, function, *args):
+        """Calls function with args once the changes of the current
+        thread so far are committed: at the end of the `transaction`
+        block it is in, or right away outside of one, where `commit`
+        doesn't wait. It isn't called when the transaction is rolled
+        back."""
+        if self.in_transaction():
+            self.local.after_commit.append((function, args))
+        else:
+            function(*args)
+
+    def defer(self, function, *args):
+        """Calls function with args on `deferred_pool`, with a connection
+        and transaction of its own, so the current request doesn't wait
+        for it. The caller doesn't get to know if it fails."""
+        if self.deferred_pool is None:
+            function(*args)
+            return
+
+        def run():
+            try:
+                with self.connection(), self.transaction():
+                    function(*args)
+            except Exception:
+                traceback.print_exc()
+        self.deferred_pool.apply_async(run)
+
+    def hash_password(self, password):
+        """Returns the hash of a password, made on `password_pool` if
+        there is one. Raises a PasswordPoolFull when the pool has too
+        much work queued."""
+        if self.password_pool is not None:
+            return self.password_pool.hash(password)
+        return passwords.hash_password(password)
+
+    def verify_password(self, password, password_hash):
+        """Returns whether the password matches the hash, verified on
+        `password_pool` if there is one. Raises a PasswordPoolFull when
+        the pool has too much work queued."""
+        if self.password_pool is not None:
+            return self.password_pool.verify(password, password_hash)
+        return passwords.verify_password(password, password_hash)
+
+    def init_database(self, migrate=True):
         """Creates the table structure in the database.  This is to be used
-        once for every database, not on every restart of the program."""
+        once for every database, not on every restart of the program.
+
+        The tables are brought up to date with all migrations, unless
+        `migrate` is False."""
         self.cursor.execute(
             """CREATE TABLE teams
             (id INTEGER PRIMARY KEY,
@@ -64,8 +274,67 @@ class Database:
             rest INTERVAL);""")
         self.database_connection.commit()
 
+        if migrate:
+            self.migrate()
+
+    def is_initialized(self):
+        """Returns whether the tables have been created in the
+        database."""
+        self.cursor.execute(
+            """SELECT to_regclass('users') IS NOT NULL;""")
+        (initialized,) = self.cursor.fetchone()
+        self.database_connection.commit()
+        return initialized
+
+    def get_schema_version(self):
+        """Returns the version of the latest migration applied to the
+        database, 0 if no migration has been applied."""
+        self.cursor.execute(
+            """CREATE TABLE IF NOT EXISTS schema_version
+            (version INTEGER PRIMARY KEY,
+            description TEXT NOT NULL,
+            applied TIMESTAMP NOT NULL DEFAULT now());""")
+        self.cursor.execute(
+            """SELECT MAX(version) FROM schema_version;""")
+        (version,) = self.cursor.fetchone()
+        return version or 0
+
+    def migrate(self):
+        """Applies all migrations that are newer than the schema version
+        of the database, in order and each in its own transaction.
+        Returns the new schema version."""
+        version = self.get_schema_version()
+
+        for (migration_version, description, statements)\
+                in migrations.MIGRATIONS:
+            if migration_version <= version:
+                continue
+
+            # Another server could be migrating at the same time, the
+            # lock makes sure the migration is only applied once
+            self.cursor.execute(
+                """LOCK TABLE schema_version IN EXCLUSIVE MODE;""")
+            version = self.get_schema_version()
+            if migration_version <= version:
+                continue
+
+            for statement in statements:
+                self.cursor.execute(statement)
+            self.cursor.execute(
+                """INSERT INTO schema_version (version, description)
+                VALUES (%s, %s);""", (migration_version, description))
+            self.database_connection.commit()
+            version = migration_version
+
+        self.database_connection.commit()
+        return version
+
     def drop_all_tables(self):
         """Drops all tables from the database"""
+        self.cursor.execute(
+            """DROP TABLE IF EXISTS schema_version;""")
+        self.cursor.execute(
+            """DROP TABLE IF EXISTS revoked_sessions;""")
         self.cursor.execute(
             """DROP TABLE sessions;""")
         self.cursor.execute(
@@ -81,9 +350,9 @@ class Database:
         self.database_connection.commit()
 
     def close_database_connection(self):
-        """Closes the database_connection and the cursor"""
-        self.cursor.close()
-        self.database_connection.close()
+        """Closes all connections of the pool and their cursors"""
+        for database_connection in self.connections:
+            database_connection.close()
 
 
 class UserDoesNotExistError(ValueError):
@@ -116,8 +385,8 @@ class UserDatabase:
 
     def add_user(self, email, password):
         """Adds an user to the database, using the given email as
-        email, the given password as password and a new id, one higher
-        than the highest id in the database."""
+        email, the given password as password and a new id from the
+        users_id_seq sequence. Returns the id of the user."""
 
         # Check if password is not empty
         if password == "":
@@ -140,25 +409,36 @@ class UserDatabase:
         if self.d.cursor.fetchone() is not None:
             raise UserDoesNotExistError('email', email)
 
-        # Find the current max_id to generate a new id that is one
-        # higher
-        self.d.cursor.execute(
-            """SELECT MAX(id) FROM users;""")
-        (max_id,) = self.d.cursor.fetchone()
-        if max_id is None:
-            max_id = 0
-
-        # Hash and salt the password using passlib
-        password_hash = pwd_context.hash(password)
+        # Hash and salt the password using passlib, without holding a
+        # connection meanwhile
+        with self.d.released():
+            password_hash = self.d.hash_password(password)
 
-        self.d.cursor.execute(
-            """INSERT INTO users (id, email, password) VALUES
-            (%s, %s, %s);""", (max_id + 1, email, password_hash))
-        self.d.database_connection.commit()
+        try:
+            self.d.cursor.execute(
+                """INSERT INTO users (email, password) VALUES
+                (%s, %s)
+                RETURNING id;""", (email, password_hash))
+        except psycopg2.IntegrityError as e:
+            self.d.rollback()
+            # Added by another thread while the password was hashed
+            if e.pgcode == psycopg2.errorcodes.UNIQUE_VIOLATION:
+                raise UserDoesNotExistError('email', email)
+            raise
+        (user_id,) = self.d.cursor.fetchone()
+        self.d.commit()
+
+        return user_id
 
     def verify_user(self, email, password):
         """Returns whether the given password is the same as the
-        password associated with this email address. """
+        password associated with this email address. Raises a
+        PasswordPoolFull when the password pool has too much work
+        queued.
+
+        When the password is correct but its hash was made with other
+        parameters than the configured ones, it is hashed again
+        deferred, see `Database.defer`."""
         self.d.cursor.execute(
             """SELECT password FROM users
             WHERE email = %s;""", (email,))
@@ -168,7 +448,29 @@ class UserDatabase:
             raise UserDoesNotExistError('email', email)
         saved_password_hash = saved_password_tuple[0]
 
-        return pwd_context.verify(password, saved_password_hash)
+        # The connection isn't held while waiting for the hash
+        with self.d.released():
+            verified = self.d.verify_password(password, saved_password_hash)
+        if verified and passwords.needs_update(saved_password_hash):
+            self.d.defer(self.rehash_password, email, password,
+                         saved_password_hash)
+        return verified
+
+    def rehash_password(self, email, password, old_password_hash):
+        """Replaces the hash of the password of a user with one made
+        with the configured parameters, unless the password was changed
+        since old_password_hash was read."""
+        try:
+            with self.d.released():
+                password_hash = self.d.hash_password(password)
+        except passwords.PasswordPoolFull:
+            # Tried again on the next login
+            return
+        self.d.cursor.execute(
+            """UPDATE users SET password = %s
+            WHERE email = %s AND password = %s;""",
+            (password_hash, email, old_password_hash))
+        self.d.commit()
 
     def get_user_id(self, email):
         """Returns the user_id associated with this email address"""
@@ -223,26 +525,18 @@ class TeamDatabase:
         if not UserDatabase(self.d).does_user_exist(user_id):
             raise UserDoesNotExistError('id', user_id)
 
-        # Find the max team id, so we can choose one that is one
-        # higher
-        self.d.cursor.execute(
-            """SELECT MAX(id) FROM teams;""")
-        (max_team_id,) = self.d.cursor.fetchone()
-        if max_team_id is None:
-            max_team_id = 0
-        team_id = max_team_id + 1
-
         # Create the team
         self.d.cursor.execute(
-            """INSERT INTO teams (id, name) VALUES (%s, %s);""",
-            (team_id, team_name))
+            """INSERT INTO teams (name) VALUES (%s)
+            RETURNING id;""", (team_name,))
+        (team_id,) = self.d.cursor.fetchone()
 
         self.d.cursor.execute(
             """UPDATE users
             SET team_id = %s, coach = %s
             WHERE id = %s;""", (team_id, True, user_id))
 
-        self.d.database_connection.commit()
+        self.d.commit()
 
         return team_id
 
@@ -282,7 +576,7 @@ class TeamDatabase:
             SET team_id = %s, coach = %s
             WHERE id = %s;""", (team_id, coach, user_to_add_id))
 
-        self.d.database_connection.commit()
+        self.d.commit()
 
     def set_user_coach_status(self, user_to_change_id, coach):
         """Changes the coach status of the user with
@@ -296,7 +590,7 @@ class TeamDatabase:
             SET coach = %s
             WHERE id = %s;""", (coach, user_to_change_id))
 
-        self.d.database_connection.commit()
+        self.d.commit()
 
     def remove_user_from_team(
             self, requesting_user_id, user_to_remove_id):
@@ -328,6 +622,8 @@ class TeamDatabase:
             SET team_id = %s, coach = %s
             WHERE id = %s""", (None, None, user_to_remove_id))
 
+        self.d.commit()
+
     def get_team_members(self, team_id):
         """Returns a list of the teammembers associated with the team_id"""
         self.d.cursor.execute(
@@ -341,8 +637,11 @@ class TeamDatabase:
 
 
 class SessionDatabase:
-    def __init__(self, database):
+    def __init__(self, database, cache=None):
+        """`cache` is an optional SessionCache, used to verify and renew
+        session keys without querying the database every time."""
         self.d = database
+        self.cache = cache
 
     def generate_session_key(self, user_id,
                              livespan=datetime.timedelta(weeks=1)):
@@ -350,14 +649,12 @@ class SessionDatabase:
         should already be verified for this. The session key will be
         saved in the sessions table and will be valid for one week.
 
-        This will (as a side effect) remove all session keys that are
-        outdated from this user from the session key database."""
+        Expired session keys are removed in the background, see
+        session_reaper."""
         udb = UserDatabase(self.d)
         if not udb.does_user_exist(user_id):
             raise UserDoesNotExistError('id', user_id)
 
-        self.remove_expired_keys(user_id)
-
         # Generate a random, cryptographically secure string of
         # printable characters, that will be used as session key.
         # Based on http://stackoverflow.com/a/23728630
@@ -376,38 +673,76 @@ class SessionDatabase:
             """INSERT INTO sessions (key, user_id, exp_date)
             VALUES (%s, %s, %s);""", (session_key, user_id,
                                       expiration_date))
-        self.d.database_connection.commit()
+        self.d.commit()
+
+        if self.cache is not None:
+            # A key that is rolled back mustn't be cached
+            self.d.after_commit(self.cache.put, session_key, user_id,
+                                expiration_date)
 
         return session_key
 
+    def get_session(self, session_key):
+        """Returns the (user_id, exp_date) of the session key, or None
+        if it doesn't exist. Uses the cache when there is one."""
+        if self.cache is not None:
+            session = self.cache.get(session_key)
+            if session is not None:
+                return session
+
+        self.d.cursor.execute(
+            """SELECT user_id, exp_date FROM sessions
+            WHERE key = %s;""", (session_key,))
+        session = self.d.cursor.fetchone()
+
+        if session is not None and self.cache is not None:
+            # It may have been added in the current transaction
+            self.d.after_commit(self.cache.put, session_key, *session)
+
+        return session
+
     def verify_session_key(self, user_id, session_key):
         """Checks whether the session key is correct and valid for the
         user. Returns whether it is."""
-        self.d.cursor.execute(
-            """SELECT user_id FROM sessions
-            WHERE key = %s
-            AND exp_date > %s
-            AND user_id = %s;""",
-            (session_key, datetime.datetime.now(), user_id))
+        session = self.get_session(session_key)
 
-        # fetchone() returns None if no matchin entry is found (ie
-        # when the key is invalid).
-        return self.d.cursor.fetchone() is not None
+        # session is None if no matching entry is found (ie when the
+        # key is invalid).
+        return session is not None and\
+            session[0] == user_id and\
+            session[1] > datetime.datetime.now()
 
     def renew_session_key(self, user_id, session_key,
                           livespan=datetime.timedelta(weeks=1)):
         """Renews the given session key for the user. The key will
         expire one week after calling this function if it isn't
-        renewed in the mean time."""
+        renewed in the mean time.
+
+        With a cache, the renewal is only written when the stored
+        expiration date is older than the renew interval of the
+        cache."""
+        expiration_date = datetime.datetime.now() + livespan
+        if self.cache is not None and\
+           not self.cache.needs_renewal(session_key, expiration_date):
+            return
+
         self.d.cursor.execute(
             """UPDATE sessions
             SET exp_date = %s
             WHERE user_id = %s
             AND key = %s;""",
-            (datetime.datetime.now() + livespan,
-             user_id, session_key))
+            (expiration_date, user_id, session_key))
+        renewed = self.d.cursor.rowcount > 0
+
+        self.d.commit()
 
-        self.d.database_connection.commit()
+        if self.cache is not None:
+            if renewed:
+                self.d.after_commit(self.cache.put, session_key, user_id,
+                                    expiration_date)
+            else:
+                # The key has been removed in the mean time
+                self.cache.invalidate(session_key)
 
     def remove_expired_keys(self, user_id):
         """Removes all expired session keys for this user from the
@@ -418,27 +753,216 @@ class SessionDatabase:
             AND exp_date < %s;""", (user_id,
                                     datetime.datetime.now()))
 
-        self.d.database_connection.commit()
+        self.d.commit()
 
-    def get_user_id_by_sessionkey(self, session_key):
-        """Returns the user_id associated with this session key"""
+    def remove_expired_sessions(self, batch_size=1000):
+        """Removes at most `batch_size` expired session keys of any user
+        from the sessions database and returns how many were removed.
+        Keeping the batches small keeps the locks short."""
         self.d.cursor.execute(
-            """SELECT user_id FROM sessions
-            WHERE key = %s;""", (session_key,))
+            """DELETE FROM sessions
+            WHERE key IN (SELECT key FROM sessions
+                          WHERE exp_date < %s
+                          LIMIT %s);""",
+            (datetime.datetime.now(), batch_size))
+        removed = self.d.cursor.rowcount
+        self.d.commit()
+        return removed
+
+    def get_sessions_size(self):
+        """Returns the (estimated number of rows, bytes on disk
+        including indexes) of the sessions table."""
+        self.d.cursor.execute(
+            """SELECT reltuples::BIGINT,
+            pg_total_relation_size(oid)
+            FROM pg_class
+            WHERE oid = 'sessions'::regclass;""")
+        (rows, size) = self.d.cursor.fetchone()
+        # Never analyzed tables have -1 (or 0) rows
+        return (max(rows, 0), size)
 
-        saved_id_tuple = self.d.cursor.fetchone()
-        if saved_id_tuple is None:
+    def get_user_id_by_sessionkey(self, session_key):
+        """Returns the user_id associated with this session key"""
+        session = self.get_session(session_key)
+        if session is None:
             return None
 
-        return saved_id_tuple[0]
+        return session[0]
 
     def remove_session_key(self, session_key):
         """Removes the provided session key from the session key"""
+        if self.cache is not None:
+            self.cache.invalidate(session_key)
+
         self.d.cursor.execute(
             """DELETE FROM sessions
             WHERE key = %s;""", (session_key,))
 
-        self.d.database_connection.commit()
+        self.d.commit()
+
+
+class SignedSessionDatabase:
+    """
+    Session backend with the interface of SessionDatabase, whose session
+    keys are tokens signed with an HMAC of `secret`, that carry the user
+    id and expiration date themselves. Verifying them needs no database
+    query.
+
+    A token is valid until the expiration date it was issued with, it
+    can't be renewed. Logging out revokes it: its nonce is kept in the
+    revoked_sessions table until it expires, and in memory. Revocations
+    by other server processes are read from the table by `refresh`.
+    """
+    def __init__(self, database, secret):
+        if not secret:
+            raise ValueError('Signed sessions need a secret')
+        self.d = database
+        self.secret = secret
+
+        # Maps the nonces of revoked tokens to their expiration date
+        self.revoked = {}
+        self.lock = threading.Lock()
+
+    def sign(self, payload):
+        return hmac.new(self.secret, payload, hashlib.sha256).hexdigest()
+
+    def parse(self, session_key):
+        """Returns the (user_id, exp_date, nonce) of a correctly signed
+        token, or None."""
+        if not isinstance(session_key, basestring):
+            return None
+        parts = session_key.encode('utf-8').split('.')
+        if len(parts) != 4 or not parts[0].isdigit() or\
+           not parts[1].isdigit():
+            return None
+        (user_id, expires, nonce, signature) = parts
+        if not hmac.compare_digest(
+                self.sign('.'.join([user_id, expires, nonce])), signature):
+            return None
+        return (int(user_id), datetime.datetime.fromtimestamp(int(expires)),
+                nonce)
+
+    def generate_session_key(self, user_id,
+                             livespan=datetime.timedelta(weeks=1)):
+        """Returns a new token for the user, the user should already be
+        verified for this. It is valid for `livespan`."""
+        udb = UserDatabase(self.d)
+        if not udb.does_user_exist(user_id):
+            raise UserDoesNotExistError('id', user_id)
+
+        nonce = ''.join(random.SystemRandom()
+                        .choice(string.ascii_letters + string.digits)
+                        for _ in range(16))
+        expires = int(time.time() + livespan.total_seconds())
+        payload = '{}.{}.{}'.format(user_id, expires, nonce)
+        return payload + '.' + self.sign(payload)
+
+    def get_session(self, session_key):
+        """Returns the (user_id, exp_date) of the token, or None if it
+        isn't correctly signed or was revoked."""
+        session = self.parse(session_key)
+        if session is None or session[2] in self.revoked:
+            return None
+        return session[:2]
+
+    def verify_session_key(self, user_id, session_key):
+        """Checks whether the token is valid for the user. Returns
+        whether it is."""
+        session = self.get_session(session_key)
+        return session is not None and\
+            session[0] == user_id and\
+            session[1] > datetime.datetime.now()
+
+    def renew_session_key(self, user_id, session_key,
+                          livespan=datetime.timedelta(weeks=1)):
+        """Tokens can't be renewed, they stay valid until the expiration
+        date they carry."""
+        pass
+
+    def get_user_id_by_sessionkey(self, session_key):
+        """Returns the user_id in the token"""
+        session = self.get_session(session_key)
+        if session is None:
+            return None
+
+        return session[0]
+
+    def remove_session_key(self, session_key):
+        """Revokes the token until it expires."""
+        session = self.parse(session_key)
+        if session is None:
+            return
+        (_, exp_date, nonce) = session
+
+        with self.lock:
+            self.revoked[nonce] = exp_date
+        self.d.cursor.execute(
+            """INSERT INTO revoked_sessions (nonce, exp_date)
+            VALUES (%s, %s)
+            ON CONFLICT (nonce) DO NOTHING;""", (nonce, exp_date))
+        self.d.commit()
+
+    def refresh(self):
+        """Reads the revocations of all server processes from the
+        revoked_sessions table, and forgets those of expired tokens."""
+        now = datetime.datetime.now()
+        self.d.cursor.execute(
+            """SELECT nonce, exp_date FROM revoked_sessions
+            WHERE exp_date > %s;""", (now,))
+        revocations = self.d.cursor.fetchall()
+        self.d.commit()
+        with self.lock:
+            self.revoked = self.unexpired(now)
+            self.revoked.update(revocations)
+
+    def unexpired(self, now):
+        """Returns the revocations of tokens that haven't expired yet.
+        Called with the lock held."""
+        return dict((nonce, exp_date)
+                    for (nonce, exp_date) in self.revoked.iteritems()
+                    if exp_date > now)
+
+    def watch(self, interval):
+        """Refreshes the revocations every interval seconds, in a daemon
+        thread."""
+        def refresh_forever():
+            while True:
+                time.sleep(interval)
+                try:
+                    with self.d.connection():
+                        self.refresh()
+                except Exception as e:
+                    print 'Reading revoked sessions failed: {}'.format(e)
+        thread = threading.Thread(target=refresh_forever)
+        thread.daemon = True
+        thread.start()
+
+    def remove_expired_sessions(self, batch_size=1000):
+        """Forgets at most `batch_size` revocations of expired tokens,
+        which aren't valid anymore anyway, and returns how many were
+        removed from the revoked_sessions table."""
+        now = datetime.datetime.now()
+        with self.lock:
+            self.revoked = self.unexpired(now)
+        self.d.cursor.execute(
+            """DELETE FROM revoked_sessions
+            WHERE nonce IN (SELECT nonce FROM revoked_sessions
+                            WHERE exp_date < %s
+                            LIMIT %s);""", (now, batch_size))
+        removed = self.d.cursor.rowcount
+        self.d.commit()
+        return removed
+
+    def get_sessions_size(self):
+        """Returns the (estimated number of rows, bytes on disk
+        including indexes) of the revoked_sessions table."""
+        self.d.cursor.execute(
+            """SELECT reltuples::BIGINT,
+            pg_total_relation_size(oid)
+            FROM pg_class
+            WHERE oid = 'revoked_sessions'::regclass;""")
+        (rows, size) = self.d.cursor.fetchone()
+        return (max(rows, 0), size)
 
 
 class HealthDatabase:
@@ -455,33 +979,47 @@ class HealthDatabase:
 
         Raises an UserDoesNotExistError if no user exists with the
         user_id."""
-        udb = UserDatabase(self.d)
-        if not udb.does_user_exist(user_id):
-            raise UserDoesNotExistError('id', user_id)
+        self.add_health_data_bulk(
+            user_id, [(date, resting_heart_rate, weight, comment)])
 
-        # get_healt_data returns None if no entry exist
-        already_exists = self.get_health_data(user_id, date) is not None
+    def add_health_data_bulk(self, user_id, health_data):
+        """Adds the health_data entries in the list `health_data`, in
+        the form [(date, resting_heart_rate, weight, comment)], for the
+        user with a single statement. Existing entries of the user on
+        the same dates are updated instead. When the list contains
+        multiple entries for one date, the last one is used.
 
-        if already_exists:
-            # Update the current entry
-            self.d.cursor.execute(
-                """UPDATE health_data
-                SET resting_heart_rate = %s,
-                weight = %s,
-                comment = %s
-                WHERE user_id = %s
-                AND date = %s;""",
-                (resting_heart_rate, weight,
-                 comment, user_id, date))
-        else:
-            # Insert a new entry
-            self.d.cursor.execute(
+        Raises an UserDoesNotExistError if no user exists with the
+        user_id."""
+        # One statement can't insert and update the same entry, so only
+        # the last entry for every date is kept
+        entries = collections.OrderedDict()
+        for (date, resting_heart_rate, weight, comment) in health_data:
+            entries.pop(date, None)
+            entries[date] = (user_id, date, resting_heart_rate,
+                             weight, comment)
+        if not entries:
+            return
+
+        try:
+            psycopg2.extras.execute_values(
+                self.d.cursor,
                 """INSERT INTO health_data
                 (user_id, date, resting_heart_rate, weight, comment)
-                VALUES (%s, %s, %s, %s, %s);""",
-                (user_id, date, resting_heart_rate, weight, comment))
-
-        self.d.database_connection.commit()
+                VALUES %s
+                ON CONFLICT (user_id, date) DO UPDATE
+                SET resting_heart_rate = EXCLUDED.resting_heart_rate,
+                weight = EXCLUDED.weight,
+                comment = EXCLUDED.comment;""",
+                entries.values(), page_size=len(entries))
+        except psycopg2.IntegrityError as e:
+            self.d.rollback()
+            # The user_id doesn't reference an existing user
+            if e.pgcode == psycopg2.errorcodes.FOREIGN_KEY_VIOLATION:
+                raise UserDoesNotExistError('id', user_id)
+            raise
+
+        self.d.commit()
 
     def get_health_data(self, user_id, date):
         """Returns the (resting_heart_rate, weight, comment) for the given
@@ -510,6 +1048,30 @@ class HealthDatabase:
 
         return self.d.cursor.fetchall()
 
+    def get_team_health_data(self, team_id,
+                             time=datetime.timedelta(days=7)):
+        """Returns a list of (user_id, email, date, resting_heart_rate,
+        weight, comment) tuples for all entries of the members of the
+        team with `team_id` who aren't a coach, that have a date less
+        than `time` ago, ordered by user and date.
+
+        Members without any entries in this period are included once,
+        with None for all health data values."""
+        self.d.cursor.execute(
+            """SELECT users.id, users.email, health_data.date,
+            health_data.resting_heart_rate, health_data.weight,
+            health_data.comment
+            FROM users
+            LEFT JOIN health_data
+            ON health_data.user_id = users.id
+            AND health_data.date >= %s
+            WHERE users.team_id = %s
+            AND users.coach IS NOT TRUE
+            ORDER BY users.id, health_data.date ASC;""",
+            (datetime.date.today() - time, team_id))
+
+        return self.d.cursor.fetchall()
+
 
 class TrainingDatabase:
     def __init__(self, database):
@@ -526,23 +1088,54 @@ class TrainingDatabase:
         if not udb.does_user_exist(user_id):
             raise UserDoesNotExistError('id', user_id)
 
-        # Find the max training id, so we can choose one that is one
-        # higher
-        self.d.cursor.execute(
-            """SELECT MAX(id) FROM training_data;""")
-        (max_training_id,) = self.d.cursor.fetchone()
-        if max_training_id is None:
-            max_training_id = 0
-        training_id = max_training_id + 1
-
         self.d.cursor.execute(
             """INSERT INTO training_data
-            (id, user_id, time, type_is_ed, comment)
-            VALUES (%s, %s, %s, %s, %s);""",
-            (training_id, user_id, time,
-             type_is_ed, comment))
+            (user_id, time, type_is_ed, comment)
+            VALUES (%s, %s, %s, %s)
+            RETURNING id;""",
+            (user_id, time, type_is_ed, comment))
+        (training_id,) = self.d.cursor.fetchone()
+
+        self.d.commit()
+
+        return training_id
+
+    def add_training_with_intervals(self, user_id, time, type_is_ed,
+                                    comment, interval_list):
+        """Adds an training entry together with all of its intervals,
+        given as [(duration, power, pace, rest)], in a single
+        transaction. If pace is 0 it will be stored as NULL. Either
+        everything is added, or nothing is. Returns the training_id
+
+        Raises an UserDoesNotExistError if no user exists with the
+        user_id."""
+        udb = UserDatabase(self.d)
+        if not udb.does_user_exist(user_id):
+            raise UserDoesNotExistError('id', user_id)
 
-        self.d.database_connection.commit()
+        try:
+            self.d.cursor.execute(
+                """INSERT INTO training_data
+                (user_id, time, type_is_ed, comment)
+                VALUES (%s, %s, %s, %s)
+                RETURNING id;""",
+                (user_id, time, type_is_ed, comment))
+            (training_id,) = self.d.cursor.fetchone()
+
+            # All intervals are inserted with one multi-row statement
+            if interval_list:
+                psycopg2.extras.execute_values(
+                    self.d.cursor,
+                    """INSERT INTO interval_data
+                    (training_id, duration, power, pace, rest)
+                    VALUES %s;""",
+                    [(training_id, duration, power, pace or None, rest)
+                     for (duration, power, pace, rest) in interval_list])
+        except Exception:
+            self.d.rollback()
+            raise
+
+        self.d.commit()
 
         return training_id
 
@@ -563,6 +1156,75 @@ class TrainingDatabase:
 
         return self.d.cursor.fetchall()
 
+    def get_team_training_data(self, team_id,
+                               time=datetime.timedelta(days=7)):
+        """Returns the training data with interval data of all members
+        of the team with `team_id` who aren't a coach, for all trainings
+        that have a date less than `time` ago, in the form
+        [(email, [(time, type_is_ed, comment,
+                   [(duration, power, pace, rest)])])]
+
+        Members without any trainings are included with an empty
+        list. All data is fetched with a single query."""
+        return [(email, list(trainings))
+                for (email, trainings) in self.iter_team_training_data(
+                    team_id, time, self.d.cursor)]
+
+    def iter_team_training_data(self, team_id,
+                                time=datetime.timedelta(days=7),
+                                cursor=None):
+        """Returns the same training data as get_team_training_data, but
+        as an iterator over the members, with an iterator over the
+        trainings of each, which read the rows of the query from
+        `cursor` while they are consumed. That is a server side cursor,
+        see Database.server_cursor, unless given.
+
+        The iterators share the rows, so they have to be consumed in
+        order: the trainings of a member before the next member."""
+        if cursor is None:
+            cursor = self.d.server_cursor()
+        cursor.execute(
+            """SELECT users.id, users.email,
+            training_data.id, training_data.time,
+            training_data.type_is_ed, training_data.comment,
+            interval_data.duration, interval_data.power,
+            interval_data.pace, interval_data.rest
+            FROM users
+            LEFT JOIN training_data
+            ON training_data.user_id = users.id
+            AND training_data.time >= %s
+            LEFT JOIN interval_data
+            ON interval_data.training_id = training_data.id
+            WHERE users.team_id = %s
+            AND users.coach IS NOT TRUE
+            ORDER BY users.id, training_data.time, training_data.id,
+            interval_data.ctid;""",
+            (datetime.datetime.now() - time, team_id))
+
+        def members(rows):
+            for (_, member_rows) in itertools.groupby(
+                    rows, lambda row: row[0]):
+                first = next(member_rows)
+                yield (first[1],
+                       trainings(itertools.chain([first], member_rows)))
+
+        def trainings(rows):
+            for (training_id, training_rows) in itertools.groupby(
+                    rows, lambda row: row[2]):
+                # The user has no trainings in this period
+                if training_id is None:
+                    continue
+                first = next(training_rows)
+                (training_time, type_is_ed, comment) = first[3:6]
+                # duration is never NULL, so a row without it is a
+                # training without intervals
+                yield (training_time, type_is_ed, comment,
+                       [tuple(row[6:])
+                        for row in itertools.chain([first], training_rows)
+                        if row[6] is not None])
+
+        return members(cursor)
+
     def does_training_exist(self, training_id):
         """"Checks if an training exists with the given training_id."""
         self.d.cursor.execute(
@@ -584,7 +1246,7 @@ class TrainingDatabase:
             """DELETE FROM training_data
             WHERE training_id = %s;""", (training_id,))
 
-        self.d.database_connection.commit()
+        self.d.commit()
 
 
 class IntervalDatabase:
@@ -609,7 +1271,7 @@ class IntervalDatabase:
             VALUES (%s, %s, %s, %s, %s);""",
             (training_id, duration, power, pace, rest))
 
-        self.d.database_connection.commit()
+        self.d.commit()
 
     def get_training_interval_data(self, training_id):
         """Returns a list of (duration, power, pace, rest)
@@ -0,0 +1,578 @@
+"""
+Event driven front end of the server, used with mode = events in the
+[server] section of crw.cfg.
+
+All connections are handled by one asyncore event loop, so an idle
+keep-alive connection costs a socket and its buffers instead of a
+thread. Static files are sent by the event loop from the asset cache,
+JSON-RPC requests are invoked on a pool of worker threads, which hand
+their responses back to the event loop. With HTTPS and the redirector
+enabled, requests on the HTTP port are redirected by the same loop (see
+http_redirector.py).
+"""
+import asynchat
+import asyncore
+import collections
+import email.utils
+import errno
+import mimetools
+import os
+import select
+import socket
+import ssl
+import sys
+import time
+from BaseHTTPServer import BaseHTTPRequestHandler
+from cStringIO import StringIO
+from multiprocessing.pool import ThreadPool
+import crw
+import http_server
+
+# Longest request line and headers accepted, in bytes
+MAX_HEADER_SIZE = 65536
+
+
+class EventServer(object):
+    """
+    Runs the event loop of the listening sockets and connections, and
+    invokes JSON-RPC requests on `workers` threads, if any.
+    """
+    # Seconds a connection may be idle before it is closed
+    timeout = 5
+    # Seconds a client may take to send a whole request, however slowly
+    # it keeps sending
+    request_timeout = 30
+    # Seconds a response may wait for the client to read any of it
+    send_timeout = 30
+    # Number of requests handled on a connection before it is closed
+    max_requests = 100
+
+    def __init__(self, workers):
+        self.socket_map = SocketMap()
+        self.pool = ThreadPool(workers) if workers > 0 else None
+        # (channel, response, keep_alive) of invoked requests, to be
+        # sent by the event loop
+        self.completed = collections.deque()
+        self.trigger = Trigger(self)
+
+    def listen(self, address, channel_class, ssl_context=None):
+        """Accepts connections on address, which are handled by a
+        channel_class, over TLS if an SSLContext is given. Returns the
+        listening dispatcher."""
+        return Listener(self, address, channel_class, ssl_context)
+
+    def serve_forever(self):
+        """
+        Runs the event loop. Unlike asyncore.loop, which asks every
+        dispatcher whether it is readable or writable on every iteration,
+        the sockets stay registered with epoll (or poll), and only the
+        interest of dispatchers that handled an event or were sent a
+        response is updated. Idle connections cost next to nothing.
+        """
+        poller = Poller()
+        # Maps file descriptors to their (dispatcher, event mask)
+        registered = {}
+        next_sweep = time.time() + 1
+        while True:
+            changed = self.socket_map.changed
+            self.socket_map.changed = set()
+            for fd in changed:
+                dispatcher = self.socket_map.get(fd)
+                (current, mask) = registered.pop(fd, (None, None))
+                if current is not None and current is not dispatcher:
+                    # Closed, possibly followed by a new socket with the
+                    # same file descriptor
+                    poller.unregister(fd)
+                    mask = None
+                if dispatcher is None:
+                    continue
+                new_mask = event_mask(dispatcher)
+                if mask is None:
+                    poller.register(fd, new_mask)
+                elif new_mask != mask:
+                    poller.modify(fd, new_mask)
+                registered[fd] = (dispatcher, new_mask)
+
+            for (fd, flags) in poller.poll(1):
+                dispatcher = self.socket_map.get(fd)
+                if dispatcher is not None:
+                    asyncore.readwrite(dispatcher, flags)
+                    self.socket_map.changed.add(fd)
+
+            if time.time() >= next_sweep:
+                self.close_idle_channels()
+                self.resume_listeners()
+                next_sweep = time.time() + 1
+
+    def close_idle_channels(self):
+        """Closes connections that didn't send or receive anything for
+        `timeout` seconds while no response was pending, and those still
+        sending a request after `request_timeout` seconds, and those
+        whose client didn't read any of the pending responses for
+        `send_timeout` seconds."""
+        now = time.time()
+        for channel in self.socket_map.values():
+            if not isinstance(channel, HttpChannel):
+                continue
+            if channel.idle and channel.last_activity < now - self.timeout:
+                channel.close()
+            elif channel.request_started is not None and \
+                    channel.request_started < now - self.request_timeout:
+                channel.close()
+            elif channel.producer_fifo and \
+                    channel.last_sent < now - self.send_timeout:
+                channel.close()
+
+    def resume_listeners(self):
+        """Polls the listening sockets that stopped accepting
+        connections again once their pause is over."""
+        now = time.time()
+        for listener in self.socket_map.values():
+            if isinstance(listener, Listener) and \
+                    0 < listener.paused_until <= now:
+                listener.paused_until = 0
+                self.socket_map.changed.add(listener._fileno)
+
+    def invoke(self, channel, request, keep_alive):
+        """Invokes a JSON-RPC request on a worker thread and sends the
+        response on channel from the event loop."""
+        def invoke_request():
+            try:
+                response = http_server.rpc_response(request,
+                                                    channel.address)
+            except Exception:
+                response = (500, [('Content-Length', 0)], '')
+            self.completed.append((channel, response, keep_alive))
+            self.trigger.pull()
+        self.pool.apply_async(invoke_request)
+
+    def send_completed(self):
+        """Sends the responses of the invoked requests, called from the
+        event loop."""
+        while self.completed:
+            (channel, (code, headers, body), keep_alive) = \
+                self.completed.popleft()
+            if channel.connected:
+                channel.respond(code, headers, [body], keep_alive)
+                channel.busy = False
+                channel.handle_waiting()
+                self.socket_map.changed.add(channel._fileno)
+
+
+class SocketMap(dict):
+    """The asyncore map of file descriptors to dispatchers, which keeps
+    the file descriptors that were added or removed, or whose
+    dispatchers may want other events, in `changed`."""
+    def __init__(self):
+        dict.__init__(self)
+        self.changed = set()
+
+    def __setitem__(self, fd, dispatcher):
+        dict.__setitem__(self, fd, dispatcher)
+        self.changed.add(fd)
+
+    def __delitem__(self, fd):
+        dict.__delitem__(self, fd)
+        self.changed.add(fd)
+
+
+def event_mask(dispatcher):
+    """Returns the poll events a dispatcher is interested in."""
+    mask = select.POLLERR | select.POLLHUP | select.POLLNVAL
+    if dispatcher.readable():
+        mask |= select.POLLIN | select.POLLPRI
+    # The listening sockets are never written to
+    if dispatcher.writable() and not dispatcher.accepting:
+        mask |= select.POLLOUT
+    return mask
+
+
+class Poller(object):
+    """select.epoll where it is available, select.poll otherwise. They
+    use the same event flags."""
+    def __init__(self):
+        if hasattr(select, 'epoll'):
+            self.poller = select.epoll()
+            self.timeout_unit = 1
+        else:
+            self.poller = select.poll()
+            self.timeout_unit = 1000
+
+    def register(self, fd, mask):
+        self.poller.register(fd, mask)
+
+    def modify(self, fd, mask):
+        self.poller.modify(fd, mask)
+
+    def unregister(self, fd):
+        """Stops polling fd, if it wasn't removed by closing it."""
+        try:
+            self.poller.unregister(fd)
+        except (IOError, KeyError, ValueError):
+            pass
+
+    def poll(self, timeout):
+        """Returns the (fd, events) of the file descriptors that are
+        ready, waiting at most timeout seconds."""
+        try:
+            return self.poller.poll(timeout * self.timeout_unit)
+        except (IOError, select.error), e:
+            if e.args[0] == errno.EINTR:
+                return []
+            raise
+
+
+class Trigger(asyncore.file_dispatcher):
+    """Wakes up the event loop from another thread, through a pipe."""
+    def __init__(self, server):
+        (self.read_fd, self.write_fd) = os.pipe()
+        asyncore.file_dispatcher.__init__(self, self.read_fd,
+                                          map=server.socket_map)
+        self.server = server
+
+    def pull(self):
+        os.write(self.write_fd, 'x')
+
+    def writable(self):
+        return False
+
+    def handle_read(self):
+        self.recv(4096)
+        self.server.send_completed()
+
+
+class Listener(asyncore.dispatcher):
+    """Accepts connections and hands them to a new channel_class."""
+    accepts_per_event = 64
+    # Seconds no connections are accepted after running out of file
+    # descriptors or memory
+    accept_pause = 1
+    # Errors of accept that last until connections are closed
+    resource_errors = (errno.EMFILE, errno.ENFILE, errno.ENOBUFS,
+                       errno.ENOMEM)
+
+    def __init__(self, server, address, channel_class, ssl_context=None):
+        asyncore.dispatcher.__init__(self, map=server.socket_map)
+        self.server = server
+        self.channel_class = channel_class
+        self.ssl_context = ssl_context
+        self.paused_until = 0
+        self.create_socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.set_reuse_addr()
+        self.bind(address)
+        self.listen(1024)
+
+    def handle_accept(self):
+        # Accept all pending connections at once, instead of one per
+        # iteration of the event loop
+        for _ in range(self.accepts_per_event):
+            try:
+                pair = self.accept()
+            except socket.error, e:
+                if e.args[0] not in self.resource_errors:
+                    raise
+                # The connection stays pending, so the socket would
+                # stay readable and the event loop would spin. Stop
+                # polling it for a while instead
+                self.log_info('accepting connections paused: {}'.format(
+                    os.strerror(e.args[0])), 'error')
+                self.paused_until = time.time() + self.accept_pause
+                return
+            if pair is None:
+                return
+            (sock, address) = pair
+            if self.ssl_context is not None:
+                sock = self.ssl_context.wrap_socket(
+                    sock, server_side=True, do_handshake_on_connect=False)
+            self.channel_class(self.server, sock, address)
+
+    def readable(self):
+        return time.time() >= self.paused_until
+
+    def handle_error(self):
+        # asyncore closes a dispatcher that raised, but the server must
+        # keep accepting connections
+        (_, error_type, error, traceback) = asyncore.compact_traceback()
+        self.log_info('uncaptured python exception, listener kept open '
+                      '({}:{} {})'.format(error_type, error, traceback),
+                      'error')
+
+
+class IteratorProducer(object):
+    """asynchat producer of the chunks of an iterator, which are only
+    produced when the previous ones have been sent."""
+    def __init__(self, iterator):
+        self.iterator = iterator
+
+    def more(self):
+        return next(self.iterator, '')
+
+
+class HttpChannel(asynchat.async_chat):
+    """
+    An HTTP/1.1 connection, serving the same responses as FileServer.
+
+    Requests are handled in the order they arrive: requests that arrive
+    while a JSON-RPC request is being invoked wait for its response.
+    Nothing more is read from a client with `max_pipelined` requests
+    waiting or responses pending, until it reads the responses.
+    """
+    max_pipelined = 16
+
+    def __init__(self, server, sock, address):
+        asynchat.async_chat.__init__(self, sock, map=server.socket_map)
+        self.server = server
+        self.address = address
+        self.set_terminator('\r\n\r\n')
+        self.incoming = []
+        self.incoming_size = 0
+        # When the first data of the request being read arrived
+        self.request_started = None
+        # (command, path, version, headers) of a request whose body is
+        # being read
+        self.request = None
+        self.requests = 0
+        # Requests that arrived while busy
+        self.waiting = collections.deque()
+        self.busy = False
+        # Whether the connection is closed after the current response
+        self.closing = False
+        self.last_activity = time.time()
+        # When data was last sent, or the pending responses were queued
+        self.last_sent = self.last_activity
+        self.handshaking = isinstance(sock, ssl.SSLSocket)
+        self.handshake_wants_write = False
+
+    @property
+    def idle(self):
+        return not self.busy and not self.producer_fifo
+
+    def readable(self):
+        # Every response is queued as two producers
+        if len(self.waiting) + len(self.producer_fifo) / 2 >= \
+                self.max_pipelined:
+            return False
+        return not self.handshake_wants_write and \
+            asynchat.async_chat.readable(self)
+
+    def writable(self):
+        if self.handshaking:
+            return self.handshake_wants_write
+        return asynchat.async_chat.writable(self)
+
+    def handle_read(self):
+        if self.handshaking:
+            self.do_handshake()
+        else:
+            asynchat.async_chat.handle_read(self)
+
+    def handle_write(self):
+        if self.handshaking:
+            self.do_handshake()
+        else:
+            asynchat.async_chat.handle_write(self)
+
+    def do_handshake(self):
+        """Continues the TLS handshake as far as possible without
+        blocking."""
+        try:
+            self.socket.do_handshake()
+        except ssl.SSLWantReadError:
+            self.handshake_wants_write = False
+            return
+        except ssl.SSLWantWriteError:
+            self.handshake_wants_write = True
+            return
+        self.handshaking = False
+        self.handshake_wants_write = False
+        self.last_activity = time.time()
+
+    def recv(self, buffer_size):
+        try:
+            data = asynchat.async_chat.recv(self, buffer_size)
+            # Data OpenSSL already decrypted doesn't make the socket
+            # readable again, so it has to be read now
+            while data and isinstance(self.socket, ssl.SSLSocket) and \
+                    self.socket.pending():
+                data += self.socket.recv(self.socket.pending())
+            return data
+        except (ssl.SSLWantReadError, ssl.SSLWantWriteError):
+            return ''
+
+    def send(self, data):
+        try:
+            sent = asynchat.async_chat.send(self, data)
+        except (ssl.SSLWantReadError, ssl.SSLWantWriteError):
+            return 0
+        if sent:
+            self.last_sent = time.time()
+        return sent
+
+    def initiate_send(self):
+        asynchat.async_chat.initiate_send(self)
+        self.last_activity = time.time()
+
+    def close(self):
+        if isinstance(self.socket, ssl.SSLSocket) and not self.handshaking:
+            # Send a close_notify, so the client can resume the session
+            try:
+                self.socket.unwrap()
+            except (socket.error, ValueError):
+                pass
+        asynchat.async_chat.close(self)
+
+    def handle_error(self):
+        (error_type, error, _) = sys.exc_info()
+        if issubclass(error_type, socket.error):
+            # The client went away or broke the TLS connection
+            self.close()
+        else:
+            asynchat.async_chat.handle_error(self)
+
+    def collect_incoming_data(self, data):
+        self.last_activity = time.time()
+        if self.closing:
+            # Ignore anything the client sends after its last request
+            return
+        if self.request_started is None:
+            self.request_started = self.last_activity
+        self.incoming.append(data)
+        self.incoming_size += len(data)
+        if self.request is None and self.incoming_size > MAX_HEADER_SIZE:
+            self.respond(400, [('Content-Length', 0)], [], False)
+
+    def found_terminator(self):
+        data = ''.join(self.incoming)
+        self.incoming = []
+        self.incoming_size = 0
+        request_started = self.request_started
+        self.request_started = None
+
+        if self.request is not None:
+            # The body of a request has been read
+            (command, path, version, headers) = self.request
+            self.request = None
+            self.set_terminator('\r\n\r\n')
+            self.handle_request(command, path, version, headers, data)
+            return
+
+        (request_line, _, header_lines) = \
+            data.lstrip('\r\n').partition('\r\n')
+        words = request_line.split()
+        if len(words) != 3 or not words[2].startswith('HTTP/'):
+            self.respond(400, [('Content-Length', 0)], [], False)
+            return
+        (command, path, version) = words
+        headers = mimetools.Message(StringIO(header_lines + '\r\n\r\n'), 0)
+
+        length = headers.getheader('content-length')
+        if command == 'POST' and length is None:
+            self.handle_request(command, path, version, headers, None)
+        elif length is not None and length.strip() != '0':
+            try:
+                self.set_terminator(int(length))
+            except ValueError:
+                self.respond(400, [('Content-Length', 0)], [], False)
+                return
+            self.request = (command, path, version, headers)
+            # The body has to arrive before the same deadline
+            self.request_started = request_started
+        else:
+            self.handle_request(command, path, version, headers, '')
+
+    def keep_alive(self, version, headers):
+        """Returns whether the connection can be kept open after the
+        response to a request."""
+        connection = headers.getheader('connection', '').lower()
+        if self.requests >= self.server.max_requests:
+            return False
+        if version == 'HTTP/1.0':
+            return connection == 'keep-alive'
+        return connection != 'close'
+
+    def handle_request(self, command, path, version, headers, body):
+        """Responds to a request, or queues it when a response to an
+        earlier request is pending."""
+        if self.closing:
+            return
+        if self.busy:
+            self.waiting.append((command, path, version, headers, body))
+            return
+        self.requests += 1
+        keep_alive = self.keep_alive(version, headers)
+
+        if command in ('GET', 'HEAD'):
+            (code, response_headers, chunks) = \
+                http_server.static_response(path, headers)
+            self.respond(code, response_headers,
+                         chunks if command == 'GET' else [], keep_alive)
+        elif command == 'POST' and path == '/rpc':
+            if body is None:
+                self.respond(411, [('Content-Length', 0)], [], False)
+            else:
+                self.busy = True
+                self.server.invoke(self, body, keep_alive)
+        elif command == 'POST':
+            self.respond(404, [('Content-Length', 0)], [], keep_alive)
+        else:
+            self.respond(501, [('Content-Length', 0)], [], False)
+        self.log_request(command, path, version)
+
+    def handle_waiting(self):
+        """Handles the requests that arrived while busy."""
+        while self.waiting and not self.busy:
+            self.handle_request(*self.waiting.popleft())
+
+    def respond(self, code, headers, chunks, keep_alive):
+        """Sends a response with the body in chunks, and closes the
+        connection afterwards unless keep_alive."""
+        lines = [
+            'HTTP/1.1 {} {}'.format(
+                code, BaseHTTPRequestHandler.responses[code][0]
+                if code in BaseHTTPRequestHandler.responses else ''),
+            'Server: {}'.format(http_server.FileServer.server_version),
+            'Date: {}'.format(email.utils.formatdate(usegmt=True)),
+        ]
+        lines += ['{}: {}'.format(keyword, value)
+                  for (keyword, value) in headers]
+        if not keep_alive:
+            lines.append('Connection: close')
+        if not self.producer_fifo:
+            self.last_sent = time.time()
+        self.push('\r\n'.join(lines) + '\r\n\r\n')
+        self.push_with_producer(IteratorProducer(iter(chunks)))
+        if not keep_alive:
+            self.close_when_done()
+            self.closing = True
+            self.waiting.clear()
+            self.incoming = []
+            self.set_terminator(None)
+
+    def log_request(self, command, path, version):
+        sys.stderr.write('{} - - [{}] "{} {} {}"\n'.format(
+            self.address[0], time.strftime('%d/%b/%Y %H:%M:%S'),
+            command, path, version))
+
+
+def serve():
+    http_server.setup()
+    EventServer.timeout = crw.KEEPALIVE_TIMEOUT
+    EventServer.request_timeout = crw.REQUEST_TIMEOUT
+    EventServer.max_requests = crw.KEEPALIVE_REQUESTS
+    server = EventServer(max(crw.SERVER_WORKERS, 1))
+    if crw.USE_HTTPS:
+        ssl_context = http_server.create_ssl_context(
+            crw.HTTPS_CERT, crw.HTTPS_KEY, crw.HTTPS_CIPHERS,
+            crw.HTTPS_SESSION_TICKETS)
+        server.listen((crw.HOST, crw.HTTPS_PORT), HttpChannel, ssl_context)
+        if crw.USE_REDIRECTOR:
+            # Imported here, as it imports this module
+            import http_redirector
+            http_redirector.listen(server)
+    else:
+        server.listen((crw.HOST, crw.PORT), HttpChannel)
+    print 'Serving with an event loop'
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
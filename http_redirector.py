@@ -1,5 +1,5 @@
 #
-# This script written by Eli Fulkerson.
+# Based on a script written by Eli Fulkerson.
 # http://www.elifulkerson.com for more.
 #
 # Taken from
@@ -9,69 +9,50 @@
 # This script needs to run at the same time as crw.py, to redirect all
 # HTTP traffic to HTTPS
 
-from socket import *
-from select import *
-
+import cgi
+import crw
+import event_server
 from crw import USE_REDIRECTOR, HOST, PORT, REDIRECT_TARGET as TARGET
 
 
-class Connection:
-    """
-    An accepted connection.
-    """
-    def __init__(self, socket, address):
-        self.socket = socket
-        self.ip = address[0]
-
-    def sendline(self, data):
-        self.socket.send(data + "\r\n")
-
-    def fileno(self):
-        return self.socket.fileno()
+def redirect_location(path):
+    """Returns the URL on the HTTPS server to redirect a request for path
+    to. Anything but a path, like '@other.host/' or '//other.host/',
+    could redirect to another host, so it is redirected to / instead."""
+    if not path.startswith('/') or path.startswith('//'):
+        path = '/'
+    return TARGET.strip('\'"').rstrip('/') + path
 
 
-class ConnectionHandler:
-    """
-    Maintains all connections.
+class RedirectChannel(event_server.HttpChannel):
     """
-    def __init__(self):
-        self.listener = socket(AF_INET, SOCK_STREAM)
-        self.listener.setsockopt(SOL_SOCKET, SO_REUSEADDR, 1)
-        self.listener.bind((HOST, PORT))
-        self.listener.listen(32)
-        print ("HTTP 302 Redirector is active and listening on port " +
-               repr(PORT) + ".")
+    An HTTP connection that redirects every request to the same path on
+    the HTTPS server.
 
-    def run(self):
-        """Listen for incoming connections on PORT.  When a connection is
-        recieved, send a 302 redirect and then close the socket.
-
-        """
-        # Accept an incoming connection.
-        conn = select([self.listener], [], [], 0.1)[0]
-
-        if conn:
-            socket, address = self.listener.accept()
-            conn = Connection(socket, address)
-
-            # burn some time so that the client and server don't have
-            # a timing error
-            trash = conn.socket.recv(1024)
-
-            # send our https redirect
-            conn.sendline("HTTP/1.1 302 Encryption Required")
-            conn.sendline("Location: " + TARGET)
-            conn.sendline("Connection: close")
-            conn.sendline("Cache-control: private")
-            conn.sendline("")
-            conn.sendline("<html><body>Encryption Required." +
-                          "  Please go to <a href='" +
-                          TARGET + "'>" + TARGET +
-                          "</a> for this service.</body></html>")
-            conn.sendline("")
-
-            # kick em out
-            conn.socket.close
+    Being a channel of an event loop, a client that connects and sends
+    nothing, or sends its request slowly, doesn't hold up any other
+    client. It is closed after the timeouts of the EventServer.
+    """
+    def handle_request(self, command, path, version, headers, body):
+        if self.closing:
+            return
+        self.requests += 1
+        location = redirect_location(path)
+        body = '<html><body>Encryption Required. Please go to ' \
+            '<a href="{0}">{0}</a> for this service.</body></html>'\
+            .format(cgi.escape(location, True))
+        self.respond(302,
+                     [('Location', location),
+                      ('Cache-control', 'private'),
+                      ('Content-type', 'text/html'),
+                      ('Content-Length', len(body))],
+                     [body] if command != 'HEAD' else [],
+                     self.keep_alive(version, headers))
+
+
+def listen(server):
+    """Redirects the requests on the HTTP port with an EventServer."""
+    server.listen((HOST, PORT), RedirectChannel)
 
 
 def serve():
@@ -79,7 +60,12 @@ def serve():
         print 'HTTPS redirector disabled in configuration.'
         return
 
-    print 'HTTPS redirector running'
-    connections = ConnectionHandler()
-    while 1:
-        connections.run()
+    # Redirects don't invoke anything, so no worker threads are needed
+    server = event_server.EventServer(0)
+    server.timeout = crw.KEEPALIVE_TIMEOUT
+    server.request_timeout = crw.REQUEST_TIMEOUT
+    server.max_requests = crw.KEEPALIVE_REQUESTS
+    listen(server)
+    print ("HTTP 302 Redirector is active and listening on port " +
+           repr(PORT) + ".")
+    server.serve_forever()
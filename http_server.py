@@ -1,30 +1,46 @@
 from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
-from mimetypes import guess_type
-from posixpath import normpath
-from urlparse import urlparse
-import os.path
+from multiprocessing.pool import ThreadPool
+import cgi
 import errno
+import itertools
+import signal
+import threading
+import Queue
+import socket
 import crw
 from crw_jsonrpc import CrwJsonRpc
+from login_throttle import LoginThrottle
+import passwords
+from passwords import PasswordPool
+from session_cache import SessionCache
+from session_reaper import SessionReaper
+from static_files import \
+    AssetCache, RangeNotSatisfiable, RouteTable, compress_directory, \
+    parse_range
 import database
+import datetime
 import ssl
 
+# Not exported by the ssl module of Python 2
+OP_NO_TICKET = 0x4000
+
 
 def serve():
-    global httpd, database_object, rpc
+    """Serves the requests with the setup made by `setup`, which has to
+    be called first."""
+    global httpd
     port = crw.HTTPS_PORT if crw.USE_HTTPS else crw.PORT
-    httpd = HTTPServer((crw.HOST, port), FileServer)
+    ssl_context = None
     if crw.USE_HTTPS:
-        httpd.socket = ssl.wrap_socket(
-            httpd.socket,
-            server_side=True,
-            # Replace with different paths if needed
-            certfile=crw.HTTPS_CERT,
-            keyfile=crw.HTTPS_KEY)
-    database_object = database.Database(
-        crw.DATABASE_HOST, crw.DATABASE_PORT, crw.DATABASE_NAME,
-        crw.DATABASE_USER, crw.DATABASE_PASS)
-    rpc = CrwJsonRpc(database_object)
+        ssl_context = create_ssl_context(
+            crw.HTTPS_CERT, crw.HTTPS_KEY, crw.HTTPS_CIPHERS,
+            crw.HTTPS_SESSION_TICKETS)
+    httpd = create_server((crw.HOST, port), crw.SERVER_WORKERS, ssl_context)
+    FileServer.timeout = crw.KEEPALIVE_TIMEOUT
+    # Without workers, a connection waiting for its next request would
+    # hold up all other clients
+    FileServer.max_requests = \
+        crw.KEEPALIVE_REQUESTS if crw.SERVER_WORKERS > 0 else 1
     try:
         httpd.serve_forever()
     except KeyboardInterrupt:
@@ -32,51 +48,227 @@ def serve():
     httpd.server_close()
 
 
+def setup():
+    """Connects to the database and sets up the JSON-RPC API and the
+    asset cache and route table of the static files, as configured in
+    crw.cfg."""
+    global database_object, rpc, assets, routes, reaper
+    passwords.configure(crw.PASSWORD_ROUNDS)
+    # The password processes are forked before any database connection
+    # is opened, so they don't inherit one, and before this module starts
+    # any thread. Start other threads after setup
+    password_pool = None
+    if crw.PASSWORD_PROCESSES > 0:
+        password_pool = PasswordPool(crw.PASSWORD_PROCESSES,
+                                     crw.PASSWORD_MAX_PENDING)
+    database_object = database.Database(
+        crw.DATABASE_HOST, crw.DATABASE_PORT, crw.DATABASE_NAME,
+        crw.DATABASE_USER, crw.DATABASE_PASS, crw.DATABASE_POOL_SIZE)
+    database_object.password_pool = password_pool
+    # Rehashing passwords after a login, see UserDatabase.verify_user
+    database_object.deferred_pool = ThreadPool(1)
+    if crw.SESSION_BACKEND == 'signed':
+        sessions = database.SignedSessionDatabase(database_object,
+                                                  crw.SESSION_SECRET)
+        with database_object.connection():
+            sessions.refresh()
+        if crw.SESSION_CACHE_TTL > 0:
+            sessions.watch(crw.SESSION_CACHE_TTL)
+    elif crw.SESSION_BACKEND == 'table':
+        session_cache = None
+        if crw.SESSION_CACHE_SIZE > 0:
+            session_cache = SessionCache(
+                crw.SESSION_CACHE_SIZE,
+                datetime.timedelta(seconds=crw.SESSION_CACHE_TTL),
+                datetime.timedelta(minutes=crw.SESSION_RENEW_INTERVAL))
+        sessions = database.SessionDatabase(database_object, session_cache)
+    else:
+        raise ValueError('Unknown session backend {!r}'.format(
+            crw.SESSION_BACKEND))
+    reaper = SessionReaper(database_object, crw.SESSION_REAP_INTERVAL,
+                           crw.SESSION_REAP_BATCH_SIZE,
+                           crw.SESSION_REAP_MAX_BATCHES, sessions)
+    if crw.SESSION_REAP_INTERVAL > 0:
+        reaper.start()
+    rpc = CrwJsonRpc(database_object, sessions=sessions)
+    if crw.LOGIN_EMAIL_BURST > 0:
+        rpc.email_throttle = LoginThrottle(
+            crw.LOGIN_EMAIL_BURST, crw.LOGIN_EMAIL_RATE / 60,
+            crw.LOGIN_BACKOFF, crw.LOGIN_MAX_BACKOFF,
+            crw.LOGIN_THROTTLE_SIZE)
+    if crw.LOGIN_ADDRESS_BURST > 0:
+        rpc.address_throttle = LoginThrottle(
+            crw.LOGIN_ADDRESS_BURST, crw.LOGIN_ADDRESS_RATE / 60,
+            crw.LOGIN_BACKOFF, crw.LOGIN_MAX_BACKOFF,
+            crw.LOGIN_THROTTLE_SIZE)
+    if crw.BATCH_WORKERS > 0:
+        rpc.batch_pool = ThreadPool(crw.BATCH_WORKERS)
+        rpc.batch_concurrency = crw.BATCH_CONCURRENCY
+    if crw.STATIC_COMPRESS:
+        compress_directory('static')
+    assets = AssetCache(crw.STATIC_CACHE_SIZE * 1024 * 1024,
+                        crw.STATIC_STREAM_THRESHOLD * 1024)
+    routes = RouteTable('static')
+    if crw.STATIC_WATCH_INTERVAL > 0:
+        routes.watch(crw.STATIC_WATCH_INTERVAL)
+    # Deploying new static files can be followed by kill -HUP, instead of
+    # waiting for the watcher
+    signal.signal(signal.SIGHUP, lambda signum, frame: routes.refresh())
+
+
+def create_server(address, workers, ssl_context=None):
+    """
+    Returns an HTTP server listening on address, which handles requests
+    with `workers` worker threads, or in the listening thread if that is
+    0. The server uses HTTPS if an SSLContext is given.
+    """
+    if workers > 0:
+        server = PooledHTTPServer(address, FileServer, workers)
+    else:
+        server = HTTPServer(address, FileServer)
+    server.ssl_context = ssl_context
+    return server
+
+
+def create_ssl_context(certfile, keyfile, ciphers, session_tickets=True):
+    """
+    Returns the SSLContext used for all HTTPS connections of the server.
+    The context caches the sessions of clients, so that clients
+    reconnecting with a session ID (or a session ticket when
+    session_tickets is True) skip the full handshake.
+    """
+    context = ssl.create_default_context(ssl.Purpose.CLIENT_AUTH)
+    context.load_cert_chain(certfile, keyfile or None)
+    context.set_ciphers(ciphers)
+    context.options |= ssl.OP_CIPHER_SERVER_PREFERENCE
+    if not session_tickets:
+        context.options |= OP_NO_TICKET
+    return context
+
+
+class PooledHTTPServer(HTTPServer):
+    """
+    HTTPServer that hands every accepted connection to a fixed pool of
+    worker threads, so a slow request doesn't hold up the others.
+    """
+    def __init__(self, server_address, RequestHandlerClass, workers):
+        HTTPServer.__init__(self, server_address, RequestHandlerClass)
+        self.requests = Queue.Queue()
+        for _ in range(workers):
+            worker = threading.Thread(target=self.process_requests)
+            worker.daemon = True
+            worker.start()
+
+    def process_request(self, request, client_address):
+        self.requests.put((request, client_address))
+
+    def process_requests(self):
+        """Handles queued connections, runs in every worker thread."""
+        while True:
+            (request, client_address) = self.requests.get()
+            try:
+                self.finish_request(request, client_address)
+            except Exception:
+                self.handle_error(request, client_address)
+            finally:
+                self.shutdown_request(request)
+
+
 class FileServer(BaseHTTPRequestHandler):
-    redirects = {
-    }
     server_version = "crw/{}".format(crw.VERSION)
+    # Keep connections open for the next request of the client
+    protocol_version = 'HTTP/1.1'
+    # Seconds a connection may be idle before it is closed
+    timeout = 5
+    # Number of requests handled on a connection before it is closed
+    max_requests = 100
+    # Buffer the response, which is flushed after every request, so the
+    # status line, headers and a small body are sent in one packet
+    # instead of waiting for the acknowledgement of the previous one
+    wbufsize = -1
+    disable_nagle_algorithm = True
 
-    def resolve_filename(self, fname):
+    def handle(self):
         """
-        Gives the right filename to be read and sent to the client,
-        based on the request path.
+        Handles requests on the connection until the client closes it, it
+        is idle for `timeout` seconds or `max_requests` requests were
+        handled.
         """
-        path = urlparse(fname).path
-        fname = normpath(path)
-        if os.path.isdir('static' + fname):
-            fname += '/index.html'
-        if fname[0] == '/':
-            fname = fname[1:]
-        return FileServer.redirects[fname] if fname in FileServer.redirects \
-            else fname
+        self.requests = 0
+        BaseHTTPRequestHandler.handle(self)
+
+    def setup(self):
+        if self.server.ssl_context is not None:
+            # The TLS handshake happens here, in the worker thread,
+            # instead of in the listening thread when accepting the
+            # connection
+            self.request.settimeout(self.timeout)
+            self.request = self.server.ssl_context.wrap_socket(
+                self.request, server_side=True)
+        BaseHTTPRequestHandler.setup(self)
+
+    def finish(self):
+        BaseHTTPRequestHandler.finish(self)
+        if self.server.ssl_context is not None:
+            # Without a proper TLS shutdown, OpenSSL removes the session
+            # from its cache and the client can't resume it. Only send
+            # our close_notify, waiting for the one of the client could
+            # take until the timeout
+            try:
+                self.request.setblocking(False)
+                self.request.unwrap()
+            except (socket.error, ssl.SSLError, ValueError):
+                pass
+
+    def send_response(self, code, message=None):
+        BaseHTTPRequestHandler.send_response(self, code, message)
+        self.requests += 1
+        if self.requests >= self.max_requests:
+            self.send_header('Connection', 'close')
+
+    def send_error(self, code, message=None):
+        """
+        Sends an error response like BaseHTTPRequestHandler, but with a
+        Content-Length, so the client doesn't depend on the connection
+        being closed to find the end of the body. It is still closed,
+        as the body of the request may not have been read.
+        """
+        try:
+            (short, explain) = self.responses[code]
+        except KeyError:
+            (short, explain) = ('???', '???')
+        if message is None:
+            message = short
+        self.log_error('code %d, message %s', code, message)
+        content = self.error_message_format % {
+            'code': code,
+            'message': cgi.escape(message),
+            'explain': explain,
+        }
+        self.send_response(code, message)
+        self.send_header('Connection', 'close')
+        self.send_header('Content-Type', self.error_content_type)
+        self.send_header('Content-Length', len(content))
+        self.end_headers()
+        if self.command != 'HEAD':
+            self.wfile.write(content)
 
     def send_file(self, fname, write=True):
         """
-        Reads a file and sends as HTTP response, including the MIME type.
+        Sends a file as HTTP response, see static_response.
         write indicates if the file should actually be sent,
         or only the headers
         """
-        fname = 'static/' + self.resolve_filename(fname)
-        try:
-            mime = guess_type(fname)[0] or 'text/plain'
-            f = open(fname, 'rb')
-            self.send_response(200)  # OK
-            self.send_header('Content-type', mime)
-            self.end_headers()
-
-            if write:
-                self.wfile.write(f.read())
-
-            f.close()
-        except IOError, e:
-            self.send_response(404 if e.errno == errno.ENOENT else 403)
-            self.send_header('Content-type', 'text/html')
-            self.end_headers()
+        (code, headers, body) = static_response(fname, self.headers)
+        self.send_response(code)
+        for (keyword, value) in headers:
+            self.send_header(keyword, value)
+        self.end_headers()
 
-            if write:
-                self.wfile.write(
-                    'IOError ({})'.format(errno.errorcode[e.errno]))
+        if write:
+            # Large files are sent in chunks as they are read from disk
+            for chunk in body:
+                self.wfile.write(chunk)
 
     def do_HEAD(self):
         self.send_file(self.path, write=False)
@@ -86,11 +278,159 @@ class FileServer(BaseHTTPRequestHandler):
 
     def do_POST(self):
         if self.path == '/rpc':
-            length = int(self.headers.getheader('content-length'))
-            request = self.rfile.read(length)
-            response = rpc.rpc_invoke(request)
+            length = self.headers.getheader('content-length')
+            if length is None:
+                self.send_error(411)  # Length Required
+                return
+            request = self.rfile.read(int(length))
+            if self.request_version == 'HTTP/1.1':
+                self.send_rpc_stream(request)
+                return
+            # Chunked transfer encoding is only understood by HTTP/1.1
+            # clients
+            (code, headers, body) = rpc_response(request,
+                                                 self.client_address)
+            self.send_response(code)
+            for (keyword, value) in headers:
+                self.send_header(keyword, value)
+            self.end_headers()
+            self.wfile.write(body)
+        else:
+            self.send_error(404)
+
+    def send_rpc_stream(self, request):
+        """
+        Sends the response to a JSON-RPC request while it is encoded,
+        with chunked transfer encoding, so a large result doesn't have
+        to be in memory at once. A response of a single chunk is sent
+        with a Content-Length instead.
+
+        An error after the first chunk was sent can only be reported by
+        closing the connection before the end of the response.
+        """
+        chunks = rpc.rpc_invoke_stream(request, self.client_address)
+        headers_sent = False
+        try:
+            first = next(chunks, None)
+            if first is None:
+                # Notifications don't get a response
+                self.send_response(204)  # No Content
+                self.end_headers()
+                return
+            second = next(chunks, None)
 
             self.send_response(200)
             self.send_header('Content-type', 'application/json')
+            if second is None:
+                self.send_header('Content-Length', len(first))
+                self.end_headers()
+                self.wfile.write(first)
+                return
+            self.send_header('Transfer-Encoding', 'chunked')
             self.end_headers()
-            self.wfile.write(response)
+            headers_sent = True
+            for chunk in itertools.chain([first, second], chunks):
+                self.wfile.write('{:x}\r\n{}\r\n'.format(len(chunk), chunk))
+            self.wfile.write('0\r\n\r\n')
+        except socket.error:
+            # The client went away, the transaction is ended by closing
+            # the stream
+            self.close_connection = 1
+        except Exception:
+            self.log_error('Error while streaming a JSON-RPC response')
+            self.close_connection = 1
+            if not headers_sent:
+                self.send_error(500)
+        finally:
+            chunks.close()
+
+
+def static_response(path, request_headers):
+    """
+    Returns the (status code, [(header, value)], body chunks) response to
+    a GET of path from the static files in the route table and the asset
+    cache, including
+    the MIME type and validators, or a 304 response without body when
+    the client already has the current version. A precompressed variant
+    of the file is sent when the client accepts its encoding, and only
+    the requested part of it for a Range request.
+    request_headers are the headers of the request, as a
+    mimetools.Message.
+    """
+    route = routes.lookup(path)
+    if route is None:
+        return file_error_response(errno.ENOENT)
+    try:
+        asset = assets.get(route.path, route.stat, route.mime)
+    except (IOError, OSError), e:
+        return file_error_response(e.errno)
+
+    variant = asset.negotiate(request_headers.getheader('accept-encoding'))
+    validators = [
+        ('ETag', variant.etag),
+        ('Last-Modified', variant.last_modified),
+        ('Cache-Control', 'max-age={}'.format(crw.STATIC_MAX_AGE)),
+    ]
+    if asset.variants:
+        validators.append(('Vary', 'Accept-Encoding'))
+
+    if variant.not_modified(
+            request_headers.getheader('if-none-match'),
+            request_headers.getheader('if-modified-since')):
+        return (304, validators, [])  # Not Modified
+
+    (start, end) = (0, variant.size)
+    byte_range = None
+    range_header = request_headers.getheader('range')
+    if_range = request_headers.getheader('if-range')
+    # A Range with an If-Range that doesn't match is for another version
+    # of the file, which is then sent whole
+    if range_header is not None and \
+            if_range in (None, variant.etag, variant.last_modified):
+        try:
+            byte_range = parse_range(range_header, variant.size)
+        except RangeNotSatisfiable:
+            return (416,  # Range Not Satisfiable
+                    [('Content-Range', 'bytes */{}'.format(variant.size)),
+                     ('Content-Length', 0)],
+                    [])
+
+    headers = []
+    if byte_range is None:
+        code = 200  # OK
+    else:
+        (start, end) = byte_range
+        code = 206  # Partial Content
+        headers.append(('Content-Range', 'bytes {}-{}/{}'.format(
+            start, end - 1, variant.size)))
+    headers += [
+        ('Content-type', variant.mime),
+        ('Content-Length', end - start),
+        ('Accept-Ranges', 'bytes'),
+    ]
+    if variant.encoding is not None:
+        headers.append(('Content-Encoding', variant.encoding))
+    return (code, headers + validators, variant.chunks(start, end))
+
+
+def file_error_response(error_number):
+    """Returns the response to a request for a static file that can't
+    be read because of an IOError with error_number."""
+    message = 'IOError ({})'.format(errno.errorcode[error_number])
+    return (404 if error_number == errno.ENOENT else 403,
+            [('Content-type', 'text/html'),
+             ('Content-Length', len(message))],
+            [message])
+
+
+def rpc_response(request, client_address=None):
+    """Returns the (status code, [(header, value)], body) response to a
+    JSON-RPC request from the client at client_address."""
+    response = rpc.rpc_invoke(request, client_address)
+    if response is None:
+        # Notifications don't get a response
+        return (204, [], '')  # No Content
+    return (200,
+            [('Content-type', 'application/json'),
+             ('Content-Length', len(response))],
+            response)
@@ -1,18 +1,41 @@
 import json
+import collections
 import datetime
+import threading
+from contextlib import contextmanager
 
 
-class JsonRpcServer:
+class JsonRpcServer(object):
     """
     Superclass for JSON-RPC method servers.
     Subclasses can simply implement methods, which will be automatically
     available for the JSON-RPC protocol.
-    Reserved method names are `version`, `rpc_invoke`, `rpc_invoke_single`
-    and the default object members.
+    Reserved method names are the members of JsonRpcServer, like
+    `version`, `rpc_invoke` and `rpc_invoke_single`, and the default
+    object members.
+
+    When the response is streamed, see `rpc_invoke_stream`, methods can
+    return iterators instead of lists, which are encoded while they are
+    consumed.
+
+    Besides the members of JSON-RPC 2.0, a request can have a
+    `datetime_format` member. With "iso", the dates and times in its
+    response are encoded compactly, see DateTimeEncoder.
+
+    The `client_address` the request methods take is the (host, port)
+    of the client that sent the request, when known. It is passed on to
+    `invocation`.
     """
     version = '2.0'
 
-    def rpc_invoke_single(self, data):
+    # A thread pool (multiprocessing.pool.ThreadPool) on which the
+    # requests of a batch are invoked concurrently, at most
+    # `batch_concurrency` of every batch at the same time. Without a
+    # pool they are invoked one after the other.
+    batch_pool = None
+    batch_concurrency = 4
+
+    def rpc_invoke_single(self, data, client_address=None):
         response = {
             'jsonrpc': JsonRpcServer.version,
             'id': None
@@ -37,13 +60,7 @@ class JsonRpcServer:
 
             # Ensure it is a method overridden in JsonRpcServer subclass
             if hasattr(self, meth) and not hasattr(JsonRpcServer, meth):
-                m = getattr(self, meth)
-                if type(params) is list:
-                    result = m(*params)
-                elif type(params) is dict:
-                    result = m(**params)
-                else:
-                    result = m()
+                result = self.rpc_call(getattr(self, meth), params)
 
                 if response is not None:
                     response['result'] = result
@@ -57,7 +74,53 @@ class JsonRpcServer:
         finally:
             return response
 
-    def rpc_invoke(self, payload):
+    @contextmanager
+    def invocation(self, data, streaming=False, client_address=None):
+        """
+        The context a single request is invoked in by
+        `rpc_invoke_single`, and its response encoded in when
+        `streaming`. Subclasses can override this to set up the state of
+        a request.
+        """
+        yield
+
+    def rpc_call(self, method, params):
+        """
+        Calls the method of a request with its params. Subclasses can
+        override this to wrap every call.
+        """
+        if type(params) is list:
+            return method(*params)
+        elif type(params) is dict:
+            return method(**params)
+        else:
+            return method()
+
+    def rpc_invoke_batch(self, batch, client_address=None):
+        """
+        Invokes all requests of a batch and returns their responses in
+        the same order, see `batch_pool`.
+        """
+        if self.batch_pool is None or len(batch) < 2:
+            return [self.rpc_invoke_single(data, client_address)
+                    for data in batch]
+
+        slots = threading.BoundedSemaphore(self.batch_concurrency)
+
+        def invoke(data):
+            try:
+                return self.rpc_invoke_single(data, client_address)
+            finally:
+                slots.release()
+
+        results = []
+        for data in batch:
+            slots.acquire()
+            results.append(self.batch_pool.apply_async(invoke, (data,)))
+
+        return [result.get() for result in results]
+
+    def rpc_invoke(self, payload, client_address=None):
         """
         Execute a JSON-RPC request and return the response as JSON.
         Supports batch requests.
@@ -66,23 +129,82 @@ class JsonRpcServer:
             'jsonrpc': JsonRpcServer.version,
             'id': None,
         }
+        compact = False
         try:
-            data = json.loads(payload,
-                              object_hook=DateTimeDecoder.dict_to_object)
+            data = DateTimeDecoder.loads(payload)
             if type(data) == list:  # Batch response
-                response = filter(lambda x: x is not None,
-                                  map(self.rpc_invoke_single, data))
+                # Every response is encoded in the datetime format of
+                # its own request
+                return '[' + ', '.join(
+                    json.dumps(response, cls=DateTimeEncoder,
+                               compact=compact_datetimes(request))
+                    for (request, response)
+                    in zip(data, self.rpc_invoke_batch(data,
+                                                       client_address))
+                    if response is not None) + ']'
             else:
-                response = self.rpc_invoke_single(data)
+                compact = compact_datetimes(data)
+                response = self.rpc_invoke_single(data, client_address)
         except ValueError:
             response['error'] = RPCError.parse.serialize()
         except RPCError as e:
             response['error'] = e.serialize()
         except Exception as e:
             response['error'] = RPCError.internal_error(e).serialize()
-        finally:
-            return None if response is None else json.dumps(
-                response, cls=DateTimeEncoder)
+
+        return None if response is None else json.dumps(
+            response, cls=DateTimeEncoder, compact=compact)
+
+    def rpc_invoke_stream(self, payload, client_address=None):
+        """
+        Executes a JSON-RPC request like `rpc_invoke`, but yields the
+        response as JSON in chunks, encoding iterators in the result as
+        they are consumed, see StreamingEncoder. Nothing is yielded for
+        a notification. Batches aren't streamed, their response is
+        yielded as a whole.
+
+        The request is invoked when the first chunk is asked for, and
+        stays in its `invocation` until the last one was yielded.
+        """
+        try:
+            data = DateTimeDecoder.loads(payload)
+        except ValueError:
+            data = None
+        if type(data) is not dict:
+            response = self.rpc_invoke(payload, client_address)
+            if response is not None:
+                yield response
+            return
+
+        started = False
+        try:
+            with self.invocation(data, streaming=True,
+                                 client_address=client_address):
+                response = JsonRpcServer.rpc_invoke_single(self, data)
+                if response is None:
+                    return
+                encoder = StreamingEncoder(compact=compact_datetimes(data))
+                for chunk in encoder.chunks(response):
+                    started = True
+                    yield chunk
+        except Exception as e:
+            # Once a chunk was sent, the error can't be reported in the
+            # response any more
+            if started:
+                raise
+            if 'id' not in data:
+                return
+            yield json.dumps({
+                'jsonrpc': JsonRpcServer.version,
+                'id': data['id'],
+                'error': RPCError.internal_error(e).serialize(),
+            })
+
+
+def compact_datetimes(request):
+    """Returns whether a request asks for the dates and times in its
+    response to be encoded compactly."""
+    return type(request) is dict and request.get('datetime_format') == 'iso'
 
 
 # Methods to encode and decode datetime objects found at
@@ -92,8 +214,22 @@ class DateTimeEncoder(json.JSONEncoder):
     """
     Converts a python object, where datetime, date and timedelta objects
     are convertedinto objects that can be decoded using the DateTimeDecoder.
+
+    With `compact`, datetime and date objects are converted into ISO 8601
+    strings instead, like "2017-03-01T18:30:00" and "2017-03-01", and
+    timedelta objects into their number of seconds.
     """
+    def __init__(self, compact=False, **kwargs):
+        json.JSONEncoder.__init__(self, **kwargs)
+        self.compact = compact
+
     def default(self, obj):
+        if self.compact:
+            if isinstance(obj, datetime.date):
+                return obj.isoformat()
+            elif isinstance(obj, datetime.timedelta):
+                return obj.days * 24 * 60 * 60 + obj.seconds
+
         if isinstance(obj, datetime.datetime):
             return {
                 '__type__': 'datetime',
@@ -119,7 +255,97 @@ class DateTimeEncoder(json.JSONEncoder):
                 'day': obj.day
             }
         else:
-            return JSONEncoder.default(self, obj)
+            return json.JSONEncoder.default(self, obj)
+
+
+class StreamingEncoder(DateTimeEncoder):
+    """
+    Encodes like the DateTimeEncoder, in chunks of about `chunk_size`
+    bytes. Iterators, like generators, are encoded as arrays while they
+    are consumed, so a large result never has to be in memory at once.
+    """
+    chunk_size = 16 * 1024
+    # Number of consecutive values without an iterator that are encoded
+    # with one call
+    run_length = 256
+
+    def chunks(self, obj):
+        """Yields the JSON of obj in chunks."""
+        buffered = []
+        size = 0
+        for part in self.parts(obj):
+            buffered.append(part)
+            size += len(part)
+            if size >= self.chunk_size:
+                yield ''.join(buffered)
+                buffered = []
+                size = 0
+        if buffered:
+            yield ''.join(buffered)
+
+    def parts(self, obj):
+        """Yields the JSON of obj in parts. Only values containing an
+        iterator are split up, runs of other values are encoded at
+        once."""
+        if not contains_iterator(obj):
+            yield self.encode(obj)
+        elif isinstance(obj, dict):
+            separator = '{'
+            for (key, value) in obj.iteritems():
+                yield separator + self.encode(key) + ': '
+                for part in self.parts(value):
+                    yield part
+                separator = ', '
+            yield '}'
+        else:
+            yield '['
+            separator = ''
+            run = []
+            for item in obj:
+                if contains_iterator(item):
+                    if run:
+                        # Without the brackets of the list
+                        yield separator + self.encode(run)[1:-1]
+                        separator = ', '
+                        run = []
+                    yield separator
+                    for part in self.parts(item):
+                        yield part
+                    separator = ', '
+                else:
+                    run.append(item)
+                    if len(run) == self.run_length:
+                        yield separator + self.encode(run)[1:-1]
+                        separator = ', '
+                        run = []
+            if run:
+                yield separator + self.encode(run)[1:-1]
+            yield ']'
+
+
+# Types of values that are never iterators, looking those up is faster
+# than checking for an iterator
+SCALAR_TYPES = frozenset([str, unicode, int, long, float, bool, type(None),
+                          datetime.date, datetime.datetime,
+                          datetime.timedelta])
+
+
+def contains_iterator(obj):
+    """Returns whether obj is an iterator, or a list, tuple or dict
+    with an iterator in it."""
+    if type(obj) in SCALAR_TYPES:
+        return False
+    if isinstance(obj, (list, tuple)):
+        for item in obj:
+            if type(item) not in SCALAR_TYPES and contains_iterator(item):
+                return True
+        return False
+    if isinstance(obj, dict):
+        for value in obj.itervalues():
+            if contains_iterator(value):
+                return True
+        return False
+    return isinstance(obj, collections.Iterator)
 
 
 class DateTimeDecoder(json.JSONDecoder):
@@ -130,19 +356,28 @@ class DateTimeDecoder(json.JSONDecoder):
     """
 
     @staticmethod
-    def dict_to_object(dict):
-        if '__type__' not in dict:
-            return dict
+    def loads(payload):
+        """Parses a json string like json.loads, converting the objects
+        of the DateTimeEncoder back. When there are none, dict_to_object
+        isn't called for every object."""
+        if '"__type__"' not in payload:
+            return json.loads(payload)
+        return json.loads(payload,
+                          object_hook=DateTimeDecoder.dict_to_object)
 
-        type = dict.pop('__type__')
+    @staticmethod
+    def dict_to_object(dict):
+        type = dict.get('__type__')
         if type == 'datetime':
-            return datetime.datetime(**dict)
+            return datetime.datetime(
+                dict['year'], dict['month'], dict['day'],
+                dict.get('hour', 0), dict.get('minute', 0),
+                dict.get('second', 0), dict.get('microsecond', 0))
         elif type == 'timedelta':
             return datetime.timedelta(seconds=dict['seconds'])
         elif type == 'date':
-            return datetime.date(**dict)
+            return datetime.date(dict['year'], dict['month'], dict['day'])
         else:
-            dict['__type__'] = type
             return dict
 
 
@@ -0,0 +1,90 @@
+import collections
+import threading
+import time
+
+
+class LoginThrottle(object):
+    """
+    Limits the login attempts per key, like an email address or the
+    address of a client, so nobody can keep the server busy hashing
+    passwords by guessing them.
+
+    Every key has a bucket of `burst` attempts, refilled with `rate`
+    attempts per second. A failed attempt also blocks the key for
+    `backoff` seconds, doubling with every consecutive failure up to
+    `max_backoff`, until an attempt succeeds. The rate has to be more
+    than 0.
+
+    The state of at most `size` keys is kept, the least recently used
+    ones are forgotten first, which only gives them a full bucket again.
+    """
+    def __init__(self, burst=5, rate=0.1, backoff=1, max_backoff=300,
+                 size=100000):
+        if rate <= 0:
+            # The bucket would never be refilled
+            raise ValueError('The rate has to be more than 0')
+        self.burst = burst
+        self.rate = rate
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.size = size
+
+        # Maps keys to [tokens, updated, failures, blocked_until], in
+        # order of use
+        self.keys = collections.OrderedDict()
+        self.lock = threading.Lock()
+
+    def entry(self, key, now):
+        """Returns the state of the key with its bucket refilled up to
+        now, marked as most recently used. Called with the lock held."""
+        entry = self.keys.pop(key, None)
+        if entry is None:
+            entry = [self.burst, now, 0, 0]
+        else:
+            entry[0] = min(self.burst, entry[0] + (now - entry[1]) * self.rate)
+            entry[1] = now
+        self.keys[key] = entry
+        while len(self.keys) > self.size:
+            self.keys.popitem(last=False)
+        return entry
+
+    def acquire(self, key):
+        """Takes an attempt from the bucket of the key and returns 0 if
+        it may log in right now, otherwise returns the number of seconds
+        until it may. Checking and taking happen under the same lock, so
+        concurrent attempts can't all pass the check on the last
+        token."""
+        with self.lock:
+            now = time.time()
+            entry = self.entry(key, now)
+            (tokens, _, _, blocked_until) = entry
+            wait = max(blocked_until - now, 0)
+            if tokens < 1:
+                wait = max(wait, (1 - tokens) / self.rate)
+            if wait == 0:
+                entry[0] = tokens - 1
+            return wait
+
+    def release(self, key):
+        """Gives back an attempt taken by acquire, for an attempt that
+        was refused after all."""
+        with self.lock:
+            entry = self.entry(key, time.time())
+            entry[0] = min(entry[0] + 1, self.burst)
+
+    def failed(self, key):
+        """Blocks the key after a failed attempt, for longer with every
+        consecutive failure."""
+        with self.lock:
+            now = time.time()
+            entry = self.entry(key, now)
+            entry[3] = now + min(self.backoff * 2 ** entry[2],
+                                 self.max_backoff)
+            entry[2] += 1
+
+    def succeeded(self, key):
+        """Resets the backoff of the key after a successful attempt."""
+        with self.lock:
+            entry = self.entry(key, time.time())
+            entry[2] = 0
+            entry[3] = 0
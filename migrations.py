@@ -0,0 +1,73 @@
+"""
+Versioned changes to the database schema, applied in order by
+Database.migrate. The version of a database is stored in its
+schema_version table.
+
+Every migration is a (version, description, statements) tuple. Add new
+migrations to the end with the next version number and never change a
+migration that has been released. The statements of a migration have to
+be idempotent, so that they can be applied to databases that already
+contain some of the changes.
+"""
+
+
+def id_sequence(table):
+    """Returns the statements that make the id column of `table` default
+    to the next value of a sequence, which continues after the highest
+    id already in use."""
+    return [
+        """CREATE SEQUENCE IF NOT EXISTS {0}_id_seq
+        OWNED BY {0}.id;""".format(table),
+        """SELECT setval('{0}_id_seq',
+        COALESCE((SELECT MAX(id) FROM {0}), 0) + 1, false);""".format(table),
+        """ALTER TABLE {0}
+        ALTER COLUMN id SET DEFAULT nextval('{0}_id_seq');""".format(table),
+    ]
+
+
+MIGRATIONS = [
+    (1, 'Add indexes for the hot lookup paths',
+     [
+         # Keep a single entry per user and day before adding the
+         # unique constraint
+         """DELETE FROM health_data AS a
+         USING health_data AS b
+         WHERE a.user_id = b.user_id
+         AND a.date = b.date
+         AND a.ctid < b.ctid;""",
+         """DO $$
+         BEGIN
+             IF NOT EXISTS (SELECT 1 FROM pg_constraint
+                            WHERE conname = 'health_data_user_id_date_key')
+             THEN
+                 ALTER TABLE health_data
+                 ADD CONSTRAINT health_data_user_id_date_key
+                 UNIQUE (user_id, date);
+             END IF;
+         END $$;""",
+         """CREATE INDEX IF NOT EXISTS sessions_user_id_exp_date_idx
+         ON sessions (user_id, exp_date);""",
+         """CREATE INDEX IF NOT EXISTS training_data_user_id_time_idx
+         ON training_data (user_id, time);""",
+         """CREATE INDEX IF NOT EXISTS interval_data_training_id_idx
+         ON interval_data (training_id);""",
+         """CREATE INDEX IF NOT EXISTS users_team_id_idx
+         ON users (team_id);""",
+     ]),
+    (2, 'Generate ids of users, teams and trainings with sequences',
+     id_sequence('users') + id_sequence('teams') +
+     id_sequence('training_data')),
+    (3, 'Add an index for removing expired sessions of all users',
+     [
+         """CREATE INDEX IF NOT EXISTS sessions_exp_date_idx
+         ON sessions (exp_date);""",
+     ]),
+    (4, 'Add a table for revoked signed session tokens',
+     [
+         """CREATE TABLE IF NOT EXISTS revoked_sessions
+         (nonce TEXT PRIMARY KEY,
+         exp_date TIMESTAMP NOT NULL);""",
+         """CREATE INDEX IF NOT EXISTS revoked_sessions_exp_date_idx
+         ON revoked_sessions (exp_date);""",
+     ]),
+]
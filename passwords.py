@@ -0,0 +1,86 @@
+"""
+Hashing and verifying passwords, which takes tens of milliseconds of CPU
+by design. With passlib's pure Python pbkdf2 the GIL is held meanwhile,
+so done in the server process it holds up all other requests. A
+PasswordPool does it in worker processes instead.
+"""
+import multiprocessing
+import threading
+from passlib.context import CryptContext
+from passlib.hash import pbkdf2_sha256
+
+# Global password context, with passlib's default number of rounds
+# unless configured. Hashes with another number of rounds are replaced
+# after a successful login, see needs_update. The rounds are set
+# explicitly, as passlib only reports hashes with other rounds as
+# outdated then
+pwd_context = CryptContext(
+    schemes=["pbkdf2_sha256"],
+    pbkdf2_sha256__rounds=pbkdf2_sha256.default_rounds
+    )
+
+
+def configure(rounds):
+    """Hashes passwords with `rounds` pbkdf2_sha256 rounds from now on.
+    Has to be called before a PasswordPool is made, whose processes
+    otherwise keep the previous number."""
+    pwd_context.update(pbkdf2_sha256__rounds=rounds)
+
+
+def hash_password(password):
+    """Returns the salted hash of a password."""
+    return pwd_context.hash(password)
+
+
+def verify_password(password, password_hash):
+    """Returns whether the password matches the hash."""
+    return pwd_context.verify(password, password_hash)
+
+
+def needs_update(password_hash):
+    """Returns whether the hash was made with other parameters than
+    the configured ones, so the password should be hashed again."""
+    return pwd_context.needs_update(password_hash)
+
+
+class PasswordPoolFull(Exception):
+    """Raised when `max_pending` passwords are being hashed or verified
+    already."""
+    pass
+
+
+class PasswordPool(object):
+    """
+    Hashes and verifies passwords on `processes` worker processes, so
+    logins are spread over the cores and other requests keep being
+    handled meanwhile.
+
+    At most `max_pending` passwords are queued or being worked on. When
+    there are more, PasswordPoolFull is raised right away, instead of
+    letting the request wait behind all of them.
+    """
+    def __init__(self, processes, max_pending):
+        self.pool = multiprocessing.Pool(processes)
+        self.slots = threading.BoundedSemaphore(max_pending)
+
+    def apply(self, function, args):
+        """Calls function with args on a worker process and returns the
+        result, raising PasswordPoolFull when it would be queued behind
+        `max_pending` other calls."""
+        if not self.slots.acquire(False):
+            raise PasswordPoolFull()
+        try:
+            return self.pool.apply_async(function, args).get()
+        finally:
+            self.slots.release()
+
+    def hash(self, password):
+        return self.apply(hash_password, (password,))
+
+    def verify(self, password, password_hash):
+        return self.apply(verify_password, (password, password_hash))
+
+    def close(self):
+        """Stops the worker processes."""
+        self.pool.close()
+        self.pool.join()
@@ -0,0 +1,90 @@
+import collections
+import datetime
+import threading
+import time
+
+
+class SessionCache(object):
+    """
+    In memory cache of the sessions table, used by SessionDatabase to
+    verify session keys without querying the database.
+
+    Entries are trusted for `ttl`, after which they are read from the
+    database again, so changes made by other server processes (like a
+    logout) are picked up within that time. At most `size` entries are
+    kept, the least recently used ones are evicted first.
+
+    Renewals of a session key are only written to the database when the
+    stored expiration date lags more than `renew_interval` behind the
+    one it would be renewed to.
+
+    An invalidated key is not cached again for `ttl`. Its removal from
+    the database is only committed at the end of the request, so a
+    concurrent request can still read the key from the database.
+    """
+    def __init__(self, size=10000, ttl=datetime.timedelta(minutes=5),
+                 renew_interval=datetime.timedelta(hours=1)):
+        self.size = size
+        self.ttl = ttl.total_seconds()
+        self.renew_interval = renew_interval
+
+        # Maps session keys to (user_id, exp_date, cached_until), in
+        # order of use. Invalidated keys map to (None, None,
+        # cached_until)
+        self.sessions = collections.OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, session_key):
+        """Returns the (user_id, exp_date) of the session key as stored
+        in the database, or None if it isn't cached."""
+        with self.lock:
+            entry = self.sessions.pop(session_key, None)
+            if entry is None:
+                return None
+
+            (user_id, exp_date, cached_until) = entry
+            if cached_until < time.time():
+                return None
+            if user_id is None:
+                self.sessions[session_key] = entry
+                return None
+
+            # Reinserting moves the entry to the end, as most recently
+            # used
+            self.sessions[session_key] = entry
+            return (user_id, exp_date)
+
+    def put(self, session_key, user_id, exp_date):
+        """Caches the user_id and expiration date stored in the database
+        for the session key."""
+        with self.lock:
+            entry = self.sessions.pop(session_key, None)
+            if (entry is not None and entry[0] is None and
+                    entry[2] >= time.time()):
+                # Invalidated, the key may still be in the database
+                # until its removal is committed
+                self.sessions[session_key] = entry
+                return
+            self.sessions[session_key] = (user_id, exp_date,
+                                          time.time() + self.ttl)
+
+            while len(self.sessions) > self.size:
+                self.sessions.popitem(last=False)
+
+    def invalidate(self, session_key):
+        """Removes the session key from the cache, and keeps it from
+        being cached again for `ttl`."""
+        with self.lock:
+            self.sessions.pop(session_key, None)
+            self.sessions[session_key] = (None, None,
+                                          time.time() + self.ttl)
+
+            while len(self.sessions) > self.size:
+                self.sessions.popitem(last=False)
+
+    def needs_renewal(self, session_key, exp_date):
+        """Returns whether renewing the session key to `exp_date` has to
+        be written to the database."""
+        cached = self.get(session_key)
+        return cached is None or\
+            exp_date - cached[1] >= self.renew_interval
@@ -0,0 +1,88 @@
+import threading
+import time
+import database
+
+
+class SessionReaper(object):
+    """
+    Removes the expired session keys of all users from the sessions
+    table in the background, every `interval` seconds, so logging in
+    doesn't have to and the keys of users who never log in again don't
+    stay forever.
+
+    Every run deletes batches of at most `batch_size` keys, each in a
+    transaction of its own, until no expired keys are left or
+    `max_batches` batches were deleted.
+
+    The totals of the runs are kept as metrics: the number of `runs`,
+    the keys `reaped` in all runs, and of the last run the keys reaped,
+    its duration and the size of the sessions table afterwards.
+
+    `sessions` is the session backend to reap, a SessionDatabase by
+    default. For a SignedSessionDatabase the revocations of expired
+    tokens are removed instead.
+    """
+    def __init__(self, database_object, interval=3600, batch_size=1000,
+                 max_batches=100, sessions=None):
+        if sessions is None:
+            sessions = database.SessionDatabase(database_object)
+        self.sdb = sessions
+        self.d = database_object
+        self.interval = interval
+        self.batch_size = batch_size
+        self.max_batches = max_batches
+
+        self.runs = 0
+        self.reaped = 0
+        self.last_reaped = 0
+        self.last_duration = 0
+        self.table_rows = 0
+        self.table_bytes = 0
+
+    def reap(self):
+        """Removes expired session keys once and returns how many."""
+        start = time.time()
+        reaped = 0
+        with self.d.connection():
+            for _ in range(self.max_batches):
+                removed = self.sdb.remove_expired_sessions(self.batch_size)
+                reaped += removed
+                if removed < self.batch_size:
+                    break
+            (self.table_rows, self.table_bytes) = \
+                self.sdb.get_sessions_size()
+
+        self.runs += 1
+        self.reaped += reaped
+        self.last_reaped = reaped
+        self.last_duration = time.time() - start
+        return reaped
+
+    def metrics(self):
+        """Returns the metrics as a dict."""
+        return {
+            'runs': self.runs,
+            'reaped': self.reaped,
+            'last_reaped': self.last_reaped,
+            'last_duration': self.last_duration,
+            'table_rows': self.table_rows,
+            'table_bytes': self.table_bytes,
+        }
+
+    def start(self):
+        """Reaps every interval seconds, in a daemon thread."""
+        def reap_forever():
+            while True:
+                time.sleep(self.interval)
+                try:
+                    self.reap()
+                except Exception as e:
+                    print 'Reaping expired sessions failed: {}'.format(e)
+                    continue
+                print ('Reaped {} expired sessions in {:.0f} ms, the '
+                       'sessions table has about {} rows ({} kB)'.format(
+                           self.last_reaped, self.last_duration * 1000,
+                           self.table_rows, self.table_bytes / 1024))
+        thread = threading.Thread(target=reap_forever)
+        thread.daemon = True
+        thread.start()
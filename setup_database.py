@@ -3,9 +3,15 @@ from crw import \
 import database
 
 if __name__ == '__main__':
-    # Setup the user database (the users table in the database)
+    # Setup the user database (the users table in the database), or
+    # bring the tables of an existing database up to date
     db = database.Database(
         DATABASE_HOST, DATABASE_PORT, DATABASE_NAME,
         DATABASE_USER, DATABASE_PASS)
-    db.init_database()
+    if db.is_initialized():
+        version = db.migrate()
+    else:
+        db.init_database()
+        version = db.get_schema_version()
+    print 'Database schema is at version {}'.format(version)
     db.close_database_connection()
@@ -0,0 +1,398 @@
+import collections
+import email.utils
+import gzip
+import hashlib
+import os
+import threading
+import time
+from cStringIO import StringIO
+from mimetypes import guess_type
+from posixpath import normpath
+from urlparse import urlparse
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+# Content codings of the precompressed variants of static files, with
+# the extension of their files, in order of preference
+ENCODINGS = [('br', '.br'), ('gzip', '.gz')]
+
+# Extensions of files that are compressed already, compressing them
+# again gains next to nothing
+COMPRESSED_EXTENSIONS = {
+    '.br', '.gz', '.zip', '.pdf', '.png', '.jpg', '.jpeg', '.gif',
+    '.woff', '.woff2',
+}
+
+# Number of bytes read from disk at a time when sending a FileAsset
+CHUNK_SIZE = 64 * 1024
+
+
+class RangeNotSatisfiable(Exception):
+    """Raised when none of the bytes in a Range header are in the file."""
+    pass
+
+
+class Asset(object):
+    """
+    A static file held in memory, with the validators sent to clients so
+    they can revalidate their copy instead of downloading it again.
+    """
+    def __init__(self, data, mime, mtime, encoding=None):
+        self.data = data
+        self.mime = mime
+        self.size = len(data)
+        self.mtime = mtime
+        self.encoding = encoding
+        self.etag = '"{}"'.format(hashlib.sha1(data).hexdigest())
+        self.last_modified = email.utils.formatdate(mtime, usegmt=True)
+
+        # Maps content codings to compressed variants of the asset
+        self.variants = {}
+
+    @property
+    def memory_size(self):
+        """The number of bytes of data of the asset and its variants."""
+        return len(self.data) + sum(variant.memory_size
+                                    for variant in self.variants.values())
+
+    def chunks(self, start=0, end=None):
+        """Yields the bytes from start up to (not including) end."""
+        if start == 0 and end in (None, self.size):
+            yield self.data
+        else:
+            yield self.data[start:end]
+
+    def negotiate(self, accept_encoding):
+        """
+        Returns the variant of the asset to send to a client that sent
+        this Accept-Encoding header (None when absent), which is the
+        asset itself when the client accepts none of the variants.
+        """
+        if accept_encoding is None or not self.variants:
+            return self
+
+        qualities = {}
+        for coding in accept_encoding.split(','):
+            parameters = coding.split(';')
+            quality = 1.0
+            for parameter in parameters[1:]:
+                (name, _, value) = parameter.strip().partition('=')
+                if name == 'q':
+                    try:
+                        quality = float(value)
+                    except ValueError:
+                        quality = 0.0
+            qualities[parameters[0].strip().lower()] = quality
+
+        best = self
+        best_quality = 0.0
+        for (encoding, _) in ENCODINGS:
+            quality = qualities.get(encoding, qualities.get('*', 0.0))
+            if encoding in self.variants and quality > best_quality:
+                best = self.variants[encoding]
+                best_quality = quality
+        return best
+
+    def not_modified(self, if_none_match, if_modified_since):
+        """
+        Returns whether a client that sent these If-None-Match and
+        If-Modified-Since headers (None when absent) already has the
+        current version of the asset. If-Modified-Since is ignored when
+        If-None-Match is present.
+        """
+        if if_none_match is not None:
+            etags = [etag.strip() for etag in if_none_match.split(',')]
+            # If-None-Match uses the weak comparison
+            etags = [etag[2:] if etag.startswith('W/') else etag
+                     for etag in etags]
+            return '*' in etags or self.etag in etags
+
+        if if_modified_since is not None:
+            since = email.utils.parsedate_tz(if_modified_since)
+            if since is None:
+                return False
+            return int(self.mtime) <= email.utils.mktime_tz(since)
+
+        return False
+
+
+class FileAsset(Asset):
+    """
+    A static file too large to hold in memory, which is read from disk in
+    chunks of CHUNK_SIZE bytes whenever it is sent.
+    """
+    def __init__(self, path, mime, mtime, encoding=None):
+        sha1 = hashlib.sha1()
+        size = 0
+        with open(path, 'rb') as f:
+            for chunk in iter(lambda: f.read(CHUNK_SIZE), ''):
+                sha1.update(chunk)
+                size += len(chunk)
+
+        Asset.__init__(self, '', mime, mtime, encoding)
+        self.path = path
+        self.size = size
+        self.etag = '"{}"'.format(sha1.hexdigest())
+
+    def chunks(self, start=0, end=None):
+        remaining = (self.size if end is None else end) - start
+        with open(self.path, 'rb') as f:
+            f.seek(start)
+            while remaining > 0:
+                chunk = f.read(min(CHUNK_SIZE, remaining))
+                if not chunk:
+                    break
+                remaining -= len(chunk)
+                yield chunk
+
+
+def load_asset(path, stat, mime, mtime, stream_threshold, encoding=None):
+    """Returns an Asset of the file at path, or a FileAsset when it is
+    larger than stream_threshold bytes according to its stat."""
+    if stat.st_size > stream_threshold:
+        return FileAsset(path, mime, mtime, encoding)
+    return Asset(read(path), mime, mtime, encoding)
+
+
+def parse_range(range_header, size):
+    """
+    Returns the (start, end) of the byte range requested by a Range
+    header in a file of size bytes, with end being exclusive, or None
+    when the header is invalid or asks for multiple ranges, in which
+    case it has to be ignored. Raises RangeNotSatisfiable when the range
+    starts after the end of the file, or the file is empty.
+    """
+    (unit, _, ranges) = range_header.partition('=')
+    if unit.strip().lower() != 'bytes' or ',' in ranges:
+        return None
+
+    (first, _, last) = ranges.strip().partition('-')
+    # Only digits, int() would also accept signs and whitespace
+    if last != '' and not last.isdigit():
+        return None
+    if first == '':
+        if last == '':
+            return None
+        # The last `last` bytes
+        suffix = int(last)
+        # An empty file has no last bytes
+        if suffix == 0 or size == 0:
+            raise RangeNotSatisfiable()
+        return (max(size - suffix, 0), size)
+    if not first.isdigit():
+        return None
+
+    start = int(first)
+    end = int(last) + 1 if last != '' else size
+    if last != '' and end <= start:
+        return None
+    if start >= size:
+        raise RangeNotSatisfiable()
+    return (start, min(end, size))
+
+
+class AssetCache(object):
+    """
+    In memory cache of static files, keyed by path.
+
+    The file is stat'ed on every lookup and read again when its mtime or
+    size changed. At most `max_size` bytes of file data are kept, the
+    least recently used files are evicted first. Files larger than
+    `stream_threshold` bytes are not kept in memory, they are cached as
+    FileAssets which are read from disk when they are sent.
+    """
+    def __init__(self, max_size=32 * 1024 * 1024,
+                 stream_threshold=256 * 1024):
+        self.max_size = max_size
+        self.stream_threshold = stream_threshold
+        self.size = 0
+
+        # Maps paths to assets, in order of use
+        self.assets = collections.OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, path, stat=None, mime=None):
+        """
+        Returns the Asset of the file at path, with the precompressed
+        variants next to it that are at least as new as the file. Raises
+        IOError or OSError when the file can't be read.
+        The stat and MIME type of the file are looked up unless given,
+        as they are by a Route.
+        """
+        if stat is None:
+            stat = os.stat(path)
+        with self.lock:
+            asset = self.assets.pop(path, None)
+            if asset is not None:
+                if asset.mtime == stat.st_mtime and \
+                        asset.size == stat.st_size:
+                    # Reinserting moves the entry to the end, as most
+                    # recently used
+                    self.assets[path] = asset
+                    return asset
+                self.size -= asset.memory_size
+
+        if mime is None:
+            mime = guess_type(path)[0] or 'text/plain'
+        asset = load_asset(path, stat, mime, stat.st_mtime,
+                           self.stream_threshold)
+        for (encoding, extension) in ENCODINGS:
+            try:
+                variant_stat = os.stat(path + extension)
+                if variant_stat.st_mtime < stat.st_mtime:
+                    continue
+                asset.variants[encoding] = load_asset(
+                    path + extension, variant_stat, mime, stat.st_mtime,
+                    self.stream_threshold, encoding)
+            except (IOError, OSError):
+                pass
+
+        if asset.memory_size <= self.max_size:
+            with self.lock:
+                previous = self.assets.pop(path, None)
+                if previous is not None:
+                    self.size -= previous.memory_size
+                self.assets[path] = asset
+                self.size += asset.memory_size
+
+                while self.size > self.max_size:
+                    (_, evicted) = self.assets.popitem(last=False)
+                    self.size -= evicted.memory_size
+        return asset
+
+    def invalidate(self, path):
+        """Removes the file at path from the cache."""
+        with self.lock:
+            asset = self.assets.pop(path, None)
+            if asset is not None:
+                self.size -= asset.memory_size
+
+
+# A static file that can be requested, with its MIME type and its stat
+# when the RouteTable was built
+Route = collections.namedtuple('Route', ['path', 'mime', 'stat'])
+
+
+class RouteTable(object):
+    """
+    Maps the URL paths of all files in a directory and its subdirectories
+    to their Routes, and the paths of the subdirectories with an
+    index.html to the Route of that file.
+
+    The table is built by walking the directory, so looking up a request
+    doesn't touch the filesystem, and a path outside the directory can't
+    be served as there is no route to it. Files that are added, removed
+    or changed afterwards are only noticed by refreshing the table.
+
+    The precompressed variants (.br and .gz files) get no route of their
+    own, they are only sent as the encoding of the file they compress.
+    """
+    def __init__(self, directory):
+        self.directory = directory
+        self.routes = {}
+        self.refresh()
+
+    def refresh(self):
+        """Walks the directory and replaces the table with the files
+        found."""
+        routes = {}
+        for (root, _, files) in os.walk(self.directory):
+            relative = os.path.relpath(root, self.directory)
+            url = '/' if relative == os.curdir else \
+                '/' + relative.replace(os.sep, '/')
+            prefix = url.rstrip('/') + '/'
+            for name in files:
+                if name.endswith(tuple(extension
+                                       for (_, extension) in ENCODINGS)):
+                    continue
+                path = os.path.join(root, name)
+                try:
+                    stat = os.stat(path)
+                except OSError:
+                    # Removed while walking
+                    continue
+                routes[prefix + name] = Route(
+                    path, guess_type(path)[0] or 'text/plain', stat)
+            index = routes.get(prefix + 'index.html')
+            if index is not None:
+                routes[url] = routes[prefix] = index
+        # Replaced at once, lookups from other threads see either table
+        self.routes = routes
+
+    def lookup(self, url):
+        """Returns the Route of the file requested with url, or None
+        when there is none."""
+        route = self.routes.get(url)
+        if route is None:
+            # With a query string, or not in its normal form
+            route = self.routes.get(normpath(urlparse(url).path))
+        return route
+
+    def watch(self, interval):
+        """Refreshes the table every interval seconds, in a daemon
+        thread."""
+        def refresh_forever():
+            while True:
+                time.sleep(interval)
+                self.refresh()
+        thread = threading.Thread(target=refresh_forever)
+        thread.daemon = True
+        thread.start()
+
+
+def read(path):
+    """Returns the contents of a file."""
+    with open(path, 'rb') as f:
+        return f.read()
+
+
+def gzip_compress(data):
+    """Returns data compressed to the gzip format."""
+    compressed = StringIO()
+    # A fixed mtime keeps the output, and so its ETag, the same when the
+    # file is compressed again
+    with gzip.GzipFile(fileobj=compressed, mode='wb', compresslevel=9,
+                       mtime=0) as f:
+        f.write(data)
+    return compressed.getvalue()
+
+
+def compress_file(path):
+    """
+    Writes the precompressed variants of a file next to it, for every
+    encoding with a compressor available, unless they are up to date
+    already. Variants that aren't smaller than the file are removed.
+    """
+    compressors = [('.gz', gzip_compress)]
+    if brotli is not None:
+        compressors.append(('.br', brotli.compress))
+
+    mtime = os.stat(path).st_mtime
+    data = None
+    for (extension, compress) in compressors:
+        variant_path = path + extension
+        if os.path.exists(variant_path) and \
+                os.stat(variant_path).st_mtime >= mtime:
+            continue
+
+        if data is None:
+            data = read(path)
+        compressed = compress(data)
+        if len(compressed) < len(data):
+            with open(variant_path, 'wb') as f:
+                f.write(compressed)
+        elif os.path.exists(variant_path):
+            os.remove(variant_path)
+
+
+def compress_directory(directory):
+    """Writes the precompressed variants of all files in the directory
+    and its subdirectories that aren't compressed already."""
+    for (root, _, files) in os.walk(directory):
+        for name in files:
+            if os.path.splitext(name)[1].lower() not in \
+                    COMPRESSED_EXTENSIONS:
+                compress_file(os.path.join(root, name))
@@ -5,6 +5,10 @@ import jsonrpc
 import json
 import string
 import datetime
+import threading
+from multiprocessing.pool import ThreadPool
+from login_throttle import LoginThrottle
+from passwords import PasswordPool
 from crw import DATABASE_HOST, DATABASE_PORT, DATABASE_USER, DATABASE_PASS
 
 # Before testing, make an empty database named userdatabasetest with the same
@@ -182,6 +186,46 @@ class CrwJsonRpcTest(u.TestCase):
             '"params": ' + params + ', "id": 2, "session": "' +\
             session + '", "user_id": ' + str(user_id) + ' }'
 
+    def test_login_password_pool_full(self):
+        """Test that a login gets a server busy RPCError instead of
+        waiting for a full password pool"""
+        self.db.password_pool = PasswordPool(processes=1, max_pending=1)
+        try:
+            self.db.password_pool.slots.acquire()
+            with self.assertRaises(jsonrpc.RPCError) as err:
+                self.rpc.login(*self.USERS[0])
+            self.assertEquals(err.exception.code, 12)
+            self.db.password_pool.slots.release()
+            self.assertTrue(self.rpc.login(*self.USERS[0]))
+        finally:
+            self.db.password_pool.close()
+
+    def test_login_throttled(self):
+        """Test that login attempts beyond the throttles are refused with
+        a too many login attempts RPCError, per email and host"""
+        self.rpc.email_throttle = LoginThrottle(burst=1, backoff=0)
+        self.rpc.address_throttle = LoginThrottle(burst=2, backoff=0)
+        (email, password) = self.USERS[0]
+        request = self.generate_rpc_request('login', '["{}","{}"]'.
+                                            format(email, 'incorrect'))
+        response = json.loads(self.rpc.rpc_invoke(request, ('host', 1)))
+        self.assertEquals(response['error']['code'], 2)
+        response = json.loads(self.rpc.rpc_invoke(request, ('host', 2)))
+        self.assertEquals(response['error']['code'], 13)
+        self.assertEquals(response['error']['data'], '10')
+
+        (email, password) = self.USERS[1]
+        request = self.generate_rpc_request('login', '["{}","{}"]'.
+                                            format(email, password))
+        response = json.loads(self.rpc.rpc_invoke(request, ('host', 3)))
+        self.assertIn('result', response)
+        response = json.loads(self.rpc.rpc_invoke(
+            request.replace(email, self.USERS[2][0]), ('host', 4)))
+        self.assertEquals(response['error']['code'], 13)
+        response = json.loads(self.rpc.rpc_invoke(
+            request.replace(email, self.USERS[2][0]), ('other', 1)))
+        self.assertIn('result', response)
+
     def test_login_valid_request(self):
         (email, password) = self.USERS[0]
         request = self.generate_rpc_request('login', '["{}","{}"]'.
@@ -343,6 +387,26 @@ class CrwJsonRpcTest(u.TestCase):
                           """Test that the correct exception is raised
                           when an user isn't authencitated.""")
 
+    def test_add_health_data_bulk_correct(self):
+        user_id = 2
+        health_data = [
+            (datetime.date.today() - datetime.timedelta(days=i), 50 + i,
+             70, '') for i in range(3)]
+        self.set_user_and_authenticated(user_id)
+        self.assertTrue(self.rpc.add_health_data_bulk(health_data))
+
+        self.set_user_and_authenticated(user_id)
+        self.assertEquals(self.rpc.get_my_health_data(7),
+                          list(reversed(health_data)))
+
+    def test_add_health_data_bulk_coach(self):
+        self.set_user_and_authenticated(self.test_team_coach_id)
+        with self.assertRaises(jsonrpc.RPCError) as err:
+            self.rpc.add_health_data_bulk(
+                [(datetime.date.today(), 50, 70, '')])
+
+        self.assertEquals(err.exception.code, 8)
+
     def populate_test_user_health(self, user_id):
         self.date1 = datetime.date.today() - datetime.timedelta(days=2)
         self.date2 = datetime.date.today() - datetime.timedelta(days=6)
@@ -411,6 +475,24 @@ class CrwJsonRpcTest(u.TestCase):
 
         self.assertEquals(team_health_data[0][1][0][1], self.heart_rate1)
 
+    def test_get_team_health_data_member_without_data(self):
+        user_id = 7
+        self.set_user_and_authenticated(self.test_team_coach_id)
+        self.rpc.add_to_team(self.USERS[user_id - 1][0])
+        self.set_user_and_authenticated(self.test_team_coach_id)
+        self.rpc.add_to_team(self.USERS[0][0])
+        self.populate_test_user_health(user_id)
+
+        self.set_user_and_authenticated(self.test_team_coach_id)
+        team_health_data = self.rpc.get_team_health_data(7)
+
+        self.assertEquals(team_health_data[0][0], self.USERS[0][0])
+        self.assertEquals(team_health_data[0][1], [],
+                          """Test that a member without health data is
+                          included with an empty list.""")
+        self.assertEquals(team_health_data[1][0], self.USERS[user_id - 1][0])
+        self.assertEquals(len(team_health_data[1][1]), 2)
+
     def test_get_team_health_data_not_authenticated(self):
         self.rpc.current_user_id = self.test_team_coach_id
         with self.assertRaises(jsonrpc.RPCError) as err:
@@ -567,6 +649,20 @@ class CrwJsonRpcTest(u.TestCase):
 
         self.assertFalse(interval_1 == interval_2)
 
+    def test_add_training_interval_argument_none(self):
+        user_id = 3
+        self.set_user_and_authenticated(user_id)
+        with self.assertRaises(jsonrpc.RPCError) as err:
+            self.rpc.add_training(
+                datetime.datetime.now(), True, '',
+                [(200, 120, 10, datetime.timedelta(seconds=10)),
+                 (200, 120, 10, None)])
+
+        self.assertEquals(err.exception.code, 11)
+        self.assertEquals(self.trdb.get_past_training_data(user_id), [],
+                          """Test that the training isn't added when
+                          one of its intervals is invalid""")
+
     def populate_test_user_training(self, user_id):
         self.time1 = datetime.datetime.now()
         self.time2 = datetime.datetime.now() - datetime.timedelta(days=2)
@@ -705,6 +801,202 @@ class CrwJsonRpcTest(u.TestCase):
         self.set_user_and_authenticated(self.test_team_coach_id)
         self.assertEquals(self.rpc.user_status(), (True, True, True))
 
+    def test_request_state_is_per_thread(self):
+        self.set_user_and_authenticated(self.test_team_coach_id)
+        other_thread_state = []
+
+        def read_state():
+            other_thread_state.append(
+                (self.rpc.current_user_id, self.rpc.authenticated))
+
+        thread = threading.Thread(target=read_state)
+        thread.start()
+        thread.join()
+
+        self.assertEquals(other_thread_state, [(-1, False)],
+                          """Test that the user authenticated in one
+                          thread is not seen by another thread""")
+        self.assertEquals(self.rpc.current_user_id,
+                          self.test_team_coach_id)
+
+    def test_failing_request_rolled_back(self):
+        def add_team_and_fail():
+            self.tdb.create_team(1, 'Team ERGON')
+            raise e.error_user_does_not_exist
+        self.rpc.add_team_and_fail = add_team_and_fail
+
+        response = self.rpc.rpc_invoke(self.generate_rpc_request(
+            'add_team_and_fail', '[]'))
+
+        self.assert_error_equals(response, 7, "")
+        self.assertEquals(self.udb.get_user_team_status(1), (None, None),
+                          """Test that the changes of a request are
+                          rolled back when it fails""")
+
+    def test_request_committed(self):
+        key = self.rpc.login(self.USERS[0][0], self.USERS[0][1])
+        self.rpc.rpc_invoke(self.generate_rpc_request(
+            'create_team', '["Team ERGON"]', session=key, user_id=1))
+
+        other_db = d.Database(DATABASE_HOST, DATABASE_PORT, DATABASE,
+                              DATABASE_USER, DATABASE_PASS)
+        try:
+            self.assertNotEqual(
+                d.UserDatabase(other_db).get_user_team_status(1)[0], None,
+                """Test that the changes of a request are committed at
+                the end of the request""")
+        finally:
+            other_db.close_database_connection()
+
+    def test_batch_invoked_concurrently(self):
+        key = self.rpc.login(self.USERS[0][0], self.USERS[0][1])
+        batch = '[{}]'.format(','.join(
+            [self.generate_rpc_request('echo', '[{}]'.format(i))
+             for i in range(6)] +
+            [self.generate_rpc_request('user_status', '[]', session=key,
+                                       user_id=1)]))
+
+        pool_db = d.Database(DATABASE_HOST, DATABASE_PORT, DATABASE,
+                             DATABASE_USER, DATABASE_PASS, pool_size=2)
+        rpc = e.CrwJsonRpc(pool_db)
+        rpc.batch_pool = ThreadPool(3)
+        rpc.batch_concurrency = 2
+        try:
+            responses = json.loads(rpc.rpc_invoke(batch))
+        finally:
+            rpc.batch_pool.close()
+            rpc.batch_pool.join()
+            pool_db.close_database_connection()
+
+        self.assertEquals([response['result'] for response in responses],
+                          range(6) + [[True, False, False]],
+                          """Test that the responses of a batch invoked
+                          on a pool are in the order of the requests""")
+
+    def test_request_state_reset_after_request(self):
+        key = self.rpc.login(self.USERS[0][0], self.USERS[0][1])
+        self.rpc.rpc_invoke(self.generate_rpc_request(
+            'user_status', '[]', session=key, user_id=1))
+
+        self.assertEquals(self.rpc.current_user_id, -1)
+        self.assertFalse(self.rpc.authenticated)
+        self.assertEquals(self.rpc.current_session, None)
+
+    def test_signed_sessions(self):
+        """Test that signed session tokens authenticate requests without
+        the sessions table, until logging out"""
+        rpc = e.CrwJsonRpc(self.db, sessions=d.SignedSessionDatabase(
+            self.db, 'secret'))
+        key = rpc.login(self.USERS[0][0], self.USERS[0][1])
+        self.db.cursor.execute("""DELETE FROM sessions;""")
+        self.db.commit()
+
+        for user_id in [1, None]:
+            response = json.loads(rpc.rpc_invoke(self.generate_rpc_request(
+                'user_status', '[]', session=key,
+                user_id='null' if user_id is None else user_id)))
+            self.assertEquals(response['result'], [True, False, False])
+
+        rpc.rpc_invoke(self.generate_rpc_request(
+            'logout', '[]', session=key, user_id=1))
+        response = json.loads(rpc.rpc_invoke(self.generate_rpc_request(
+            'user_status', '[]', session=key, user_id=1)))
+        self.assertEquals(response['result'], [False, False, False])
+
+    def test_stream_team_training_data(self):
+        self.set_user_and_authenticated(self.test_team_coach_id)
+        self.rpc.add_to_team(self.USERS[3][0])
+        self.rpc.add_to_team(self.USERS[4][0])
+        self.rpc.add_to_team(self.USERS[0][0])
+        for user_id in [4, 5]:
+            self.set_user_and_authenticated(user_id)
+            for hours in range(3):
+                self.rpc.add_training(
+                    datetime.datetime.now() - datetime.timedelta(hours=hours),
+                    hours == 0, 'Training {}'.format(hours),
+                    [(300, 200 + i, 20, datetime.timedelta(seconds=60))
+                     for i in range(hours + 1)])
+        self.set_user_and_authenticated(-1, False)
+
+        key = self.rpc.login(*self.USERS[self.test_team_coach_id - 1])
+        request = self.generate_rpc_request(
+            'get_team_training_data', '[7]', session=key,
+            user_id=self.test_team_coach_id)
+        chunk_size = jsonrpc.StreamingEncoder.chunk_size
+        jsonrpc.StreamingEncoder.chunk_size = 64
+        try:
+            chunks = list(self.rpc.rpc_invoke_stream(request))
+        finally:
+            jsonrpc.StreamingEncoder.chunk_size = chunk_size
+
+        self.assertGreater(len(chunks), 1)
+        self.assertEquals(''.join(chunks), self.rpc.rpc_invoke(request),
+                          """Test that the streamed response is the same
+                          as the one encoded at once""")
+        self.assertEquals(len(json.loads(''.join(chunks))['result']), 3)
+        self.assertFalse(self.rpc.streaming)
+
+    def test_stream_error(self):
+        request = self.generate_rpc_request('get_team_training_data', '[7]')
+        self.assertEquals(
+            json.loads(''.join(self.rpc.rpc_invoke_stream(request))),
+            json.loads(self.rpc.rpc_invoke(request)))
+        self.assertEquals(
+            list(self.rpc.rpc_invoke_stream(
+                '{"jsonrpc": "2.0", "method": "echo", "params": [1]}')),
+            [], """Test that nothing is streamed for a notification""")
+
+    def test_streaming_encoder(self):
+        obj = {'result': [(i, iter(['a', datetime.date(2017, 1, i + 1)]))
+                          for i in range(3)] + [iter([])]}
+        expected = json.dumps(
+            {'result': [(i, ['a', datetime.date(2017, 1, i + 1)])
+                        for i in range(3)] + [[]]},
+            cls=jsonrpc.DateTimeEncoder)
+        self.assertEquals(''.join(jsonrpc.StreamingEncoder().chunks(obj)),
+                          expected)
+
+    def test_compact_datetimes(self):
+        params = [[{'__type__': 'datetime', 'year': 2017, 'month': 3,
+                    'day': 1, 'hour': 18, 'minute': 30, 'second': 0,
+                    'microsecond': 0},
+                   {'__type__': 'date', 'year': 2017, 'month': 3, 'day': 1},
+                   {'__type__': 'timedelta', 'seconds': 90}]]
+        request = {'jsonrpc': '2.0', 'id': 1, 'method': 'echo',
+                   'params': params}
+
+        response = json.loads(self.rpc.rpc_invoke(json.dumps(request)))
+        self.assertEquals(response['result'], params[0])
+
+        request['datetime_format'] = 'iso'
+        response = json.loads(self.rpc.rpc_invoke(json.dumps(request)))
+        self.assertEquals(response['result'],
+                          ['2017-03-01T18:30:00', '2017-03-01', 90])
+        self.assertEquals(
+            json.loads(''.join(self.rpc.rpc_invoke_stream(
+                json.dumps(request))))['result'],
+            ['2017-03-01T18:30:00', '2017-03-01', 90])
+
+        batch = [request, dict(request, datetime_format='object')]
+        responses = json.loads(self.rpc.rpc_invoke(json.dumps(batch)))
+        self.assertEquals([response['result'][1] for response in responses],
+                          ['2017-03-01', params[0][1]],
+                          """Test that every response of a batch is
+                          encoded in the format of its request""")
+
+    def test_decode_datetimes(self):
+        payload = json.dumps(
+            {'a': [{'__type__': 'date', 'year': 2017, 'month': 3,
+                    'day': 1}],
+             'b': {'__type__': 'timedelta', 'seconds': 90},
+             'c': {'__type__': 'other', 'value': 1}})
+        self.assertEquals(jsonrpc.DateTimeDecoder.loads(payload),
+                          {'a': [datetime.date(2017, 3, 1)],
+                           'b': datetime.timedelta(seconds=90),
+                           'c': {'__type__': 'other', 'value': 1}})
+        self.assertEquals(jsonrpc.DateTimeDecoder.loads('{"a": [1, "b"]}'),
+                          {'a': [1, 'b']})
+
 
 if __name__ == '__main__':
     suite = u.TestLoader()\
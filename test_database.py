@@ -1,6 +1,14 @@
 import unittest as u
 import database as d
 import datetime
+import threading
+import psycopg2
+import migrations
+import passwords
+from multiprocessing.pool import ThreadPool
+from passlib.hash import pbkdf2_sha256
+from session_cache import SessionCache
+from session_reaper import SessionReaper
 from crw import DATABASE_HOST, DATABASE_PORT
 
 # Before testing, make an empty database named userdatabasetest and
@@ -90,12 +98,117 @@ class UserDatabaseTest(DatabaseTest):
             self.udb.verify_user('nieuw@user.nl', 'hunter'),
             """Unable to add a normal, non duplicate user to the database""")
 
+    def test_add_user_returns_id(self):
+        self.assertEquals(self.udb.add_user('nieuw@user.nl', 'hunter'),
+                          len(self.USERS) + 1,
+                          """Test that add_user returns the next id""")
+
+    def test_add_user_concurrently(self):
+        """Test that a user added with the same email address while the
+        password is hashed is reported as an existing user"""
+        db = d.Database(DATABASE_HOST, DATABASE_PORT, DATABASE, user, '', 2)
+
+        def hash_password(password):
+            def add_same_user():
+                with db.connection():
+                    db.cursor.execute(
+                        """INSERT INTO users (email, password)
+                        VALUES (%s, %s);""",
+                        ('nieuw@user.nl', passwords.hash_password('other')))
+                    db.commit()
+            thread = threading.Thread(target=add_same_user)
+            thread.start()
+            thread.join()
+            return passwords.hash_password(password)
+        try:
+            with db.connection(), db.transaction():
+                udb = d.UserDatabase(db)
+                db.hash_password = hash_password
+                with self.assertRaises(d.UserDoesNotExistError):
+                    udb.add_user('nieuw@user.nl', 'hunter')
+        finally:
+            db.close_database_connection()
+        self.assertTrue(self.udb.verify_user('nieuw@user.nl', 'other'))
+
     def test_verify_user_wrong_password(self):
         self.assertFalse(
             self.udb.verify_user('henk@email.com', 'wrong'),
             """Test that verifying a user with an incorrect password
             returns false""")
 
+    def set_password_hash(self, email, password_hash):
+        self.db.cursor.execute(
+            """UPDATE users SET password = %s WHERE email = %s;""",
+            (password_hash, email))
+        self.db.commit()
+
+    def get_password_hash(self, email):
+        self.db.cursor.execute(
+            """SELECT password FROM users WHERE email = %s;""", (email,))
+        return self.db.cursor.fetchone()[0]
+
+    def test_verify_rehashes_stale_hash(self):
+        """Test that a password hashed with another number of rounds is
+        hashed again after a successful login"""
+        self.set_password_hash('henk@email.com',
+                               pbkdf2_sha256.hash('phenk', rounds=1000))
+        self.assertFalse(self.udb.verify_user('henk@email.com', 'wrong'))
+        self.assertTrue(passwords.needs_update(
+            self.get_password_hash('henk@email.com')))
+
+        self.assertTrue(self.udb.verify_user('henk@email.com', 'phenk'))
+        password_hash = self.get_password_hash('henk@email.com')
+        self.assertFalse(passwords.needs_update(password_hash))
+        self.assertTrue(self.udb.verify_user('henk@email.com', 'phenk'))
+        self.assertEquals(self.get_password_hash('henk@email.com'),
+                          password_hash)
+
+    def test_deferred_rehash(self):
+        """Test that the rehash is done on the deferred pool"""
+        self.set_password_hash('henk@email.com',
+                               pbkdf2_sha256.hash('phenk', rounds=1000))
+        # A connection for this thread and one for the deferred pool
+        db = d.Database(DATABASE_HOST, DATABASE_PORT, DATABASE, user, '', 2)
+        db.deferred_pool = ThreadPool(1)
+        try:
+            self.assertTrue(d.UserDatabase(db).verify_user('henk@email.com',
+                                                           'phenk'))
+            db.deferred_pool.close()
+            db.deferred_pool.join()
+        finally:
+            db.close_database_connection()
+        self.assertFalse(passwords.needs_update(
+            self.get_password_hash('henk@email.com')))
+
+    def test_connection_released_while_verifying(self):
+        """Test that other threads can use the connection of a login
+        while its password is verified"""
+        db = d.Database(DATABASE_HOST, DATABASE_PORT, DATABASE, user, '', 1)
+        free_connections = []
+
+        def verify_password(password, password_hash):
+            free_connections.append(db.pool.qsize())
+            return passwords.verify_password(password, password_hash)
+        db.verify_password = verify_password
+        try:
+            with db.connection(), db.transaction():
+                self.assertTrue(d.UserDatabase(db).verify_user(
+                    'henk@email.com', 'phenk'))
+                # The connection is claimed again afterwards
+                self.assertEquals(db.pool.qsize(), 0)
+        finally:
+            db.close_database_connection()
+        self.assertEquals(free_connections, [1])
+
+    def test_rehash_keeps_changed_password(self):
+        """Test that a rehash doesn't overwrite a password changed after
+        the login"""
+        self.set_password_hash('henk@email.com', 'changed')
+        self.udb.rehash_password('henk@email.com', 'phenk',
+                                 pbkdf2_sha256.hash('phenk', rounds=1000))
+        self.assertEquals(self.get_password_hash('henk@email.com'),
+                          'changed')
+
     def test_verify_non_existing_user(self):
         with self.assertRaises(d.UserDoesNotExistError) as a:
             self.udb.verify_user('nietbestaand@email.com', 'blabla')
@@ -397,6 +510,88 @@ class SessionDatabaseTest(DatabaseTest):
                          """Test that remove_expired_keys removes
                          expired keys""")
 
+    def test_generate_keeps_expired_keys(self):
+        """Test that logging in leaves expired keys to the reaper"""
+        expired_key = self.sdb.generate_session_key(1, datetime.
+                                                    timedelta(hours=-1))
+        self.sdb.generate_session_key(1)
+        self.assertEquals(self.sdb.get_session(expired_key)[0], 1)
+
+    def test_remove_expired_sessions(self):
+        for user_id in [1, 2, 2]:
+            self.sdb.generate_session_key(user_id,
+                                          datetime.timedelta(hours=-1))
+        valid_key = self.sdb.generate_session_key(1)
+
+        self.assertEquals(self.sdb.remove_expired_sessions(batch_size=2), 2,
+                          """Test that at most batch_size keys are
+                          removed""")
+        self.assertEquals(self.sdb.remove_expired_sessions(batch_size=2), 1)
+        self.db.cursor.execute("""SELECT key FROM sessions;""")
+        self.assertEquals(self.db.cursor.fetchall(), [(valid_key,)])
+
+
+class CachedSessionDatabaseTest(SessionDatabaseTest):
+    """Runs the SessionDatabase tests again with a cache"""
+    def setUp(self):
+        SessionDatabaseTest.setUp(self)
+        self.cache = SessionCache()
+        self.sdb = d.SessionDatabase(self.db, self.cache)
+
+    def get_stored_exp_date(self, session_key):
+        self.db.cursor.execute(
+            """SELECT exp_date FROM sessions WHERE key = %s;""",
+            (session_key,))
+        return self.db.cursor.fetchone()[0]
+
+    def test_verify_from_cache(self):
+        session_key = self.sdb.generate_session_key(1)
+        self.db.cursor.execute("""DELETE FROM sessions;""")
+
+        self.assertTrue(self.sdb.verify_session_key(1, session_key),
+                        """Test that a cached session key is verified
+                        without the database""")
+
+    def test_remove_session_key_invalidates_cache(self):
+        session_key = self.sdb.generate_session_key(1)
+        self.sdb.remove_session_key(session_key)
+
+        self.assertFalse(self.sdb.verify_session_key(1, session_key),
+                         """Test that a removed session key isn't
+                         verified from the cache""")
+
+    def test_rolled_back_key_not_cached(self):
+        try:
+            with self.db.transaction():
+                session_key = self.sdb.generate_session_key(1)
+                raise ValueError()
+        except ValueError:
+            pass
+        self.assertIsNone(self.cache.get(session_key),
+                          """Test that a session key is only cached once
+                          it is committed""")
+        self.assertFalse(self.sdb.verify_session_key(1, session_key))
+
+    def test_renewal_coalesced(self):
+        session_key = self.sdb.generate_session_key(1)
+        exp_date = self.get_stored_exp_date(session_key)
+        self.sdb.renew_session_key(1, session_key)
+
+        self.assertEquals(self.get_stored_exp_date(session_key), exp_date,
+                          """Test that a renewal within the renew
+                          interval isn't written to the database""")
+
+    def test_stale_renewal_written(self):
+        session_key = self.sdb.generate_session_key(
+            1, datetime.timedelta(days=1))
+        self.sdb.renew_session_key(1, session_key)
+
+        self.assertTrue(self.get_stored_exp_date(session_key) >
+                        datetime.datetime.now() + datetime.timedelta(days=6),
+                        """Test that a renewal is written when the stored
+                        expiration date is older than the renew
+                        interval""")
+
 
 class HealthDatabaseTest(DatabaseTest):
     def test_add_new_health_data(self):
@@ -441,6 +636,36 @@ class HealthDatabaseTest(DatabaseTest):
             self.hdb.add_health_data(-1, datetime.date(1999, 12, 31),
                                      10, 10, '')
 
+    def test_add_health_data_bulk(self):
+        user_id = 2
+        dates = [datetime.date(2017, 1, day) for day in range(1, 15)]
+        self.hdb.add_health_data_bulk(
+            user_id, [(date, 50 + date.day, 70, '') for date in dates])
+
+        for date in dates:
+            self.assertEquals(self.hdb.get_health_data(user_id, date),
+                              (50 + date.day, 70, ''))
+
+    def test_add_health_data_bulk_updates_existing(self):
+        self.hdb.add_health_data_bulk(
+            self.test_health_user_id,
+            [(self.test_health_date, 60, 65, 'First'),
+             (self.test_health_date, 61, 66, 'Second')])
+
+        self.assertEquals(self.hdb.get_health_data(
+            self.test_health_user_id, self.test_health_date),
+            (61, 66, 'Second'),
+            """Test that an existing entry is updated with the last
+            entry for its date""")
+
+    def test_add_health_data_bulk_empty(self):
+        self.hdb.add_health_data_bulk(self.test_health_user_id, [])
+
+    def test_add_health_data_bulk_no_user(self):
+        with self.assertRaises(d.UserDoesNotExistError) as e:
+            self.hdb.add_health_data_bulk(
+                -1, [(datetime.date(1999, 12, 31), 10, 10, '')])
+
     def test_get_health_data(self):
         self.assertEquals(self.hdb.get_health_data(
             self.test_health_user_id, self.test_health_date),
@@ -475,6 +700,28 @@ class HealthDatabaseTest(DatabaseTest):
             """Test that no entries are retreived if the user doesn't
             exist.""")
 
+    def test_get_team_health_data(self):
+        team_id = self.tdb.create_team(2, 'Team ERGON')
+        self.tdb.add_user_to_team(2, 3)
+        self.tdb.add_user_to_team(2, self.test_health_user_id)
+
+        team_health_data = self.hdb.get_team_health_data(team_id)
+        self.assertEquals(
+            [row[0] for row in team_health_data],
+            [self.test_health_user_id] * self.test_health_last_week_amm +
+            [3],
+            """Test that the entries of all members who aren't a coach
+            are returned ordered by user, with a single row for a member
+            without entries.""")
+        self.assertEquals(team_health_data[0][2:],
+                          self.hdb.get_past_health_data(
+                              self.test_health_user_id)[0])
+        self.assertEquals(team_health_data[-1][2:],
+                          (None, None, None, None))
+
+    def test_get_team_health_data_no_team(self):
+        self.assertEquals(self.hdb.get_team_health_data(-1), [])
+
 
 class TrainingDatabaseTest(DatabaseTest):
     def test_add_training_no_user(self):
@@ -494,6 +741,38 @@ class TrainingDatabaseTest(DatabaseTest):
                           """Test that the correct data is saved when
                           adding a new entry.""")
 
+    def test_add_training_with_intervals(self):
+        time = datetime.datetime.now()
+        intervals = [(60, 300, 10, datetime.timedelta(seconds=60)),
+                     (60, 310, 0, datetime.timedelta(seconds=60)),
+                     (120, 250, None, datetime.timedelta(0))]
+        training_id = self.trdb.add_training_with_intervals(
+            1, time, True, 'Intervals', intervals)
+
+        self.assertEquals(self.trdb.get_past_training_data(1),
+                          [(training_id, time, True, 'Intervals')])
+        self.assertEquals(
+            self.idb.get_training_interval_data(training_id),
+            [intervals[0], (60, 310, None, datetime.timedelta(seconds=60)),
+             intervals[2]],
+            """Test that all intervals are added in order, with a pace
+            of 0 stored as None""")
+
+    def test_add_training_with_invalid_interval(self):
+        """Test that nothing is added when one of the intervals can't
+        be added"""
+        with self.assertRaises(psycopg2.IntegrityError) as e:
+            self.trdb.add_training_with_intervals(
+                1, datetime.datetime.now(), True, '',
+                [(60, 300, 10, datetime.timedelta(0)),
+                 (60, None, 10, datetime.timedelta(0))])
+        self.assertEquals(self.trdb.get_past_training_data(1), [])
+
+    def test_add_training_with_intervals_no_user(self):
+        with self.assertRaises(d.UserDoesNotExistError) as e:
+            self.trdb.add_training_with_intervals(
+                -1, datetime.datetime.now(), True, '', [])
+
     def test_get_past_training_data_no_data(self):
         self.assertEquals(
             len(self.trdb.get_past_training_data(4)), 0,
@@ -506,6 +785,53 @@ class TrainingDatabaseTest(DatabaseTest):
             """Test that no entries are retreived if the user doesn't
             exist.""")
 
+    def populate_test_team_training(self):
+        """Creates a team with user 1 as coach and users 2 and 3 as
+        members. User 2 has a recent training with two intervals and
+        an old training, user 3 has no trainings."""
+        self.test_team_id = self.tdb.create_team(1, 'Team ERGON')
+        self.tdb.add_user_to_team(1, 2)
+        self.tdb.add_user_to_team(1, 3)
+
+        self.test_training_time = datetime.datetime.now()
+        self.test_intervals = [
+            (300, 200, 20, datetime.timedelta(minutes=2)),
+            (60, 250, 0, datetime.timedelta(seconds=30))]
+        training_id = self.trdb.add_training(
+            2, self.test_training_time, True, 'Recent')
+        for interval in self.test_intervals:
+            self.idb.add_interval(training_id, *interval)
+
+        self.trdb.add_training(
+            2, self.test_training_time - datetime.timedelta(days=30),
+            False, 'Old')
+
+    def test_get_team_training_data(self):
+        self.populate_test_team_training()
+        self.assertEquals(
+            self.trdb.get_team_training_data(self.test_team_id),
+            [(self.USERS[1][0],
+              [(self.test_training_time, True, 'Recent',
+                [self.test_intervals[0],
+                 (60, 250, None, datetime.timedelta(seconds=30))])]),
+             (self.USERS[2][0], [])],
+            """Test that the recent trainings of all members who aren't
+            a coach are returned with their intervals in order.""")
+
+    def test_get_team_training_data_longer_period(self):
+        self.populate_test_team_training()
+        member_trainings = self.trdb.get_team_training_data(
+            self.test_team_id, datetime.timedelta(days=31))[0][1]
+        self.assertEquals([training[2] for training in member_trainings],
+                          ['Old', 'Recent'],
+                          """Test that trainings are ordered by time and
+                          that a training without intervals is
+                          included.""")
+        self.assertEquals(member_trainings[0][3], [])
+
+    def test_get_team_training_data_no_team(self):
+        self.assertEquals(self.trdb.get_team_training_data(-1), [])
+
 
 class IntervalDatabaseTest(DatabaseTest):
     def test_add_new_interval(self):
@@ -534,6 +860,340 @@ class IntervalDatabaseTest(DatabaseTest):
                 10, 10)
 
 
+class SignedSessionDatabaseTest(DatabaseTest):
+    def setUp(self):
+        DatabaseTest.setUp(self)
+        self.sdb = d.SignedSessionDatabase(self.db, 'secret')
+
+    def test_generate_correct_session_key(self):
+        session_key = self.sdb.generate_session_key(2)
+        self.assertTrue(self.sdb.verify_session_key(2, session_key))
+        self.assertEquals(self.sdb.get_user_id_by_sessionkey(session_key), 2)
+        self.assertFalse(self.sdb.verify_session_key(1, session_key))
+
+    def test_generate_for_non_existing_user(self):
+        with self.assertRaises(d.UserDoesNotExistError):
+            self.sdb.generate_session_key(1000)
+
+    def test_no_session_queries(self):
+        """Test that tokens are verified without the database"""
+        session_key = self.sdb.generate_session_key(2)
+        self.db.drop_all_tables()
+        try:
+            self.assertTrue(self.sdb.verify_session_key(2, session_key))
+        finally:
+            self.db.init_database()
+
+    def test_expired_session_key(self):
+        session_key = self.sdb.generate_session_key(
+            2, datetime.timedelta(hours=-1))
+        self.assertFalse(self.sdb.verify_session_key(2, session_key))
+        self.sdb.renew_session_key(2, session_key)
+        self.assertFalse(self.sdb.verify_session_key(2, session_key),
+                         """Test that tokens can't be renewed""")
+
+    def test_tampered_session_key(self):
+        (user_id, expires, nonce, signature) = \
+            self.sdb.generate_session_key(2).split('.')
+        for session_key in ['.'.join(['1', expires, nonce, signature]),
+                            '.'.join([user_id, str(int(expires) + 1), nonce,
+                                      signature]),
+                            d.SignedSessionDatabase(self.db, 'other')
+                            .generate_session_key(2)]:
+            self.assertFalse(self.sdb.verify_session_key(
+                int(session_key.split('.')[0]), session_key), session_key)
+
+    def test_invalid_session_keys(self):
+        for session_key in [None, '', 'abc', 'a.b.c.d', u'\xe9.1.2.3', 5]:
+            self.assertFalse(self.sdb.verify_session_key(2, session_key))
+            self.assertIsNone(self.sdb.get_user_id_by_sessionkey(
+                session_key))
+
+    def test_revoke(self):
+        session_key = self.sdb.generate_session_key(2)
+        other_process = d.SignedSessionDatabase(self.db, 'secret')
+        self.sdb.remove_session_key(session_key)
+        self.assertFalse(self.sdb.verify_session_key(2, session_key))
+
+        self.assertTrue(other_process.verify_session_key(2, session_key))
+        other_process.refresh()
+        self.assertFalse(other_process.verify_session_key(2, session_key),
+                         """Test that revocations are read from the
+                         database""")
+
+    def test_remove_expired_revocations(self):
+        self.sdb.remove_session_key(self.sdb.generate_session_key(
+            2, datetime.timedelta(hours=-1)))
+        valid_key = self.sdb.generate_session_key(2)
+        self.sdb.remove_session_key(valid_key)
+
+        self.assertEquals(self.sdb.remove_expired_sessions(), 1)
+        self.assertEquals(len(self.sdb.revoked), 1)
+        self.assertFalse(self.sdb.verify_session_key(2, valid_key))
+
+    def test_refresh_forgets_expired_revocations(self):
+        self.sdb.remove_session_key(self.sdb.generate_session_key(
+            2, datetime.timedelta(hours=-1)))
+        valid_key = self.sdb.generate_session_key(2)
+        self.sdb.remove_session_key(valid_key)
+
+        self.sdb.refresh()
+        self.assertEquals(len(self.sdb.revoked), 1,
+                          """Test that revocations of expired tokens are
+                          forgotten without reaping""")
+        self.assertFalse(self.sdb.verify_session_key(2, valid_key))
+
+
+class SessionReaperTest(DatabaseTest):
+    def test_reap(self):
+        for user_id in [1, 2, 3]:
+            self.sdb.generate_session_key(user_id,
+                                          datetime.timedelta(hours=-1))
+        valid_key = self.sdb.generate_session_key(1)
+        reaper = SessionReaper(self.db, batch_size=2, max_batches=10)
+
+        self.assertEquals(reaper.reap(), 3)
+        self.assertEquals(reaper.reap(), 0)
+        self.assertTrue(self.sdb.verify_session_key(1, valid_key))
+        metrics = reaper.metrics()
+        self.assertEquals(metrics['runs'], 2)
+        self.assertEquals(metrics['reaped'], 3)
+        self.assertEquals(metrics['last_reaped'], 0)
+        self.assertTrue(metrics['table_bytes'] > 0)
+
+    def test_max_batches(self):
+        for user_id in [1, 2, 3]:
+            self.sdb.generate_session_key(user_id,
+                                          datetime.timedelta(hours=-1))
+        reaper = SessionReaper(self.db, batch_size=1, max_batches=2)
+        self.assertEquals(reaper.reap(), 2,
+                          """Test that a run stops after max_batches""")
+        self.assertEquals(reaper.reap(), 1)
+
+
+class MigrationTest(DatabaseTest):
+    def get_index_names(self):
+        self.db.cursor.execute(
+            """SELECT indexname FROM pg_indexes
+            WHERE schemaname = current_schema();""")
+        return [row[0] for row in self.db.cursor.fetchall()]
+
+    def test_initialized_database_is_latest_version(self):
+        self.assertEquals(self.db.get_schema_version(),
+                          migrations.MIGRATIONS[-1][0],
+                          """Test that a newly initialized database has
+                          all migrations applied""")
+
+    def test_migrate_twice(self):
+        version = self.db.get_schema_version()
+        self.assertEquals(self.db.migrate(), version,
+                          """Test that migrating an up to date database
+                          doesn't change the version""")
+
+    def test_migrations_idempotent(self):
+        self.db.cursor.execute("""DELETE FROM schema_version;""")
+        self.assertEquals(self.db.migrate(), migrations.MIGRATIONS[-1][0],
+                          """Test that migrations can be applied again
+                          to a database that already has the changes""")
+
+    def test_hot_path_indexes_exist(self):
+        index_names = self.get_index_names()
+        for index_name in ['health_data_user_id_date_key',
+                           'sessions_user_id_exp_date_idx',
+                           'training_data_user_id_time_idx',
+                           'interval_data_training_id_idx',
+                           'users_team_id_idx',
+                           'sessions_exp_date_idx',
+                           'revoked_sessions_exp_date_idx']:
+            self.assertTrue(index_name in index_names, index_name)
+
+    def test_sequence_continues_after_existing_ids(self):
+        self.db.cursor.execute(
+            """INSERT INTO teams (id, name) VALUES (50, 'Old team');""")
+        self.db.cursor.execute(
+            """DELETE FROM schema_version WHERE version >= 2;""")
+        self.db.migrate()
+
+        self.assertEquals(self.tdb.create_team(1, 'New team'), 51,
+                          """Test that migrating an existing database
+                          continues the ids after the highest one""")
+
+    def test_is_initialized(self):
+        self.assertTrue(self.db.is_initialized())
+
+    def test_health_data_unique_per_day(self):
+        with self.assertRaises(psycopg2.IntegrityError) as e:
+            self.db.cursor.execute(
+                """INSERT INTO health_data
+                (user_id, date, resting_heart_rate, weight, comment)
+                VALUES (%s, %s, 0, 0, '');""",
+                (self.test_health_user_id, self.test_health_date))
+        self.db.database_connection.rollback()
+
+
+class TransactionTest(DatabaseTest):
+    def count_teams(self):
+        self.db.cursor.execute("""SELECT COUNT(*) FROM teams;""")
+        return self.db.cursor.fetchone()[0]
+
+    def test_transaction_committed_at_end(self):
+        with self.db.transaction():
+            self.tdb.create_team(1, 'Team ERGON')
+            self.tdb.create_team(2, 'Team crw')
+            self.db.database_connection.rollback()
+        self.assertEquals(self.count_teams(), 0,
+                          """Test that the commits of the database
+                          classes are deferred to the end of the
+                          transaction""")
+
+    def test_transaction_rolled_back_on_error(self):
+        with self.assertRaises(d.UserDoesNotExistError) as e:
+            with self.db.transaction():
+                self.tdb.create_team(1, 'Team ERGON')
+                self.tdb.create_team(-1, 'Team crw')
+        self.assertEquals(self.count_teams(), 0,
+                          """Test that all changes in a transaction are
+                          rolled back when an error is raised""")
+
+    def test_nested_transaction_error_rolls_back(self):
+        with self.db.transaction():
+            self.tdb.create_team(1, 'Team ERGON')
+            try:
+                with self.db.transaction():
+                    self.tdb.create_team(-1, 'Team crw')
+            except d.UserDoesNotExistError:
+                pass
+        self.assertEquals(self.count_teams(), 0,
+                          """Test that an error in a nested transaction
+                          rolls back the outer transaction""")
+
+    def test_commit_outside_transaction(self):
+        self.tdb.create_team(1, 'Team ERGON')
+        self.db.database_connection.rollback()
+        self.assertEquals(self.count_teams(), 1)
+
+    def test_after_commit(self):
+        calls = []
+        with self.db.transaction():
+            self.db.after_commit(calls.append, 'committed')
+            self.assertEquals(calls, [])
+        self.assertEquals(calls, ['committed'])
+
+        with self.db.transaction():
+            self.db.after_commit(calls.append, 'rolled back')
+            self.db.rollback()
+        self.assertEquals(calls, ['committed'],
+                          """Test that nothing is called after a
+                          transaction is rolled back""")
+
+    def test_rollback_in_transaction(self):
+        with self.db.transaction():
+            self.tdb.create_team(1, 'Team ERGON')
+            self.db.rollback()
+            self.assertTrue(self.db.in_transaction())
+        self.assertFalse(self.db.in_transaction())
+        self.assertEquals(self.count_teams(), 0)
+
+
+class ConnectionPoolTest(DatabaseTest):
+    def setUp(self):
+        DatabaseTest.setUp(self)
+        self.pool_db = d.Database(DATABASE_HOST, DATABASE_PORT, DATABASE,
+                                  user, '', pool_size=2)
+
+    def tearDown(self):
+        self.pool_db.close_database_connection()
+        DatabaseTest.tearDown(self)
+
+    def connection_of_other_thread(self):
+        """Returns the connection a new thread gets inside a
+        connection block."""
+        connections = []
+
+        def claim():
+            with self.pool_db.connection():
+                connections.append(self.pool_db.database_connection)
+
+        thread = threading.Thread(target=claim)
+        thread.start()
+        thread.join()
+        return connections[0]
+
+    def test_threads_use_different_connections(self):
+        with self.pool_db.connection():
+            self.assertNotEqual(self.connection_of_other_thread(),
+                                self.pool_db.database_connection,
+                                """Test that two threads inside a
+                                connection block don't share a
+                                connection""")
+
+    def test_connection_returned_to_pool(self):
+        with self.pool_db.connection():
+            own_connection = self.pool_db.database_connection
+        self.connection_of_other_thread()
+        self.connection_of_other_thread()
+        self.assertEquals(self.pool_db.pool.qsize(), 2,
+                          """Test that connections are returned to the
+                          pool after the connection block""")
+        self.assertTrue(own_connection in self.pool_db.connections)
+
+    def test_broken_connection_returned_to_pool(self):
+        with self.assertRaises(psycopg2.InterfaceError):
+            with self.pool_db.connection():
+                # The rollback at the end of the block fails
+                self.pool_db.database_connection.close()
+        self.assertEquals(self.pool_db.pool.qsize(), 2,
+                          """Test that a connection is returned to the
+                          pool when it can't be rolled back""")
+        self.assertEquals(self.pool_db.local.connection, None)
+
+    def test_nested_connection_blocks(self):
+        with self.pool_db.connection():
+            outer_connection = self.pool_db.database_connection
+            with self.pool_db.connection():
+                self.assertEquals(self.pool_db.database_connection,
+                                  outer_connection,
+                                  """Test that a nested connection block
+                                  reuses the connection of the outer
+                                  block""")
+            self.assertEquals(self.pool_db.pool.qsize(), 1)
+
+    def test_concurrent_add_training(self):
+        trdb = d.TrainingDatabase(self.pool_db)
+        training_ids = []
+
+        def add_trainings():
+            with self.pool_db.connection():
+                for _ in range(10):
+                    training_ids.append(trdb.add_training(
+                        1, datetime.datetime.now(), True, ''))
+
+        threads = [threading.Thread(target=add_trainings)
+                   for _ in range(2)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEquals(sorted(training_ids), range(1, 21),
+                          """Test that trainings added at the same time
+                          through different connections get unique
+                          ids""")
+
+    def test_pool_connection_sees_committed_data(self):
+        def count_users():
+            with self.pool_db.connection():
+                self.pool_db.cursor.execute(
+                    """SELECT COUNT(*) FROM users;""")
+                counts.append(self.pool_db.cursor.fetchone()[0])
+
+        counts = []
+        thread = threading.Thread(target=count_users)
+        thread.start()
+        thread.join()
+        self.assertEquals(counts, [len(self.USERS)])
+
+
 if __name__ == '__main__':
     suite1 = u.TestLoader()\
               .loadTestsFromTestCase(UserDatabaseTest)
@@ -0,0 +1,218 @@
+import unittest as u
+import asyncore
+import errno
+import httplib
+import json
+import mimetools
+import os
+import select
+import socket
+import threading
+import time
+from cStringIO import StringIO
+import database as d
+import event_server
+import http_redirector
+import http_server
+from crw_jsonrpc import CrwJsonRpc
+from static_files import AssetCache, RouteTable
+from crw import DATABASE_HOST, DATABASE_PORT, DATABASE_USER, DATABASE_PASS
+
+# Before testing, make an empty database named userdatabasetest with the same
+# username and password as stated in crw.cfg
+
+DATABASE = 'userdatabasetest'
+
+
+class EventServerTest(u.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.db = d.Database(DATABASE_HOST, DATABASE_PORT, DATABASE,
+                            DATABASE_USER, DATABASE_PASS, pool_size=2)
+        http_server.rpc = CrwJsonRpc(cls.db)
+        http_server.assets = AssetCache()
+        http_server.routes = RouteTable('static')
+        event_server.HttpChannel.log_request = lambda *args: None
+
+        cls.server = event_server.EventServer(2)
+        cls.server.request_timeout = 2
+        cls.server.send_timeout = 2
+        cls.port = cls.server.listen(
+            ('localhost', 0), event_server.HttpChannel)\
+            .socket.getsockname()[1]
+        cls.redirect_port = cls.server.listen(
+            ('localhost', 0), http_redirector.RedirectChannel)\
+            .socket.getsockname()[1]
+        thread = threading.Thread(target=cls.server.serve_forever)
+        thread.daemon = True
+        thread.start()
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.db.close_database_connection()
+
+    def rpc_request(self, request_id, method, params):
+        return json.dumps({'jsonrpc': '2.0', 'id': request_id,
+                           'method': method, 'params': params})
+
+    def test_static_files(self):
+        connection = httplib.HTTPConnection('localhost', self.port)
+        connection.request('GET', '/promo/LICENSE')
+        response = connection.getresponse()
+        self.assertEquals(response.status, 200)
+        self.assertEquals(response.read(), open('static/promo/LICENSE').read())
+
+        # The same connection is used for the next request
+        connection.request('GET', '/promo/missing')
+        response = connection.getresponse()
+        self.assertEquals(response.status, 404)
+        response.read()
+        connection.close()
+
+    def test_rpc(self):
+        connection = httplib.HTTPConnection('localhost', self.port)
+        connection.request('POST', '/rpc',
+                           self.rpc_request(1, 'echo', ['crw']))
+        response = connection.getresponse()
+        self.assertEquals(response.status, 200)
+        self.assertEquals(json.loads(response.read())['result'], 'crw')
+        connection.close()
+
+    def test_pipelined_requests(self):
+        request = self.rpc_request(1, 'echo', ['crw'])
+        connection = socket.create_connection(('localhost', self.port))
+        connection.sendall(
+            'POST /rpc HTTP/1.1\r\nContent-Length: {}\r\n\r\n{}'
+            'GET /promo/LICENSE HTTP/1.1\r\nConnection: close\r\n\r\n'
+            .format(len(request), request))
+        data = ''.join(iter(lambda: connection.recv(65536), ''))
+        connection.close()
+        self.assertLess(data.index('"result": "crw"'),
+                        data.index('Connection: close'),
+                        """Test that responses are sent in the order of
+                        the requests""")
+
+    def test_redirect(self):
+        # A client that never sends its request doesn't hold up others
+        idle = socket.create_connection(('localhost', self.redirect_port))
+        connection = httplib.HTTPConnection('localhost', self.redirect_port,
+                                            timeout=1)
+        for path in ['/promo/index.html', '/?page=2']:
+            # Both requests are sent on the same connection
+            connection.request('GET', path)
+            response = connection.getresponse()
+            self.assertEquals(response.status, 302)
+            self.assertTrue(response.getheader('location').endswith(path))
+            response.read()
+        connection.close()
+        idle.close()
+
+    def test_redirect_other_host(self):
+        base = http_redirector.redirect_location('/')
+        for path in ['@evil.example/', '//evil.example/', '.evil.example',
+                     'http://evil.example/']:
+            self.assertEquals(http_redirector.redirect_location(path), base,
+                              """Test that a request target that isn't a
+                              path doesn't redirect to another host""")
+
+    def test_slow_request(self):
+        connection = socket.create_connection(('localhost', self.port))
+        connection.settimeout(1)
+        # A request sent a byte per second is cut off after the
+        # request_timeout of 2 seconds
+        closed = False
+        for byte in 'GET /promo/LICENSE HTTP/1.1\r\n':
+            try:
+                connection.sendall(byte)
+                closed = connection.recv(1) == ''
+            except socket.timeout:
+                pass
+            except socket.error:
+                closed = True
+            if closed:
+                break
+        connection.close()
+        self.assertTrue(closed)
+
+    def test_client_not_reading(self):
+        connection = socket.socket()
+        connection.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 4096)
+        connection.connect(('localhost', self.port))
+        connection.sendall('GET /promo/Gebruikershandleiding.pdf '
+                           'HTTP/1.1\r\n\r\n' * 16)
+        # Longer than the send_timeout of 2 seconds
+        time.sleep(4)
+        connection.settimeout(5)
+        received = 0
+        try:
+            for data in iter(lambda: connection.recv(65536), ''):
+                received += len(data)
+        except socket.error, e:
+            # Reset when data sent to the client was still unread
+            self.assertNotEqual(type(e), socket.timeout)
+        connection.close()
+        size = os.path.getsize('static/promo/Gebruikershandleiding.pdf')
+        self.assertTrue(received < 16 * size,
+                        """Test that a connection whose client doesn't
+                        read the responses is closed""")
+
+
+class ChannelTest(u.TestCase):
+    def setUp(self):
+        self.server = event_server.EventServer(0)
+        (self.sock, self.client) = socket.socketpair()
+        self.channel = event_server.HttpChannel(self.server, self.sock,
+                                                ('localhost', 1))
+
+    def tearDown(self):
+        self.channel.close()
+        self.client.close()
+
+    def test_max_pipelined(self):
+        self.assertTrue(self.channel.readable())
+        self.channel.busy = True
+        headers = mimetools.Message(StringIO(''))
+        for _ in range(event_server.HttpChannel.max_pipelined):
+            self.channel.handle_request('GET', '/', 'HTTP/1.1', headers, '')
+        self.assertFalse(self.channel.readable(),
+                         """Test that no more requests are read while
+                         max_pipelined requests are waiting""")
+        self.channel.busy = False
+        self.channel.waiting.clear()
+        self.assertTrue(self.channel.readable())
+
+
+class ListenerTest(u.TestCase):
+    def setUp(self):
+        self.server = event_server.EventServer(0)
+        self.listener = self.server.listen(('localhost', 0),
+                                           event_server.HttpChannel)
+        self.listener.log_info = lambda *args: None
+
+    def tearDown(self):
+        self.listener.close()
+
+    def test_out_of_file_descriptors(self):
+        def accept():
+            raise socket.error(errno.EMFILE, 'Too many open files')
+        self.listener.accept = accept
+        asyncore.readwrite(self.listener, select.POLLIN)
+        self.assertFalse(self.listener.readable(),
+                         """Test that the listener isn't polled while
+                         accepting fails for lack of file descriptors""")
+
+        self.listener.paused_until = time.time() - 1
+        self.server.socket_map.changed = set()
+        self.server.resume_listeners()
+        self.assertTrue(self.listener.readable())
+        self.assertIn(self.listener._fileno, self.server.socket_map.changed)
+
+    def test_error_keeps_listening(self):
+        def accept():
+            raise socket.error(errno.EPERM, 'Operation not permitted')
+        self.listener.accept = accept
+        asyncore.readwrite(self.listener, select.POLLIN)
+        self.assertIn(self.listener._fileno, self.server.socket_map,
+                      """Test that the listener isn't closed when
+                      accepting a connection fails""")
+        self.assertTrue(self.listener.accepting)
@@ -0,0 +1,187 @@
+import unittest as u
+import httplib
+import json
+import shutil
+import socket
+import ssl
+import tempfile
+import threading
+import benchmark
+import database as d
+import http_server
+from crw_jsonrpc import CrwJsonRpc
+from static_files import AssetCache, RouteTable
+from crw import DATABASE_HOST, DATABASE_PORT, DATABASE_USER, DATABASE_PASS
+
+# Before testing, make an empty database named userdatabasetest with the same
+# username and password as stated in crw.cfg
+
+DATABASE = 'userdatabasetest'
+
+
+class HttpServerTest(u.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.db = d.Database(DATABASE_HOST, DATABASE_PORT, DATABASE,
+                            DATABASE_USER, DATABASE_PASS, pool_size=2)
+        http_server.rpc = CrwJsonRpc(cls.db)
+        http_server.assets = AssetCache()
+        http_server.routes = RouteTable('static')
+        http_server.FileServer.log_message = lambda *args: None
+        cls.handler_settings = (http_server.FileServer.timeout,
+                                http_server.FileServer.max_requests)
+        http_server.FileServer.timeout = 1
+        http_server.FileServer.max_requests = 2
+
+        cls.server = http_server.create_server(('localhost', 0), 2)
+        cls.port = cls.server.server_address[1]
+        thread = threading.Thread(target=cls.server.serve_forever)
+        thread.daemon = True
+        thread.start()
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.shutdown()
+        cls.server.server_close()
+        (http_server.FileServer.timeout,
+         http_server.FileServer.max_requests) = cls.handler_settings
+        del http_server.FileServer.log_message
+        cls.db.close_database_connection()
+
+    def rpc_request(self, method, params, request_id=None):
+        request = {'jsonrpc': '2.0', 'method': method, 'params': params}
+        if request_id is not None:
+            request['id'] = request_id
+        return json.dumps(request)
+
+    def raw_request(self, data):
+        """Sends data on a new connection and returns everything the
+        server sent until it closed the connection."""
+        connection = socket.create_connection(('localhost', self.port))
+        connection.settimeout(5)
+        try:
+            connection.sendall(data)
+            return ''.join(iter(lambda: connection.recv(65536), ''))
+        finally:
+            connection.close()
+
+    def test_notification(self):
+        connection = httplib.HTTPConnection('localhost', self.port)
+        connection.request('POST', '/rpc', self.rpc_request('echo', ['crw']))
+        response = connection.getresponse()
+        self.assertEquals(response.status, 204)
+        self.assertEquals(response.read(), '')
+
+        # The connection is kept open for the next request
+        connection.request('POST', '/rpc',
+                           self.rpc_request('echo', ['crw'], 1))
+        response = connection.getresponse()
+        self.assertEquals(json.loads(response.read())['result'], 'crw')
+        connection.close()
+
+    def test_length_required(self):
+        response = self.raw_request('POST /rpc HTTP/1.1\r\n\r\n')
+        self.assertTrue(response.startswith('HTTP/1.1 411 '))
+        (headers, _, body) = response.partition('\r\n\r\n')
+        self.assertIn('Content-Length: {}\r\n'.format(len(body)),
+                      headers + '\r\n',
+                      """Test that error responses have a
+                      Content-Length""")
+
+    def test_post_not_found(self):
+        connection = httplib.HTTPConnection('localhost', self.port)
+        connection.request('POST', '/other', 'data')
+        response = connection.getresponse()
+        self.assertEquals(response.status, 404)
+        body = response.read()
+        self.assertEquals(response.getheader('content-length'),
+                          str(len(body)))
+        self.assertEquals(response.getheader('connection'), 'close')
+        connection.close()
+
+    def test_max_requests(self):
+        request = self.rpc_request('echo', ['crw'], 1)
+        message = 'POST /rpc HTTP/1.1\r\nContent-Length: {}\r\n\r\n{}'\
+            .format(len(request), request)
+        response = self.raw_request(message * 3)
+        self.assertEquals(response.count('HTTP/1.1 200 '), 2,
+                          """Test that the connection is closed after
+                          max_requests requests""")
+        self.assertEquals(response.count('Connection: close'), 1)
+
+    def test_idle_timeout(self):
+        connection = socket.create_connection(('localhost', self.port))
+        connection.settimeout(5)
+        try:
+            self.assertEquals(connection.recv(1), '',
+                              """Test that an idle connection is closed
+                              after the timeout""")
+        finally:
+            connection.close()
+
+
+class SslContextTest(u.TestCase):
+    CIPHERS = 'ECDHE-RSA-AES256-GCM-SHA384:ECDHE-RSA-AES128-GCM-SHA256'
+
+    @classmethod
+    def setUpClass(cls):
+        cls.directory = tempfile.mkdtemp()
+        (cls.certfile, cls.keyfile) = \
+            benchmark.create_certificate(cls.directory)
+
+    @classmethod
+    def tearDownClass(cls):
+        shutil.rmtree(cls.directory)
+
+    def context(self, session_tickets=True):
+        return http_server.create_ssl_context(
+            self.certfile, self.keyfile, self.CIPHERS, session_tickets)
+
+    def handshake(self, context, client_ciphers):
+        """Makes a TLS 1.2 handshake with a client offering
+        client_ciphers, and returns the cipher the server chose."""
+        (server_sock, client_sock) = [socket.socket(_sock=sock)
+                                      for sock in socket.socketpair()]
+        client_context = ssl.SSLContext(ssl.PROTOCOL_TLSv1_2)
+        client_context.set_ciphers(client_ciphers)
+
+        def connect():
+            try:
+                client_context.wrap_socket(client_sock).close()
+            except (ssl.SSLError, socket.error):
+                # The server refused the handshake
+                pass
+        thread = threading.Thread(target=connect)
+        thread.start()
+        try:
+            return context.wrap_socket(server_sock,
+                                       server_side=True).cipher()[0]
+        finally:
+            server_sock.close()
+            thread.join()
+            client_sock.close()
+
+    def test_session_tickets(self):
+        self.assertFalse(self.context(True).options &
+                         http_server.OP_NO_TICKET)
+        self.assertTrue(self.context(False).options &
+                        http_server.OP_NO_TICKET,
+                        """Test that session tickets are disabled as
+                        configured""")
+
+    def test_server_cipher_preference(self):
+        context = self.context()
+        self.assertTrue(context.options & ssl.OP_CIPHER_SERVER_PREFERENCE)
+        self.assertEquals(
+            self.handshake(context, 'ECDHE-RSA-AES128-GCM-SHA256:'
+                           'ECDHE-RSA-AES256-GCM-SHA384'),
+            'ECDHE-RSA-AES256-GCM-SHA384',
+            """Test that the first configured cipher the client supports
+            is used, whatever the preference of the client""")
+
+    def test_configured_ciphers(self):
+        self.assertEquals(
+            self.handshake(self.context(), 'ECDHE-RSA-AES128-GCM-SHA256'),
+            'ECDHE-RSA-AES128-GCM-SHA256')
+        with self.assertRaises(ssl.SSLError):
+            self.handshake(self.context(), 'AES128-SHA')
@@ -0,0 +1,86 @@
+import unittest as u
+import threading
+import time
+from multiprocessing.pool import ThreadPool
+from login_throttle import LoginThrottle
+
+
+class LoginThrottleTest(u.TestCase):
+    def setUp(self):
+        self.throttle = LoginThrottle(burst=2, rate=0.1, backoff=0.5,
+                                      max_backoff=1, size=2)
+
+    def test_burst(self):
+        for _ in range(2):
+            self.assertEquals(self.throttle.acquire('key'), 0)
+        self.assertTrue(9 < self.throttle.acquire('key') <= 10,
+                        """Test that the bucket is refilled with rate
+                        attempts per second""")
+        self.assertEquals(self.throttle.acquire('other'), 0)
+
+    def test_refused_attempt_is_free(self):
+        self.throttle.acquire('key')
+        self.throttle.acquire('key')
+        self.throttle.acquire('key')
+        self.assertTrue(9 < self.throttle.acquire('key') <= 10,
+                        """Test that refused attempts don't take from the
+                        bucket""")
+
+    def test_release(self):
+        self.throttle.acquire('key')
+        self.throttle.acquire('key')
+        self.throttle.release('key')
+        self.assertEquals(self.throttle.acquire('key'), 0)
+
+    def test_parallel_attempts(self):
+        """Test that no more than burst of many simultaneous attempts
+        are let through"""
+        throttle = LoginThrottle(burst=5, rate=0.001)
+        start = threading.Event()
+
+        def attempt(_):
+            start.wait()
+            return throttle.acquire('key')
+        pool = ThreadPool(20)
+        try:
+            result = pool.map_async(attempt, range(100))
+            start.set()
+            waits = result.get(10)
+        finally:
+            pool.close()
+        self.assertEquals(waits.count(0), 5)
+
+    def test_rate_zero(self):
+        with self.assertRaises(ValueError):
+            LoginThrottle(burst=1, rate=0)
+
+    def test_refill(self):
+        throttle = LoginThrottle(burst=1, rate=100)
+        throttle.acquire('key')
+        time.sleep(0.02)
+        self.assertEquals(throttle.acquire('key'), 0)
+
+    def test_backoff(self):
+        self.throttle.failed('key')
+        self.assertTrue(0.4 < self.throttle.acquire('key') <= 0.5)
+        self.throttle.failed('key')
+        self.assertTrue(0.9 < self.throttle.acquire('key') <= 1)
+        self.throttle.failed('key')
+        self.assertTrue(0.9 < self.throttle.acquire('key') <= 1,
+                        """Test that the backoff doesn't exceed
+                        max_backoff""")
+
+    def test_success_resets_backoff(self):
+        self.throttle.failed('key')
+        self.throttle.succeeded('key')
+        self.assertEquals(self.throttle.acquire('key'), 0)
+        self.throttle.failed('key')
+        self.assertTrue(0.4 < self.throttle.acquire('key') <= 0.5)
+
+    def test_forget_least_recently_used(self):
+        self.throttle.failed('first')
+        self.throttle.failed('second')
+        self.throttle.acquire('first')
+        self.throttle.acquire('third')
+        self.assertTrue(self.throttle.acquire('first') > 0)
+        self.assertEquals(self.throttle.acquire('second'), 0)
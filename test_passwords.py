@@ -0,0 +1,46 @@
+import unittest as u
+from passlib.hash import pbkdf2_sha256
+import passwords
+from passwords import PasswordPool, PasswordPoolFull, verify_password
+
+
+class ConfigureTest(u.TestCase):
+    def setUp(self):
+        self.settings = passwords.pwd_context.to_dict()
+
+    def tearDown(self):
+        passwords.pwd_context.load(self.settings)
+
+    def test_default_rounds(self):
+        password_hash = passwords.hash_password('password')
+        self.assertEquals(pbkdf2_sha256.from_string(password_hash).rounds,
+                          pbkdf2_sha256.default_rounds)
+
+    def test_configure(self):
+        passwords.configure(1000)
+        password_hash = passwords.hash_password('password')
+        self.assertEquals(pbkdf2_sha256.from_string(password_hash).rounds,
+                          1000)
+        self.assertFalse(passwords.needs_update(password_hash))
+
+
+class PasswordPoolTest(u.TestCase):
+    def setUp(self):
+        self.pool = PasswordPool(processes=1, max_pending=1)
+
+    def tearDown(self):
+        self.pool.close()
+
+    def test_hash_and_verify(self):
+        password_hash = self.pool.hash('password')
+        self.assertTrue(verify_password('password', password_hash))
+        self.assertTrue(self.pool.verify('password', password_hash))
+        self.assertFalse(self.pool.verify('incorrect', password_hash))
+
+    def test_full(self):
+        """Test that a password isn't queued behind max_pending others"""
+        self.pool.slots.acquire()
+        with self.assertRaises(PasswordPoolFull):
+            self.pool.hash('password')
+        self.pool.slots.release()
+        self.assertTrue(self.pool.hash('password'))
@@ -0,0 +1,69 @@
+import unittest as u
+import datetime
+from session_cache import SessionCache
+
+
+class SessionCacheTest(u.TestCase):
+    def setUp(self):
+        self.exp_date = datetime.datetime.now() + datetime.timedelta(weeks=1)
+        self.cache = SessionCache(size=2)
+
+    def test_get_cached_session(self):
+        self.cache.put('key', 1, self.exp_date)
+        self.assertEquals(self.cache.get('key'), (1, self.exp_date))
+
+    def test_get_not_cached_session(self):
+        self.assertEquals(self.cache.get('key'), None)
+
+    def test_invalidate(self):
+        self.cache.put('key', 1, self.exp_date)
+        self.cache.invalidate('key')
+        self.assertEquals(self.cache.get('key'), None)
+
+    def test_put_invalidated(self):
+        self.cache.invalidate('key')
+        self.cache.put('key', 1, self.exp_date)
+        self.assertEquals(self.cache.get('key'), None,
+                          """Test that a key read from the database before
+                          its removal was committed isn't cached again""")
+
+    def test_put_after_invalidation_expired(self):
+        cache = SessionCache(ttl=datetime.timedelta(seconds=-1))
+        cache.invalidate('key')
+        cache.put('key', 1, self.exp_date)
+        self.assertEquals(cache.sessions['key'][0], 1)
+
+    def test_expired_entry(self):
+        cache = SessionCache(ttl=datetime.timedelta(seconds=-1))
+        cache.put('key', 1, self.exp_date)
+        self.assertEquals(cache.get('key'), None,
+                          """Test that entries aren't used after their
+                          time to live""")
+
+    def test_evict_least_recently_used(self):
+        self.cache.put('key1', 1, self.exp_date)
+        self.cache.put('key2', 2, self.exp_date)
+        self.cache.get('key1')
+        self.cache.put('key3', 3, self.exp_date)
+
+        self.assertEquals(self.cache.get('key2'), None,
+                          """Test that the least recently used entry is
+                          evicted when the cache is full""")
+        self.assertNotEqual(self.cache.get('key1'), None)
+        self.assertNotEqual(self.cache.get('key3'), None)
+
+    def test_needs_renewal(self):
+        self.cache.put('key', 1, self.exp_date)
+        self.assertFalse(self.cache.needs_renewal(
+            'key', self.exp_date + datetime.timedelta(minutes=1)))
+        self.assertTrue(self.cache.needs_renewal(
+            'key', self.exp_date + datetime.timedelta(days=1)))
+        self.assertTrue(self.cache.needs_renewal(
+            'other key', self.exp_date),
+            """Test that a session key that isn't cached is always
+            renewed""")
+
+
+if __name__ == '__main__':
+    suite = u.TestLoader().loadTestsFromTestCase(SessionCacheTest)
+    u.TextTestRunner(verbosity=2).run(suite)
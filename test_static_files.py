@@ -0,0 +1,236 @@
+import unittest as u
+import email.utils
+import os
+import shutil
+import tempfile
+import gzip
+from static_files import \
+    Asset, AssetCache, FileAsset, RangeNotSatisfiable, RouteTable, \
+    compress_file, parse_range
+
+
+class AssetTest(u.TestCase):
+    def setUp(self):
+        self.asset = Asset('body {}', 'text/css', 1000000000)
+
+    def test_etag_matches(self):
+        self.assertTrue(self.asset.not_modified(self.asset.etag, None))
+        self.assertTrue(self.asset.not_modified(
+            '"other", W/' + self.asset.etag, None))
+        self.assertTrue(self.asset.not_modified('*', None))
+
+    def test_etag_differs(self):
+        self.assertFalse(self.asset.not_modified('"other"', None))
+        self.assertFalse(self.asset.not_modified(
+            '"other"', self.asset.last_modified),
+            """Test that If-Modified-Since is ignored when If-None-Match
+            is present""")
+
+    def test_if_modified_since(self):
+        self.assertTrue(self.asset.not_modified(
+            None, self.asset.last_modified))
+        self.assertFalse(self.asset.not_modified(
+            None, email.utils.formatdate(999999999, usegmt=True)))
+        self.assertFalse(self.asset.not_modified(None, 'invalid'))
+
+    def test_no_conditional_headers(self):
+        self.assertFalse(self.asset.not_modified(None, None))
+
+    def test_negotiate(self):
+        gzipped = Asset('gzipped', 'text/css', 1000000000, 'gzip')
+        self.asset.variants['gzip'] = gzipped
+        self.assertIs(self.asset.negotiate('gzip, deflate'), gzipped)
+        self.assertIs(self.asset.negotiate('*'), gzipped)
+        self.assertIs(self.asset.negotiate(None), self.asset)
+        self.assertIs(self.asset.negotiate('deflate'), self.asset)
+        self.assertIs(self.asset.negotiate('gzip;q=0'), self.asset)
+
+    def test_negotiate_preference(self):
+        gzipped = Asset('gzipped', 'text/css', 1000000000, 'gzip')
+        brotli = Asset('brotli', 'text/css', 1000000000, 'br')
+        self.asset.variants = {'gzip': gzipped, 'br': brotli}
+        self.assertIs(self.asset.negotiate('gzip, br'), brotli)
+        self.assertIs(self.asset.negotiate('gzip, br;q=0.5'), gzipped)
+
+
+class RangeTest(u.TestCase):
+    def test_range(self):
+        self.assertEquals(parse_range('bytes=0-99', 1000), (0, 100))
+        self.assertEquals(parse_range('bytes=500-', 1000), (500, 1000))
+        self.assertEquals(parse_range('bytes=-100', 1000), (900, 1000))
+        self.assertEquals(parse_range('bytes=900-2000', 1000), (900, 1000))
+        self.assertEquals(parse_range('bytes=-2000', 1000), (0, 1000))
+
+    def test_ignored_range(self):
+        self.assertEquals(parse_range('bytes=0-1,5-6', 1000), None)
+        self.assertEquals(parse_range('bytes=5-1', 1000), None)
+        self.assertEquals(parse_range('bytes=a-b', 1000), None)
+        self.assertEquals(parse_range('bytes=--5', 1000), None)
+        self.assertEquals(parse_range('bytes=-+5', 1000), None)
+        self.assertEquals(parse_range('bytes=+5-', 1000), None)
+        self.assertEquals(parse_range('bytes=-', 1000), None)
+        self.assertEquals(parse_range('items=0-1', 1000), None)
+
+    def test_range_not_satisfiable(self):
+        with self.assertRaises(RangeNotSatisfiable):
+            parse_range('bytes=1000-', 1000)
+        with self.assertRaises(RangeNotSatisfiable):
+            parse_range('bytes=-0', 1000)
+        with self.assertRaises(RangeNotSatisfiable):
+            parse_range('bytes=-5', 0)
+        with self.assertRaises(RangeNotSatisfiable):
+            parse_range('bytes=0-', 0)
+
+
+class AssetCacheTest(u.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.cache = AssetCache(max_size=10)
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def write(self, name, data, mtime=1000000000):
+        path = os.path.join(self.directory, name)
+        with open(path, 'wb') as f:
+            f.write(data)
+        os.utime(path, (mtime, mtime))
+        return path
+
+    def test_get_asset(self):
+        path = self.write('style.css', 'body {}')
+        asset = self.cache.get(path)
+        self.assertEquals(asset.data, 'body {}')
+        self.assertEquals(asset.mime, 'text/css')
+        self.assertEquals(asset.size, 7)
+        self.assertIs(self.cache.get(path), asset)
+
+    def test_missing_file(self):
+        with self.assertRaises(OSError):
+            self.cache.get(os.path.join(self.directory, 'missing'))
+
+    def test_invalidate_on_mtime_change(self):
+        path = self.write('a.txt', 'old')
+        old = self.cache.get(path)
+        self.write('a.txt', 'new', mtime=1000000001)
+        new = self.cache.get(path)
+        self.assertEquals(new.data, 'new')
+        self.assertNotEquals(new.etag, old.etag)
+        self.assertEquals(self.cache.size, 3)
+
+    def test_evict_least_recently_used(self):
+        a = self.write('a.txt', 'aaaa')
+        b = self.write('b.txt', 'bbbb')
+        c = self.write('c.txt', 'cccc')
+        self.cache.get(a)
+        self.cache.get(b)
+        self.cache.get(a)
+        self.cache.get(c)
+        self.assertEquals(list(self.cache.assets), [a, c])
+        self.assertEquals(self.cache.size, 8)
+
+    def test_large_file_not_cached(self):
+        path = self.write('large.txt', 'x' * 11)
+        self.assertEquals(self.cache.get(path).size, 11)
+        self.assertEquals(len(self.cache.assets), 0)
+
+    def test_precompressed_variant(self):
+        path = self.write('style.css', 'body {}' * 10)
+        compress_file(path)
+        cache = AssetCache()
+        gzipped = cache.get(path).variants['gzip']
+        self.assertEquals(gzipped.encoding, 'gzip')
+        self.assertEquals(
+            gzip.open(path + '.gz').read(), 'body {}' * 10)
+        self.assertEquals(cache.size, 70 + gzipped.size)
+
+    def test_outdated_variant_ignored(self):
+        path = self.write('style.css', 'body {}' * 10)
+        compress_file(path)
+        self.write('style.css', 'body {}' * 20, mtime=2000000000)
+        self.assertEquals(self.cache.get(path).variants, {})
+
+    def test_incompressible_file(self):
+        path = self.write('a.txt', 'a')
+        compress_file(path)
+        self.assertFalse(os.path.exists(path + '.gz'))
+
+    def test_stream_large_file(self):
+        data = ''.join(chr(i % 256) for i in range(200 * 1024))
+        path = self.write('large.bin', data)
+        asset = AssetCache(stream_threshold=1024).get(path)
+        self.assertIsInstance(asset, FileAsset)
+        self.assertEquals(asset.size, len(data))
+        self.assertEquals(asset.memory_size, 0)
+        self.assertEquals(asset.etag, Asset(data, '', 0).etag)
+        chunks = list(asset.chunks())
+        self.assertEquals(len(chunks), 4)
+        self.assertEquals(''.join(chunks), data)
+        self.assertEquals(''.join(asset.chunks(1000, 150000)),
+                          data[1000:150000])
+
+
+class RouteTableTest(u.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        os.mkdir(os.path.join(self.directory, 'promo'))
+        os.mkdir(os.path.join(self.directory, 'promo', 'css'))
+        self.write('index.html')
+        self.write('promo/index.html')
+        self.write('promo/css/style.css')
+        self.routes = RouteTable(self.directory)
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def write(self, name):
+        with open(os.path.join(self.directory, name), 'wb') as f:
+            f.write(name)
+
+    def test_file(self):
+        route = self.routes.lookup('/promo/css/style.css')
+        self.assertEquals(route.path, os.path.join(
+            self.directory, 'promo', 'css', 'style.css'))
+        self.assertEquals(route.mime, 'text/css')
+        self.assertEquals(route.stat.st_size, len('promo/css/style.css'))
+
+    def test_directory_index(self):
+        index = self.routes.lookup('/promo/index.html')
+        self.assertIs(self.routes.lookup('/promo'), index)
+        self.assertIs(self.routes.lookup('/promo/'), index)
+        self.assertEquals(self.routes.lookup('/').path,
+                          os.path.join(self.directory, 'index.html'))
+        self.assertIsNone(self.routes.lookup('/promo/css/'),
+                          """Test that directories without index.html
+                          have no route""")
+
+    def test_normalized_path(self):
+        index = self.routes.lookup('/promo/index.html')
+        self.assertIs(self.routes.lookup('/promo/index.html?lang=nl'), index)
+        self.assertIs(self.routes.lookup('/promo/css/../index.html'), index)
+        self.assertIs(self.routes.lookup('//promo//index.html'), None)
+
+    def test_outside_directory(self):
+        name = os.path.basename(self.directory)
+        self.assertIsNone(self.routes.lookup('/../' + name + '/index.html'))
+        self.assertIsNone(self.routes.lookup('/../../etc/passwd'))
+
+    def test_variant_not_routable(self):
+        self.write('promo/css/style.css.gz')
+        self.write('promo/css/style.css.br')
+        self.routes.refresh()
+        self.assertIsNone(self.routes.lookup('/promo/css/style.css.gz'),
+                          """Test that precompressed variants aren't
+                          served as files of their own""")
+        self.assertIsNone(self.routes.lookup('/promo/css/style.css.br'))
+        self.assertIsNotNone(self.routes.lookup('/promo/css/style.css'))
+
+    def test_refresh(self):
+        self.write('promo/new.css')
+        os.remove(os.path.join(self.directory, 'promo', 'index.html'))
+        self.assertIsNone(self.routes.lookup('/promo/new.css'))
+        self.routes.refresh()
+        self.assertEquals(self.routes.lookup('/promo/new.css').mime,
+                          'text/css')
+        self.assertIsNone(self.routes.lookup('/promo'))
+        self.assertIsNone(self.routes.lookup('/promo/index.html'))